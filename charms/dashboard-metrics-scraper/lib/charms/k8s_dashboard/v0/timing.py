@@ -0,0 +1,101 @@
+"""Hook timing instrumentation for the Kubernetes Dashboard charms.
+
+A HookTimer splits a hook into phases, timed as laps: each call to lap()
+closes the phase which started at the previous call, or when the timer was
+created. A disabled timer records nothing, so the calls can stay in place.
+HookTimings keeps the timings of the latest hook of each kind, and reports
+them in the hook-timings action.
+
+This library is owned by the k8s-dashboard charm; the dashboard-metrics-scraper
+charm carries a copy of it, which must be kept identical.
+"""
+
+import json
+import logging
+import time
+
+from ops.framework import Object, StoredState
+
+# The unique Charmhub library identifier, never change it
+LIBID = "2d6012d2c3c444a0b3bc1affdfe2f0d8"
+
+# Increment this major API version when introducing breaking changes
+LIBAPI = 0
+
+# Increment this PATCH version before using `charmcraft publish-lib` or reset
+# to 0 if you are raising the major API version
+LIBPATCH = 2
+
+logger = logging.getLogger(__name__)
+
+
+class HookTimer:
+    """Time the phases of a hook."""
+
+    def __init__(self, enabled=True, clock=time.perf_counter):
+        self.enabled = enabled
+        self.phases = {}
+        self._clock = clock
+        self._start = self._last = clock() if enabled else None
+
+    def lap(self, phase):
+        """Close the current phase, recording its duration under ``phase``.
+
+        Durations of phases recorded more than once are added up.
+        """
+        if not self.enabled:
+            return
+        now = self._clock()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def summary(self):
+        """Summarize the phases recorded so far.
+
+        Returns:
+            Dict[str, str]: milliseconds taken by each phase, keyed by
+            ``<phase>-ms``, and by the whole hook, keyed by ``total-ms``. The
+            values are strings so that they can be used as action results.
+            Empty if the timer is disabled.
+        """
+        if not self.enabled:
+            return {}
+        summary = {'{}-ms'.format(phase): '{:.1f}'.format(seconds * 1000)
+                   for phase, seconds in self.phases.items()}
+        summary['total-ms'] = '{:.1f}'.format((self._clock() - self._start) * 1000)
+        return summary
+
+
+class HookTimings(Object):
+    """Keep the timings of the latest hook of each kind, for the action."""
+
+    state = StoredState()
+
+    def __init__(self, charm, key='hook-timings'):
+        super().__init__(charm, key)
+        self.framework.observe(charm.on.hook_timings_action,
+                               self.on_hook_timings_action)
+
+    def record(self, event, timer):
+        """Log the phase timings of a hook and keep them for the action.
+
+        Args:
+            event (EventBase): the event the hook ran for.
+            timer (HookTimer): the timer of the hook.
+        """
+        if not timer.enabled:
+            return
+        self.state.set_default(hook_timings={})
+        kind = event.handle.kind.replace('_', '-')
+        timings = timer.summary()
+        logger.info('Hook timings: %s', json.dumps(dict(timings, event=kind),
+                                                   sort_keys=True))
+        self.state.hook_timings[kind] = timings
+
+    def on_hook_timings_action(self, event):
+        self.state.set_default(hook_timings={})
+        if not self.state.hook_timings:
+            event.fail('No hook timings recorded, is the hook-timings option enabled?')
+            return
+        event.set_results({kind: dict(timings)
+                           for kind, timings in self.state.hook_timings.items()})
@@ -1,160 +1,389 @@
 #!/usr/bin/env python3
 
+import json
 import logging
+import re
+from pathlib import PurePosixPath
 
-from ops.charm import CharmBase
+from ops.charm import CharmBase, LeaderElectedEvent, UpgradeCharmEvent
 from ops.main import main
-from ops.model import ActiveStatus, MaintenanceStatus, WaitingStatus
+from ops.model import ActiveStatus, WaitingStatus
+from ops.framework import StoredState
 
-from oci_image import OCIImageResource, OCIImageResourceError
-from k8s_service import ProvideK8sService
+from charms.k8s_dashboard.v0 import k8s_api, pod_spec, reconciler, timing
+
+
+SERVICE_ANNOTATIONS = {
+    'seccomp.security.alpha.kubernetes.io/pod': 'runtime/default',
+}
+
+# Mount point of the optional database storage, see metadata.yaml.
+STORAGE_LOCATION = '/var/lib/metrics-scraper'
+
+# Workload container and Pebble service in sidecar mode, see metadata.yaml.
+WORKLOAD_CONTAINER = 'metrics-scraper'
+SCRAPER_COMMAND = '/metrics-sidecar'
+
+_DURATION_RE = re.compile(r'^(?:[0-9]+(?:\.[0-9]+)?(?:ns|us|ms|s|m|h))+$')
+_DURATION_PART_RE = re.compile(r'([0-9]+(?:\.[0-9]+)?)(ns|us|ms|s|m|h)')
+_DURATION_UNITS = {
+    'ns': 10 ** -9, 'us': 10 ** -6, 'ms': 10 ** -3, 's': 1, 'm': 60, 'h': 3600,
+}
 
 
 class DashboardMetricsScraperCharm(CharmBase):
+    state = StoredState()
+
     def __init__(self, *args):
         super().__init__(*args)
+        self.hook_timings = timing.HookTimings(self)
+        self.reconciler = reconciler.Reconciler(self)
+        self.framework.observe(self.on.reconcile_stats_action,
+                               self.on_reconcile_stats_action)
         if not self.unit.is_leader():
             # We can't do anything useful when not the leader, so do nothing.
-            self.model.unit.status = WaitingStatus('Waiting for leadership')
+            # The status is only written once, not on every hook, as each
+            # write is a request to the controller.
+            self.state.set_default(waiting_for_leadership=False)
+            if not self.state.waiting_for_leadership:
+                self.model.unit.status = WaitingStatus('Waiting for leadership')
+                self.state.waiting_for_leadership = True
             return
-
-        ProvideK8sService(self,
-                          'metrics-scraper',
-                          service_name=self.app.name,
-                          service_port=self.model.config["port"])
+        # Only the leader uses it, non-leader hooks are spared importing it.
+        from oci_image import OCIImageResource
 
         self.log = logging.getLogger(__name__)
+        self.state.set_default(image_details=None)
         self.scraper_image = OCIImageResource(self, 'metrics-scraper-image')
-        for event in [self.on.install,
-                      self.on.leader_elected,
+        # config-changed always follows install, which would only set the
+        # same spec again after leader-elected forgot it.
+        for event in [self.on.leader_elected,
                       self.on.upgrade_charm,
-                      self.on.config_changed]:
+                      self.on.config_changed,
+                      self.on.database_storage_attached,
+                      self.on.metrics_scraper_relation_created,
+                      self.on.metrics_endpoint_relation_created]:
             self.framework.observe(event, self.main)
+        if self._sidecar:
+            self.framework.observe(self.on[WORKLOAD_CONTAINER].pebble_ready, self.main)
 
     def main(self, event):
+        # Statuses set from now on replace the non-leader one.
+        self.state.waiting_for_leadership = False
+        self.timer = timing.HookTimer(self.model.config['hook-timings'])
         try:
-            scraper_image_details = self.scraper_image.fetch()
-        except OCIImageResourceError as e:
+            self._main(event)
+        finally:
+            self.hook_timings.record(event, self.timer)
+
+    def on_reconcile_stats_action(self, event):
+        event.set_results(self.reconciler.stats())
+
+    def _main(self, event):
+        from oci_image import OCIImageResourceError
+
+        if isinstance(event, LeaderElectedEvent):
+            self.reconciler.forget_applied()
+        config = self.model.config
+        try:
+            scraper_image_details = self._fetch_image_details(event)
+            self.timer.lap('image-fetch')
+            pull_policy = pod_spec.image_pull_policy(
+                scraper_image_details['imagePath'], config['image-pull-policy'])
+            resources = pod_spec.container_resources(config)
+            tmp_volume = pod_spec.tmp_volume(config['tmp-volume-size-limit'])
+            probes = pod_spec.probes('HTTP', config['port'], config)
+            args = self._build_args()
+            placement = pod_spec.placement(self.app.name, config, self._app_label)
+            autoscaler = pod_spec.autoscaler(self.app.name, self._workload_kind(),
+                                             config)
+            scrape_annotations = pod_spec.scrape_annotations(config['port'], 'http',
+                                                             config)
+            pod_monitor = pod_spec.pod_monitor(
+                self.app.name, pod_spec.METRICS_SCRAPER_PORT, 'http', config,
+                app_label=self._app_label)
+            scrape_job = pod_spec.scrape_job(
+                self.app.name,
+                '{}.{}.svc:{}'.format(self._service_name, self.model.name,
+                                      config['port']),
+                'http', config)
+        except (OCIImageResourceError, pod_spec.ConfigError) as e:
             self.model.unit.status = e.status
             return
+        self.timer.lap('config')
 
-        self.model.unit.status = MaintenanceStatus('Setting pod spec')
+        # In sidecar mode Juju runs the pods without a spec, all the placement
+        # is patched into the workload.
+        pod_placement = {} if self._sidecar else {
+            key: value for key, value in placement.items()
+            if key in pod_spec.POD_SPEC_PLACEMENT}
+        placement_patch = pod_spec.workload_placement(
+            self.app.name, self._workload_kind(),
+            {key: value for key, value in placement.items()
+             if key not in pod_placement},
+            container=self._container_name, resources=resources)
 
-        self.model.pod.set_spec({
+        kubernetes = dict(probes, securityContext=pod_spec.SECURITY_CONTEXT)
+
+        spec = {
             'version': 3,
-            'service': {
-                'updateStrategy': {
-                    'type': 'RollingUpdate',
-                    'rollingUpdate': {'maxUnavailable': 1},
-                },
-                'annotations': {
-                    'seccomp.security.alpha.kubernetes.io/pod': 'runtime/default',
-                },
-            },
+            'service': dict(pod_spec.SERVICE, annotations=SERVICE_ANNOTATIONS),
             'containers': [
                 {
-                    'name': self.model.app.name,
+                    'name': self._container_name,
                     'imageDetails': scraper_image_details,
-                    'ports': [
-                        {
-                            'name': 'scraper',
-                            'containerPort': self.model.config["port"],
-                            'protocol': 'TCP',
-                        },
-                    ],
-                    'volumeConfig': [
-                        {
-                            'name': 'tmp-volume',
-                            'mountPath': '/tmp',
-                            'emptyDir': {
-                                'medium': 'Memory',
-                            },
-                        },
-                    ],
-                    'kubernetes': {
-                        'securityContext': {
-                            'allowPrivilegeEscalation': False,
-                            'readOnlyRootFilesystem': True,
-                            'runAsUser': 1001,
-                            'runAsGroup': 2001,
-                        },
-                        'livenessProbe': {
-                            'httpGet': {
-                                'scheme': 'HTTP',
-                                'path': '/',
-                                'port': 8000,
-                            },
-                            'initialDelaySeconds': 30,
-                            'timeoutSeconds': 30,
-                        },
-                    },
+                    'ports': [pod_spec.container_port(pod_spec.METRICS_SCRAPER_PORT,
+                                                      config["port"])],
+                    'args': args,
+                    'volumeConfig': [tmp_volume],
+                    'kubernetes': kubernetes,
                 },
             ],
-            'serviceAccount': {
-                'roles': [
-                    {
-                        'rules': [
-                            {
-                                'apiGroups': [''],
-                                'resources': ['secrets'],
-                                'resourceNames': [
-                                    'kubernetes-dashboard-key-holder',
-                                    'kubernetes-dashboard-certs',
-                                    'kubernetes-dashboard-csrf',
-                                ],
-                                'verbs': ['get', 'update', 'delete'],
-                            },
-                            {
-                                'apiGroups': [''],
-                                'resources': ['configmaps'],
-                                'resourceNames': [
-                                    'kubernetes-dashboard-settings'],
-                                'verbs': ['get', 'update'],
-                            },
-                            {
-                                'apiGroups': [''],
-                                'resources': ['services'],
-                                'resourceNames': [
-                                    'heapster',
-                                    'dashboard-metrics-scraper',
-                                ],
-                                'verbs': ['proxy'],
-                            },
-                            {
-                                'apiGroups': [''],
-                                'resources': ['services/proxy'],
-                                'resourceNames': [
-                                    'heapster',
-                                    'http:heapster',
-                                    'https:heapster',
-                                    'dashboard-metrics-scraper',
-                                    'http:dashboard-metrics-scraper',
-                                ],
-                                'verbs': ['get'],
-                            },
-                            {
-                                'apiGroups': ['metrics.k8s.io'],
-                                'resources': ['pods', 'nodes'],
-                                'verbs': ['get', 'list', 'watch'],
-                            },
-                        ],
-                    },
-                    {
-                        'global': True,
-                        'rules': [
-                            {
-                                'apiGroups': ['metrics.k8s.io'],
-                                'resources': ['pods', 'nodes'],
-                                'verbs': ['get', 'list', 'watch'],
-                            },
-                        ],
-                    },
-                ],
+            'serviceAccount': pod_spec.SERVICE_ACCOUNT,
+            'kubernetesResources': {
+                'services': [self._build_service()],
+                'pod': dict(
+                    pod_placement,
+                    # Lets the dashboard fan out to several scraper apps.
+                    labels={pod_spec.METRICS_SCRAPER_LABEL: 'true'},
+                ),
             },
-        })
+        }
+        if pull_policy:
+            spec['containers'][0]['imagePullPolicy'] = pull_policy
+        if config['db-file'].startswith(STORAGE_LOCATION + '/'):
+            # The storage volume is owned by root, let the scraper write to it.
+            spec['kubernetesResources']['pod']['securityContext'] = {
+                'fsGroup': pod_spec.SECURITY_CONTEXT['runAsGroup'],
+            }
+        if scrape_annotations:
+            spec['kubernetesResources']['pod']['annotations'] = scrape_annotations
+        if pod_monitor:
+            spec['kubernetesResources']['customResources'] = {
+                pod_spec.POD_MONITOR_CRD: [pod_monitor],
+            }
+        self.timer.lap('spec-build')
+        if self._sidecar:
+            # Juju runs the pods, the spec only describes the workload and
+            # the resources to apply through the API.
+            if not self._replan_workload(args):
+                return
+            manifests = pod_spec.api_manifests(self.app.name, spec)
+        else:
+            self.reconciler.set_pod_spec(spec)
+            manifests = []
+        self.timer.lap('set-spec')
+        self._publish_service()
+        self._publish_scrape_job(scrape_job)
+        self.timer.lap('relation-write')
+
+        try:
+            self.reconciler.apply(manifests + ([autoscaler] if autoscaler else []),
+                                  placement_patch)
+        except k8s_api.APIError as e:
+            self.log.error('Failed to apply Kubernetes resources: %s', e)
+            self.model.unit.status = e.status
+            return
+        finally:
+            self.timer.lap('k8s-api')
 
         self.model.unit.status = ActiveStatus()
 
+    @property
+    def _sidecar(self):
+        """Whether the charm runs in sidecar mode.
+
+        Sidecar mode is chosen by declaring the workload container in
+        metadata.yaml, see the README.
+        """
+        return WORKLOAD_CONTAINER in self.meta.containers
+
+    @property
+    def _app_label(self):
+        return pod_spec.SIDECAR_APP_LABEL if self._sidecar else pod_spec.APP_LABEL
+
+    @property
+    def _container_name(self):
+        """Name of the scraper container in the workload."""
+        return WORKLOAD_CONTAINER if self._sidecar else self.app.name
+
+    @property
+    def _service_name(self):
+        # The application service Juju creates can't be session-affine, and
+        # has no ports in sidecar mode.
+        return '{}-workload'.format(self.app.name)
+
+    def _build_service(self):
+        """Generate the service the scraper is published with.
+
+        Each unit scrapes into its own database, so their metrics differ. The
+        service keeps a client on the same unit while it is ready, rather
+        than mixing the metrics of all of them.
+
+        Returns:
+            Dict[str, Any]: the service resource.
+        """
+        port = self.model.config['port']
+        return {
+            'name': self._service_name,
+            'annotations': SERVICE_ANNOTATIONS,
+            'spec': {
+                'selector': {self._app_label: self.app.name},
+                'ports': [{
+                    'name': pod_spec.METRICS_SCRAPER_PORT,
+                    'protocol': 'TCP',
+                    'port': port,
+                    'targetPort': port,
+                }],
+                'sessionAffinity': 'ClientIP',
+            },
+        }
+
+    def _replan_workload(self, args):
+        """Run the scraper with the given arguments under Pebble.
+
+        A changed command is applied by Pebble restarting the scraper in
+        place, rather than Juju replacing the pod.
+
+        Args:
+            args (List[str]): the scraper arguments.
+
+        Returns:
+            bool: whether the scraper is running the layer, False if Pebble
+            is not ready yet.
+        """
+        from ops.pebble import APIError, ConnectionError
+
+        container = self.unit.get_container(WORKLOAD_CONTAINER)
+        if not container.can_connect():
+            self.model.unit.status = WaitingStatus('Waiting for Pebble')
+            return False
+        layer = pod_spec.pebble_layer(WORKLOAD_CONTAINER, [SCRAPER_COMMAND] + args)
+        try:
+            container.add_layer(WORKLOAD_CONTAINER, layer, combine=True)
+            container.replan()
+        except (APIError, ConnectionError) as e:
+            self.log.error('Failed to start the scraper: %s', e)
+            self.model.unit.status = WaitingStatus('Waiting for Pebble')
+            return False
+        return True
+
+    def _workload_kind(self):
+        """Get the kind of workload Juju runs the pods in.
+
+        Juju uses a StatefulSet when the application has storage attached,
+        whether the database is kept on it or not, see the db-file option,
+        and always in sidecar mode.
+        """
+        if self._sidecar or self.model.storages['database']:
+            return 'StatefulSet'
+        return 'Deployment'
+
+    def _build_args(self):
+        """Generate the metrics scraper arguments.
+
+        Returns:
+            List[str]: the container args.
+
+        Raises:
+            ConfigError: if a duration or the database file is invalid.
+        """
+        config = self.model.config
+        resolution = parse_duration('metric-resolution', config['metric-resolution'])
+        duration = parse_duration('metric-duration', config['metric-duration'])
+        if resolution > duration:
+            raise pod_spec.ConfigError('metric-resolution exceeds metric-duration')
+
+        db_file = PurePosixPath(config['db-file'])
+        if str(db_file.parent) not in ('/tmp', STORAGE_LOCATION):
+            raise pod_spec.ConfigError(
+                'db-file must be in /tmp or {}'.format(STORAGE_LOCATION))
+        on_storage = str(db_file.parent) == STORAGE_LOCATION
+        if on_storage and not self.model.storages['database']:
+            # The root filesystem is read-only, the scraper would crash-loop.
+            raise pod_spec.ConfigError('db-file requires the database storage')
+
+        return [
+            '--metric-resolution={}'.format(config['metric-resolution']),
+            '--metric-duration={}'.format(config['metric-duration']),
+            '--db-file={}'.format(db_file),
+        ]
+
+    def _fetch_image_details(self, event):
+        """Fetch the image details, reusing the ones from a previous hook.
+
+        Fetching the resource costs a round-trip to the controller. Attaching
+        a new revision of the resource triggers upgrade-charm, which is the
+        only time it can change after it was first fetched. A new leader
+        fetches them again too, as it may have missed that hook.
+
+        Raises:
+            OCIImageResourceError: if the resource is missing or invalid.
+        """
+        if (isinstance(event, (UpgradeCharmEvent, LeaderElectedEvent))
+                or not self.state.image_details):
+            self.state.image_details = self.scraper_image.fetch()
+        return dict(self.state.image_details)
+
+    def _publish_service(self):
+        """Advertise the service of the scraper to the related dashboards.
+
+        This is the provider side of the k8s-service interface. Values are
+        only written when they change, as each write fires relation-changed,
+        and a reconcile, on the dashboard.
+        """
+        data = {
+            'service-name': self._service_name,
+            'service-port': str(self.model.config['port']),
+        }
+        for relation in self.model.relations['metrics-scraper']:
+            app_data = relation.data[self.app]
+            for key, value in data.items():
+                if app_data.get(key) != value:
+                    app_data[key] = value
+
+    def _publish_scrape_job(self, job):
+        """Advertise the metrics endpoint to the related Prometheus consumers.
+
+        Values are only written when they change, as each write fires
+        relation-changed on the consumer.
+        """
+        data = {
+            'scrape_jobs': json.dumps([job], sort_keys=True),
+            'scrape_metadata': json.dumps({
+                'model': self.model.name,
+                'application': self.app.name,
+                'charm_name': self.meta.name,
+            }, sort_keys=True),
+        }
+        for relation in self.model.relations['metrics-endpoint']:
+            app_data = relation.data[self.app]
+            for key, value in data.items():
+                if app_data.get(key) != value:
+                    app_data[key] = value
+
+
+def parse_duration(option, value):
+    """Parse a Go duration such as 1m30s.
+
+    Args:
+        option (str): name of the config option, used in the error message.
+        value (str): the duration.
+
+    Returns:
+        float: the duration in seconds.
+
+    Raises:
+        ConfigError: if the value is not a valid, non-zero duration.
+    """
+    if not _DURATION_RE.match(value):
+        raise pod_spec.ConfigError('Invalid {}: {!r}'.format(option, value))
+    seconds = sum(float(number) * _DURATION_UNITS[unit]
+                  for number, unit in _DURATION_PART_RE.findall(value))
+    if not seconds:
+        raise pod_spec.ConfigError('Invalid {}: {!r}'.format(option, value))
+    return seconds
+
 
 if __name__ == "__main__":
     main(DashboardMetricsScraperCharm)
@@ -1,3 +1,6 @@
+import json
+from unittest import mock
+
 import pytest
 
 from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
@@ -5,6 +8,7 @@ from ops.testing import Harness
 import yaml
 
 from charm import DashboardMetricsScraperCharm
+from charms.k8s_dashboard.v0.reconciler import Reconciler
 
 
 if yaml.__with_libyaml__:
@@ -13,14 +17,35 @@ else:
     _DefaultDumper = yaml.SafeDumper
 
 
+@pytest.fixture(autouse=True)
+def k8s_client(monkeypatch):
+    # A new leader lists what the previous one applied through the API.
+    client = mock.Mock(**{"list.return_value": []})
+    monkeypatch.setattr(Reconciler, "client", property(lambda self: client))
+    return client
+
+
 @pytest.fixture
 def harness():
     return Harness(DashboardMetricsScraperCharm)
 
 
+@pytest.fixture
+def sidecar_harness():
+    # The sidecar flavour of the charm declares its workload container.
+    with open("metadata.yaml") as f:
+        meta = yaml.safe_load(f)
+    meta["containers"] = {"metrics-scraper": {"resource": "metrics-scraper-image"}}
+    with open("actions.yaml") as f:
+        actions = f.read()
+    return Harness(DashboardMetricsScraperCharm, meta=yaml.safe_dump(meta),
+                   actions=actions)
+
+
 def test_not_leader(harness):
     harness.begin()
     assert isinstance(harness.charm.model.unit.status, WaitingStatus)
+    assert harness.charm.state.waiting_for_leadership
 
 
 def test_missing_image(harness):
@@ -60,8 +85,452 @@ def test_main_with_relation(harness):
     assert isinstance(harness.charm.model.unit.status, ActiveStatus)
 
     rel_data = harness.get_relation_data(rel_id, "dashboard-metrics-scraper")
-    assert rel_data["service-name"] == "dashboard-metrics-scraper"
+    assert rel_data["service-name"] == "dashboard-metrics-scraper-workload"
     assert rel_data["service-port"] == "8000"
+    # each unit keeps its own metrics, clients stick to one of them
+    service = harness.get_pod_spec()[0]["kubernetesResources"]["services"][0]
+    assert service["name"] == "dashboard-metrics-scraper-workload"
+    assert service["spec"]["sessionAffinity"] == "ClientIP"
+    assert service["spec"]["selector"] == {"juju-app": "dashboard-metrics-scraper"}
 
     # confirm that we can serialize the pod spec
     yaml.dump(harness.get_pod_spec(), Dumper=_DefaultDumper)
+
+
+def test_main_publishes_service_on_change(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    rel_id = harness.add_relation("metrics-scraper", "k8s-dashboard")
+    harness.begin_with_initial_hooks()
+    rel_data = harness.get_relation_data(rel_id, "dashboard-metrics-scraper")
+    assert rel_data["service-port"] == "8000"
+
+    relation = harness.charm.model.get_relation("metrics-scraper", rel_id)
+    app_data = relation.data[harness.charm.app]
+    content = type(app_data)
+    with mock.patch.object(
+        content, "__setitem__", autospec=True, side_effect=content.__setitem__
+    ) as setitem:
+        harness.charm.on.config_changed.emit()
+        setitem.assert_not_called()
+        harness.update_config(key_values={"port": 8080})
+    setitem.assert_called_once_with(app_data, "service-port", "8080")
+    assert rel_data["service-port"] == "8080"
+
+
+def test_main_skips_unchanged_spec(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    state = harness.charm.reconciler.state
+    applied, skipped = state.specs_applied, state.specs_skipped
+    assert applied == 1
+
+    harness.charm.on.config_changed.emit()
+    assert state.specs_applied == applied
+    assert state.specs_skipped == skipped + 1
+
+    harness.update_config(key_values={"port": 8001})
+    assert state.specs_applied == applied + 1
+    kubernetes = harness.get_pod_spec()[0]["containers"][0]["kubernetes"]
+    for probe in ("startupProbe", "livenessProbe", "readinessProbe"):
+        assert kubernetes[probe]["httpGet"]["port"] == 8001
+
+    # another unit may have set a different spec while this one wasn't the
+    # leader, so a new leader sets its spec even if it looks unchanged
+    harness.charm.on.leader_elected.emit()
+    assert state.specs_applied == applied + 2
+
+    action_event = mock.Mock()
+    harness.charm.on_reconcile_stats_action(action_event)
+    action_event.set_results.assert_called_once_with(
+        {"specs-applied": applied + 2, "specs-skipped": skipped + 1}
+    )
+
+
+def test_main_resources(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values={"cpu-request": "1", "cpu-limit": "500m"})
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "cpu-request exceeds cpu-limit"
+    )
+
+    harness.update_config(key_values={"cpu-request": "250m"})
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    container = harness.get_pod_spec()[0]["containers"][0]
+    # Juju takes no resources in a pod spec, they are patched into the workload
+    assert "resources" not in container["kubernetes"]
+    harness.charm.reconciler.spec_set = False
+    harness.framework.reemit()
+    patch = k8s_client.apply.call_args[0][0]
+    assert patch["kind"] == "Deployment"
+    assert patch["spec"]["template"]["spec"]["containers"] == [
+        {
+            "name": "dashboard-metrics-scraper",
+            "resources": {
+                "requests": {"cpu": "250m"},
+                "limits": {"cpu": "500m"},
+            },
+        },
+    ]
+
+
+def test_main_args(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    pod_spec = harness.get_pod_spec()[0]
+    assert pod_spec["containers"][0]["args"] == [
+        "--metric-resolution=1m",
+        "--metric-duration=15m",
+        "--db-file=/tmp/metrics.db",
+    ]
+    pod = pod_spec["kubernetesResources"]["pod"]
+    assert pod["labels"] == {"k8s-dashboard.juju.is/metrics-scraper": "true"}
+    assert "securityContext" not in pod
+
+    harness.update_config(
+        key_values={
+            "metric-resolution": "30s",
+            "metric-duration": "1h",
+            "db-file": "/var/lib/metrics-scraper/metrics.db",
+        }
+    )
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "db-file requires the database storage"
+    )
+
+    harness.add_storage("database")
+    harness.charm.on.config_changed.emit()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    pod_spec = harness.get_pod_spec()[0]
+    assert pod_spec["containers"][0]["args"] == [
+        "--metric-resolution=30s",
+        "--metric-duration=1h",
+        "--db-file=/var/lib/metrics-scraper/metrics.db",
+    ]
+    pod = pod_spec["kubernetesResources"]["pod"]
+    assert pod["securityContext"]["fsGroup"] == 2001
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"metric-duration": "15 minutes"}, "Invalid metric-duration: '15 minutes'"),
+        ({"metric-resolution": "0s"}, "Invalid metric-resolution: '0s'"),
+        ({"metric-resolution": "1h"}, "metric-resolution exceeds metric-duration"),
+        ({"db-file": "/metrics.db"},
+         "db-file must be in /tmp or /var/lib/metrics-scraper"),
+        ({"anti-affinity": "always"}, "Invalid anti-affinity: 'always'"),
+        ({"node-selector": "infra"},
+         "node-selector must be a mapping of labels to values"),
+    ],
+)
+def test_main_args_invalid(harness, config, message):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values=config)
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(message)
+
+
+def test_main_placement(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    pod = harness.get_pod_spec()[0]["kubernetesResources"]["pod"]
+    assert pod == {"labels": {"k8s-dashboard.juju.is/metrics-scraper": "true"}}
+    k8s_client.apply.assert_not_called()
+
+    # only the priority class goes in the spec, the rest is patched into the
+    # deployment once Juju replaced it, after the hook which set the spec
+    harness.update_config(
+        key_values={
+            "anti-affinity": "preferred",
+            "node-selector": "{node-role.kubernetes.io/infra: 'true'}",
+            "priority-class-name": "infra",
+        }
+    )
+    pod = harness.get_pod_spec()[0]["kubernetesResources"]["pod"]
+    assert pod["priorityClassName"] == "infra"
+    assert "affinity" not in pod and "nodeSelector" not in pod
+    k8s_client.apply.assert_not_called()
+    harness.charm.reconciler.spec_set = False
+    harness.framework.reemit()
+    patch = k8s_client.apply.call_args[0][0]
+    assert (patch["kind"], patch["metadata"]["name"]) == (
+        "Deployment", "dashboard-metrics-scraper"
+    )
+    template = patch["spec"]["template"]["spec"]
+    assert template["nodeSelector"] == {"node-role.kubernetes.io/infra": "true"}
+    [rule] = template["affinity"]["podAntiAffinity"][
+        "preferredDuringSchedulingIgnoredDuringExecution"
+    ]
+    assert rule["podAffinityTerm"]["labelSelector"] == {
+        "matchLabels": {"juju-app": "dashboard-metrics-scraper"}
+    }
+
+    # a placement change alone leaves the spec alone and patches right away
+    specs_applied = harness.charm.reconciler.state.specs_applied
+    harness.update_config(key_values={"anti-affinity": "required"})
+    assert harness.charm.reconciler.state.specs_applied == specs_applied
+    template = k8s_client.apply.call_args[0][0]["spec"]["template"]["spec"]
+    assert "requiredDuringSchedulingIgnoredDuringExecution" in (
+        template["affinity"]["podAntiAffinity"]
+    )
+
+
+def test_main_image_pull_policy(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    assert "imagePullPolicy" not in harness.get_pod_spec()[0]["containers"][0]
+
+    harness.update_config(key_values={"image-pull-policy": "Never"})
+    container = harness.get_pod_spec()[0]["containers"][0]
+    assert container["imagePullPolicy"] == "Never"
+
+
+def test_hook_timings(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values={"hook-timings": True})
+    harness.begin_with_initial_hooks()
+    action_event = mock.Mock()
+    harness.charm.hook_timings.on_hook_timings_action(action_event)
+    results = action_event.set_results.call_args[0][0]
+    assert set(results) == {"leader-elected", "config-changed"}
+    assert "set-spec-ms" in results["leader-elected"]
+
+
+def test_image_details_cached(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    image = harness.charm.scraper_image
+    with mock.patch.object(image, "fetch", wraps=image.fetch) as fetch:
+        harness.update_config(key_values={"metric-duration": "30m"})
+        fetch.assert_not_called()
+
+        harness.charm.on.upgrade_charm.emit()
+        fetch.assert_called_once()
+
+        # a new leader may have missed upgrade-charm while it wasn't one
+        harness.charm.on.leader_elected.emit()
+        assert fetch.call_count == 2
+
+
+def test_main_metrics(harness):
+    harness.set_leader(True)
+    harness.set_model_name("dashboard")
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus")
+    harness.update_config(
+        key_values={
+            "metrics-annotations": True,
+            "pod-monitor": True,
+            "metrics-scrape-interval": 15,
+        }
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    pod_spec = harness.get_pod_spec()[0]
+    yaml.dump(pod_spec, Dumper=_DefaultDumper)
+    pod = pod_spec["kubernetesResources"]["pod"]
+    assert pod["labels"] == {"k8s-dashboard.juju.is/metrics-scraper": "true"}
+    assert pod["annotations"]["prometheus.io/port"] == "8000"
+    monitors = pod_spec["kubernetesResources"]["customResources"][
+        "podmonitors.monitoring.coreos.com"
+    ]
+    assert monitors[0]["spec"]["podMetricsEndpoints"] == [
+        {"port": "scraper", "path": "/metrics", "scheme": "http", "interval": "15s"}
+    ]
+
+    rel_data = harness.get_relation_data(rel_id, "dashboard-metrics-scraper")
+    (job,) = json.loads(rel_data["scrape_jobs"])
+    assert job["static_configs"] == [
+        {"targets": ["dashboard-metrics-scraper-workload.dashboard.svc:8000"]}
+    ]
+    assert json.loads(rel_data["scrape_metadata"])["charm_name"] == (
+        "dashboard-metrics-scraper"
+    )
+
+
+def test_main_autoscaling(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "autoscaling-max-replicas": 3,
+            "autoscaling-target-memory": 80,
+        }
+    )
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "autoscaling-target-memory requires memory-request"
+    )
+    k8s_client.apply.assert_not_called()
+
+    harness.update_config(key_values={"memory-request": "64Mi"})
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    autoscaler = k8s_client.apply.call_args[0][0]
+    assert autoscaler["spec"]["scaleTargetRef"]["kind"] == "Deployment"
+
+    # attached storage makes Juju run a StatefulSet, even with the default
+    # db-file out of it
+    harness.add_storage("database")
+    harness.charm.on.config_changed.emit()
+    autoscaler = k8s_client.apply.call_args[0][0]
+    assert autoscaler["spec"]["scaleTargetRef"]["kind"] == "StatefulSet"
+    metric = autoscaler["spec"]["metrics"][0]["resource"]
+    assert metric == {
+        "name": "memory",
+        "target": {"type": "Utilization", "averageUtilization": 80},
+    }
+
+
+def test_main_sidecar(sidecar_harness, monkeypatch, k8s_client):
+    harness = sidecar_harness
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "metrics-scraper-image",
+        {
+            "registrypath": "kubernetesui/metrics-scraper:v1.0.5",
+            "username": "",
+            "password": "",
+        },
+    )
+    rel_id = harness.add_relation("metrics-scraper", "kubernetes-dashboard")
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    assert harness.charm.reconciler.state.specs_applied == 0
+    plan = harness.get_container_pebble_plan("metrics-scraper")
+    command = plan.services["metrics-scraper"].command.split()
+    assert command[0] == "/metrics-sidecar"
+    assert "--metric-resolution=1m" in command
+    # a new leader also releases any placement another unit patched in
+    applied = {manifest["kind"]: manifest
+               for manifest in [call[0][0] for call in k8s_client.apply.call_args_list]}
+    assert applied["StatefulSet"]["spec"] == {"template": {"spec": {}}}
+    service = applied["Service"]
+    assert service["metadata"]["name"] == "dashboard-metrics-scraper-workload"
+    assert service["spec"]["selector"] == {
+        "app.kubernetes.io/name": "dashboard-metrics-scraper"
+    }
+    assert service["spec"]["sessionAffinity"] == "ClientIP"
+    assert service["metadata"]["annotations"] == {
+        "seccomp.security.alpha.kubernetes.io/pod": "runtime/default"
+    }
+    app_data = harness.get_relation_data(rel_id, "dashboard-metrics-scraper")
+    assert app_data["service-name"] == "dashboard-metrics-scraper-workload"
+
+    # an arg change only restarts the service, the resources are unchanged
+    k8s_client.reset_mock()
+    harness.update_config(key_values={"metric-resolution": "30s"})
+    plan = harness.get_container_pebble_plan("metrics-scraper")
+    assert "--metric-resolution=30s" in plan.services["metrics-scraper"].command.split()
+    k8s_client.apply.assert_not_called()
+    assert harness.charm.reconciler.state.specs_applied == 0
+
+    # a restarted container gets the layer back
+    container = harness.charm.unit.get_container("metrics-scraper")
+    monkeypatch.setattr(
+        container, "add_layer", mock.Mock(wraps=container.add_layer)
+    )
+    harness.charm.on.metrics_scraper_pebble_ready.emit(container)
+    container.add_layer.assert_called_once()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+
+    harness.update_config(
+        key_values={
+            "cpu-request": "100m",
+            "autoscaling-max-replicas": 5,
+            "autoscaling-target-cpu": 60,
+        }
+    )
+    # the resource requests are patched into the workload container Juju runs
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    autoscaler, patch = [call[0][0] for call in k8s_client.apply.call_args_list[-2:]]
+    assert autoscaler["spec"]["scaleTargetRef"]["kind"] == "StatefulSet"
+    assert patch["spec"]["template"]["spec"]["containers"] == [
+        {"name": "metrics-scraper", "resources": {"requests": {"cpu": "100m"}}},
+    ]
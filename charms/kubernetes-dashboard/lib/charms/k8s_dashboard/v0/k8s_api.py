@@ -0,0 +1,275 @@
+"""Minimal in-cluster Kubernetes API client for the Kubernetes Dashboard charms.
+
+Pod spec v3 only carries a fixed set of Kubernetes resources. Objects it can't
+express, such as PodDisruptionBudgets, or which must change without setting a
+new pod spec, such as rotated TLS secrets, are applied by the leader directly
+through the API server, with server-side apply, using the service account of
+the operator pod.
+
+The HTTP and TLS modules are only imported when a request is sent: most hooks
+have nothing to apply, and every hook is a fresh process paying for imports.
+
+This library is owned by the k8s-dashboard charm; the dashboard-metrics-scraper
+charm carries a copy of it, which must be kept identical.
+"""
+
+import datetime
+import json
+import urllib.parse
+from pathlib import Path
+
+from ops.model import BlockedStatus
+
+from charms.k8s_dashboard.v0.pod_spec import spec_hash
+
+# The unique Charmhub library identifier, never change it
+LIBID = "fbbda6b6ff46489dab02e49f38d534fc"
+
+# Increment this major API version when introducing breaking changes
+LIBAPI = 0
+
+# Increment this PATCH version before using `charmcraft publish-lib` or reset
+# to 0 if you are raising the major API version
+LIBPATCH = 10
+
+API_SERVER = 'https://kubernetes.default.svc'
+SERVICE_ACCOUNT_DIR = Path('/var/run/secrets/kubernetes.io/serviceaccount')
+
+# Plural resource names of the namespaced kinds the charms manage.
+RESOURCES = {
+    'ConfigMap': 'configmaps',
+    'Deployment': 'deployments',
+    'HorizontalPodAutoscaler': 'horizontalpodautoscalers',
+    'Ingress': 'ingresses',
+    'PodDisruptionBudget': 'poddisruptionbudgets',
+    'PodMonitor': 'podmonitors',
+    'Role': 'roles',
+    'RoleBinding': 'rolebindings',
+    'Secret': 'secrets',
+    'Service': 'services',
+    'StatefulSet': 'statefulsets',
+}
+
+# Plural resource names of the cluster-wide kinds the charms manage.
+CLUSTER_RESOURCES = {
+    'ClusterRole': 'clusterroles',
+    'ClusterRoleBinding': 'clusterrolebindings',
+}
+
+# API versions of the kinds the charms apply whole objects of, rather than
+# patches, to list them.
+API_VERSIONS = {
+    'ClusterRole': 'rbac.authorization.k8s.io/v1',
+    'ClusterRoleBinding': 'rbac.authorization.k8s.io/v1',
+    'ConfigMap': 'v1',
+    'HorizontalPodAutoscaler': 'autoscaling/v2',
+    'Ingress': 'networking.k8s.io/v1',
+    'PodDisruptionBudget': 'policy/v1',
+    'PodMonitor': 'monitoring.coreos.com/v1',
+    'Role': 'rbac.authorization.k8s.io/v1',
+    'RoleBinding': 'rbac.authorization.k8s.io/v1',
+    'Secret': 'v1',
+    'Service': 'v1',
+}
+
+
+class APIError(Exception):
+    """Raised when a request to the Kubernetes API fails."""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+    @property
+    def status(self):
+        if self.code == 403:
+            # The operator pod's service account only gets the permissions
+            # once the application is trusted.
+            return BlockedStatus('Kubernetes API access denied, run juju trust')
+        return BlockedStatus('Kubernetes API error: {}'.format(self))
+
+
+class Client:
+    """Kubernetes API client authenticated as the operator pod."""
+
+    def __init__(self, namespace, field_manager, timeout=30):
+        self.namespace = namespace
+        self.field_manager = field_manager
+        self.timeout = timeout
+
+    def apply(self, manifest, field_manager=None):
+        """Create or update an object with server-side apply.
+
+        The API server releases the fields a field manager applied before and
+        left out of its new apply, so separate patches of the same object
+        must use separate field managers.
+
+        Args:
+            manifest (Dict[str, Any]): the object, with apiVersion, kind and
+                metadata.name set.
+            field_manager (Optional[str]): the field manager, the one of the
+                client by default.
+        """
+        query = urllib.parse.urlencode({
+            'fieldManager': field_manager or self.field_manager,
+            'force': 'true',
+        })
+        path = self._path(manifest['apiVersion'], manifest['kind'],
+                          manifest['metadata']['name'])
+        self._request('PATCH', '{}?{}'.format(path, query), manifest,
+                      content_type='application/apply-patch+yaml')
+
+    def create(self, manifest):
+        """Create an object, unless one of the same name exists.
+
+        Args:
+            manifest (Dict[str, Any]): the object, with apiVersion, kind and
+                metadata.name set.
+
+        Returns:
+            bool: whether the object was created.
+        """
+        query = urllib.parse.urlencode({'fieldManager': self.field_manager})
+        path = self._collection_path(manifest['apiVersion'], manifest['kind'])
+        try:
+            self._request('POST', '{}?{}'.format(path, query), manifest)
+        except APIError as e:
+            if e.code != 409:
+                raise
+            return False
+        return True
+
+    def get(self, api_version, kind, name):
+        """Get an object.
+
+        Returns:
+            Optional[Dict[str, Any]]: the object, or None if it doesn't exist.
+        """
+        try:
+            return self._request('GET', self._path(api_version, kind, name))
+        except APIError as e:
+            if e.code != 404:
+                raise
+            return None
+
+    def list(self, api_version, kind, label_selector):
+        """List the objects of a kind matching a label selector.
+
+        Namespaced kinds are only listed in the namespace of the client.
+
+        Returns:
+            List[Dict[str, Any]]: the objects.
+        """
+        query = urllib.parse.urlencode({'labelSelector': label_selector})
+        path = self._collection_path(api_version, kind)
+        return self._request('GET', '{}?{}'.format(path, query))['items']
+
+    def delete(self, api_version, kind, name):
+        """Delete an object, if it exists."""
+        try:
+            self._request('DELETE', self._path(api_version, kind, name))
+        except APIError as e:
+            if e.code != 404:
+                raise
+
+    def _path(self, api_version, kind, name):
+        return '{}/{}'.format(self._collection_path(api_version, kind), name)
+
+    def _collection_path(self, api_version, kind):
+        prefix = '/api/v1' if api_version == 'v1' else '/apis/' + api_version
+        if kind in CLUSTER_RESOURCES:
+            return '{}/{}'.format(prefix, CLUSTER_RESOURCES[kind])
+        return '{}/namespaces/{}/{}'.format(prefix, self.namespace, RESOURCES[kind])
+
+    def _request(self, method, path, body=None, content_type='application/json'):
+        import ssl
+        import urllib.error
+        import urllib.request
+
+        try:
+            token = (SERVICE_ACCOUNT_DIR / 'token').read_text()
+            context = ssl.create_default_context(
+                cafile=str(SERVICE_ACCOUNT_DIR / 'ca.crt'))
+        except OSError as e:
+            raise APIError('no service account credentials ({})'.format(e)) from e
+
+        request = urllib.request.Request(
+            API_SERVER + path,
+            method=method,
+            data=None if body is None else json.dumps(body).encode('utf8'),
+            headers={
+                'Authorization': 'Bearer {}'.format(token.strip()),
+                'Accept': 'application/json',
+                'Content-Type': content_type,
+            })
+        try:
+            with urllib.request.urlopen(request, context=context,
+                                        timeout=self.timeout) as response:
+                return json.loads(response.read() or b'null')
+        except urllib.error.HTTPError as e:
+            raise APIError('{} {} failed: {} {}'.format(
+                method, path.split('?')[0], e.code, e.reason), e.code) from e
+        except (OSError, ValueError) as e:
+            raise APIError('{} {} failed: {}'.format(
+                method, path.split('?')[0], e)) from e
+
+
+def resource_key(manifest):
+    """Identify an object by its apiVersion, kind and name."""
+    return '/'.join((manifest['apiVersion'], manifest['kind'],
+                     manifest['metadata']['name']))
+
+
+def reconcile(client, applied, manifests):
+    """Apply the objects which changed and delete the ones no longer wanted.
+
+    Args:
+        client (Client): the API client.
+        applied (MutableMapping[str, str]): resource key to spec hash of the
+            objects applied so far, updated in place. This is usually a dict
+            in the charm's stored state, so that unchanged objects don't cost
+            an API request on every hook.
+        manifests (Iterable[Dict[str, Any]]): the objects which should exist.
+
+    Raises:
+        APIError: if a request fails. Objects handled before the failure are
+            recorded in ``applied``.
+    """
+    wanted = set()
+    for manifest in manifests:
+        key = resource_key(manifest)
+        wanted.add(key)
+        manifest_hash = spec_hash(manifest)
+        if applied.get(key) != manifest_hash:
+            client.apply(manifest)
+            applied[key] = manifest_hash
+
+    for key in [key for key in applied if key not in wanted]:
+        client.delete(*key.rsplit('/', 2))
+        del applied[key]
+
+
+def rollout_restart(client, name):
+    """Replace the pods of a Deployment one by one, like kubectl rollout restart.
+
+    Only the restartedAt annotation of the pod template is applied, the rest
+    of the Deployment is left to Juju. It is applied by its own field manager,
+    so that it doesn't release the fields of the workload patch, nor the
+    other way round.
+
+    Args:
+        client (Client): the API client.
+        name (str): the Deployment.
+
+    Raises:
+        APIError: if the request fails.
+    """
+    restarted_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    client.apply({
+        'apiVersion': 'apps/v1',
+        'kind': 'Deployment',
+        'metadata': {'name': name},
+        'spec': {'template': {'metadata': {'annotations': {
+            'kubectl.kubernetes.io/restartedAt': restarted_at,
+        }}}},
+    }, field_manager='{}-restart'.format(client.field_manager))
@@ -0,0 +1,859 @@
+"""Pod spec building blocks shared by the Kubernetes Dashboard charms.
+
+The k8s-dashboard and dashboard-metrics-scraper charms render pod specs with
+the same service account rules, security context, tmp volume and probes.
+Those fragments are built once, at import time, so that each charm only has
+to assemble the parts of its spec which depend on config or relations.
+
+This library is owned by the k8s-dashboard charm; the dashboard-metrics-scraper
+charm carries a copy of it, which must be kept identical.
+
+The fragments are shared by reference between specs and must never be
+modified in place.
+
+In sidecar mode the workload runs under Pebble instead, and the Kubernetes
+resources of the pod spec are converted to manifests applied through the API.
+
+Importing the library must stay cheap, as non-leader units import it on every
+hook without using it: patterns are compiled on first use, through the cache
+of the re module, and hashlib is only imported to hash a spec.
+"""
+
+import json
+import re
+
+from ops.model import BlockedStatus
+import yaml
+
+# The unique Charmhub library identifier, never change it
+LIBID = "8e3a52bea4084622af2f591b4b3ece41"
+
+# Increment this major API version when introducing breaking changes
+LIBAPI = 0
+
+# Increment this PATCH version before using `charmcraft publish-lib` or reset
+# to 0 if you are raising the major API version
+LIBPATCH = 16
+
+# Config options holding container resource quantities, and where in the
+# container resources they are rendered. Juju takes no resources in a pod
+# spec, they are patched into the workload, see workload_placement.
+RESOURCE_OPTIONS = (
+    ('cpu-request', 'requests', 'cpu'),
+    ('cpu-limit', 'limits', 'cpu'),
+    ('memory-request', 'requests', 'memory'),
+    ('memory-limit', 'limits', 'memory'),
+)
+
+_QUANTITY_PATTERN = (
+    r'^(?P<number>[0-9]+(\.[0-9]*)?|\.[0-9]+)(?P<suffix>[numkMGTPE]|[KMGTPE]i)?$')
+# Config options holding probe timings, which must be positive.
+PROBE_OPTIONS = (
+    'probe-period',
+    'probe-timeout',
+    'probe-failure-threshold',
+    'startup-probe-failure-threshold',
+)
+
+PULL_POLICIES = ('Always', 'IfNotPresent', 'Never')
+
+# Config options holding autoscaling utilization targets, the resource they
+# apply to and the request option the utilization is relative to.
+AUTOSCALING_TARGETS = (
+    ('autoscaling-target-cpu', 'cpu', 'cpu-request'),
+    ('autoscaling-target-memory', 'memory', 'memory-request'),
+)
+
+# Custom resource the Prometheus operator discovers scrape targets from.
+POD_MONITOR_CRD = 'podmonitors.monitoring.coreos.com'
+
+_DNS_SUBDOMAIN_PATTERN = r'^[a-z0-9]([-a-z0-9.]{0,251}[a-z0-9])?$'
+_TOLERATION_FIELDS = {'key', 'operator', 'value', 'effect', 'tolerationSeconds'}
+_TOLERATION_OPERATORS = ('Equal', 'Exists')
+_TOLERATION_EFFECTS = ('NoSchedule', 'PreferNoSchedule', 'NoExecute')
+_DIGEST_PATTERN = r'@sha256:[0-9a-f]{64}$'
+_INT_OR_PERCENT_PATTERN = r'^[0-9]+%?$'
+_QUANTITY_SUFFIXES = {
+    'n': 10 ** -9, 'u': 10 ** -6, 'm': 10 ** -3, '': 1,
+    'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9,
+    'T': 10 ** 12, 'P': 10 ** 15, 'E': 10 ** 18,
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30,
+    'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+}
+
+
+class ConfigError(Exception):
+    """Raised when a config option holds a value which can't be rendered."""
+
+    @property
+    def status(self):
+        return BlockedStatus(str(self))
+
+
+SERVICE = {
+    'updateStrategy': {
+        'type': 'RollingUpdate',
+        'rollingUpdate': {'maxUnavailable': 1},
+    },
+}
+
+SECURITY_CONTEXT = {
+    'allowPrivilegeEscalation': False,
+    'readOnlyRootFilesystem': True,
+    'runAsUser': 1001,
+    'runAsGroup': 2001,
+}
+
+# Fields of placement() which the pod section of a Juju pod spec takes.
+POD_SPEC_PLACEMENT = ('priorityClassName',)
+
+# Label Juju puts on the pods of an application, by charm mode.
+APP_LABEL = 'juju-app'
+SIDECAR_APP_LABEL = 'app.kubernetes.io/name'
+
+# Label carried by every metrics scraper pod, whichever application it belongs
+# to, and the name of its container port, so that a single service can fan
+# out to the pods of several scraper applications.
+METRICS_SCRAPER_LABEL = 'k8s-dashboard.juju.is/metrics-scraper'
+METRICS_SCRAPER_PORT = 'scraper'
+
+TMP_VOLUME = {
+    'name': 'tmp-volume',
+    'mountPath': '/tmp',
+    'emptyDir': {
+        'medium': 'Memory',
+    },
+}
+
+SERVICE_ACCOUNT = {
+    'roles': [
+        {
+            'rules': [
+                {
+                    'apiGroups': [''],
+                    'resources': ['secrets'],
+                    'resourceNames': [
+                        'kubernetes-dashboard-key-holder',
+                        'kubernetes-dashboard-certs',
+                        'kubernetes-dashboard-csrf',
+                    ],
+                    'verbs': ['get', 'update', 'delete'],
+                },
+                {
+                    'apiGroups': [''],
+                    'resources': ['configmaps'],
+                    'resourceNames': [
+                        'kubernetes-dashboard-settings'],
+                    'verbs': ['get', 'update'],
+                },
+                {
+                    'apiGroups': [''],
+                    'resources': ['services'],
+                    'resourceNames': [
+                        'heapster',
+                        'dashboard-metrics-scraper',
+                    ],
+                    'verbs': ['proxy'],
+                },
+                {
+                    'apiGroups': [''],
+                    'resources': ['services/proxy'],
+                    'resourceNames': [
+                        'heapster',
+                        'http:heapster',
+                        'https:heapster',
+                        'dashboard-metrics-scraper',
+                        'http:dashboard-metrics-scraper',
+                    ],
+                    'verbs': ['get'],
+                },
+                {
+                    'apiGroups': ['metrics.k8s.io'],
+                    'resources': ['pods', 'nodes'],
+                    'verbs': ['get', 'list', 'watch'],
+                },
+            ],
+        },
+        {
+            'global': True,
+            'rules': [
+                {
+                    'apiGroups': ['metrics.k8s.io'],
+                    'resources': ['pods', 'nodes'],
+                    'verbs': ['get', 'list', 'watch'],
+                },
+            ],
+        },
+    ],
+}
+
+
+def probes(scheme, port, config):
+    """Generate the startup, liveness and readiness probes of a container.
+
+    The startup probe allows startup-probe-failure-threshold periods for the
+    container to come up, and holds off the other probes until it has, so
+    they need no initial delay.
+
+    Args:
+        scheme (str): HTTP or HTTPS.
+        port (int): the container port to probe.
+        config (Mapping[str, Any]): charm config holding the PROBE_OPTIONS.
+
+    Returns:
+        Dict[str, Any]: the probes, to be merged into the container's
+        kubernetes section.
+
+    Raises:
+        ConfigError: if a timing is not positive.
+    """
+    for option in PROBE_OPTIONS:
+        if config[option] < 1:
+            raise ConfigError('{} must be at least 1'.format(option))
+
+    def probe(failure_threshold):
+        return {
+            'httpGet': {
+                'scheme': scheme,
+                'path': '/',
+                'port': port,
+            },
+            'periodSeconds': config['probe-period'],
+            'timeoutSeconds': config['probe-timeout'],
+            'failureThreshold': failure_threshold,
+        }
+
+    return {
+        'startupProbe': probe(config['startup-probe-failure-threshold']),
+        'livenessProbe': probe(config['probe-failure-threshold']),
+        'readinessProbe': probe(config['probe-failure-threshold']),
+    }
+
+
+def container_port(name, port):
+    """Generate a TCP container port.
+
+    Returns:
+        Dict[str, Any]: the port.
+    """
+    return {
+        'name': name,
+        'containerPort': port,
+        'protocol': 'TCP',
+    }
+
+
+def image_pull_policy(image_path, policy, default=None):
+    """Pick the pull policy of a container image.
+
+    An image pinned by digest never changes, so unless a policy is set it is
+    only pulled when missing from the node, and pods restart from the cache.
+
+    Args:
+        image_path (str): the image, as fetched from the OCI image resource.
+        policy (str): the image-pull-policy config option, empty to pick one.
+        default (Optional[str]): policy of images not pinned by digest, None
+            for the Kubernetes default.
+
+    Returns:
+        Optional[str]: the policy, None for the Kubernetes default.
+
+    Raises:
+        ConfigError: if the policy is invalid.
+    """
+    if policy:
+        if policy not in PULL_POLICIES:
+            raise ConfigError('Invalid image-pull-policy: {!r}'.format(policy))
+        return policy
+    if re.search(_DIGEST_PATTERN, image_path):
+        return 'IfNotPresent'
+    return default
+
+
+def int_or_percent(option, value):
+    """Parse a value which is either a count or a percentage, such as 1 or 25%.
+
+    Args:
+        option (str): name of the config option, used in the error message.
+        value (str): the count or percentage.
+
+    Returns:
+        Union[int, str]: the count as an int, or the percentage as is.
+
+    Raises:
+        ConfigError: if the value is neither.
+    """
+    value = value.strip()
+    if not re.match(_INT_OR_PERCENT_PATTERN, value):
+        raise ConfigError('Invalid {}: {!r}'.format(option, value))
+    return value if value.endswith('%') else int(value)
+
+
+def service(max_surge='', max_unavailable='1'):
+    """Generate the service section of the pod spec.
+
+    Args:
+        max_surge (str): pods created above the desired count during a
+            rolling update, as a count or percentage. Empty for the
+            Kubernetes default.
+        max_unavailable (str): pods which may be unavailable during a rolling
+            update, as a count or percentage.
+
+    Returns:
+        Dict[str, Any]: the service section.
+
+    Raises:
+        ConfigError: if either value is invalid, or both are zero.
+    """
+    if not max_surge and max_unavailable == '1':
+        return SERVICE
+
+    rolling_update = {
+        'maxUnavailable': int_or_percent('max-unavailable', max_unavailable),
+    }
+    if max_surge:
+        rolling_update['maxSurge'] = int_or_percent('max-surge', max_surge)
+    if rolling_update['maxUnavailable'] in (0, '0%') and \
+            rolling_update.get('maxSurge') in (0, '0%'):
+        raise ConfigError('max-surge and max-unavailable cannot both be 0')
+    return {
+        'updateStrategy': {
+            'type': 'RollingUpdate',
+            'rollingUpdate': rolling_update,
+        },
+    }
+
+
+def parse_quantity(option, value):
+    """Parse a Kubernetes resource quantity such as 250m or 512Mi.
+
+    Args:
+        option (str): name of the config option, used in the error message.
+        value (str): the quantity.
+
+    Returns:
+        float: the quantity in base units.
+
+    Raises:
+        ConfigError: if the value is not a valid quantity.
+    """
+    match = re.match(_QUANTITY_PATTERN, value)
+    if not match:
+        raise ConfigError('Invalid {}: {!r}'.format(option, value))
+    suffix = match.group('suffix') or ''
+    return float(match.group('number')) * _QUANTITY_SUFFIXES[suffix]
+
+
+def container_resources(config):
+    """Generate the container resource requests and limits from config.
+
+    Args:
+        config (Mapping[str, Any]): charm config holding the RESOURCE_OPTIONS.
+
+    Returns:
+        Dict[str, Any]: the resources, empty if none are set.
+
+    Raises:
+        ConfigError: if a value is not a valid quantity or a request exceeds
+            its limit.
+    """
+    resources = {}
+    for option, kind, resource in RESOURCE_OPTIONS:
+        value = config[option]
+        if value:
+            parse_quantity(option, value)
+            resources.setdefault(kind, {})[resource] = value
+
+    for resource in ('cpu', 'memory'):
+        request = resources.get('requests', {}).get(resource)
+        limit = resources.get('limits', {}).get(resource)
+        if request and limit and (
+                parse_quantity('', request) > parse_quantity('', limit)):
+            raise ConfigError('{0}-request exceeds {0}-limit'.format(resource))
+    return resources
+
+
+def tmp_volume(size_limit):
+    """Generate the Memory-backed tmp volume.
+
+    Args:
+        size_limit (str): quantity the volume is limited to, or empty for no
+            limit.
+
+    Returns:
+        Dict[str, Any]: the volume config.
+
+    Raises:
+        ConfigError: if the size limit is not a valid quantity.
+    """
+    if not size_limit:
+        return TMP_VOLUME
+    parse_quantity('tmp-volume-size-limit', size_limit)
+    return dict(TMP_VOLUME, emptyDir={'medium': 'Memory', 'sizeLimit': size_limit})
+
+
+def anti_affinity(app_name, mode, app_label=APP_LABEL):
+    """Generate the pod affinity spreading the units of an app over nodes.
+
+    Args:
+        app_name (str): the application, whose pods carry the app_label.
+        mode (str): 'preferred' to spread the pods where possible, 'required'
+            to never run two of them on the same node, or 'none'.
+        app_label (str): APP_LABEL, or SIDECAR_APP_LABEL in sidecar mode.
+
+    Returns:
+        Optional[Dict[str, Any]]: the affinity, None for 'none'.
+
+    Raises:
+        ConfigError: if the mode is invalid.
+    """
+    if mode == 'none':
+        return None
+    term = {
+        'labelSelector': {'matchLabels': {app_label: app_name}},
+        'topologyKey': 'kubernetes.io/hostname',
+    }
+    if mode == 'preferred':
+        rules = {'preferredDuringSchedulingIgnoredDuringExecution': [
+            {'weight': 100, 'podAffinityTerm': term}]}
+    elif mode == 'required':
+        rules = {'requiredDuringSchedulingIgnoredDuringExecution': [term]}
+    else:
+        raise ConfigError('Invalid anti-affinity: {!r}'.format(mode))
+    return {'podAntiAffinity': rules}
+
+
+def _load_yaml(option, value):
+    try:
+        return yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise ConfigError('{} is not valid YAML'.format(option)) from e
+
+
+def _toleration(toleration):
+    error = ConfigError('Invalid toleration: {!r}'.format(toleration))
+    if not isinstance(toleration, dict) or not toleration or \
+            not set(toleration) <= _TOLERATION_FIELDS:
+        raise error
+    operator = toleration.get('operator', 'Equal')
+    if operator not in _TOLERATION_OPERATORS or \
+            operator == 'Exists' and 'value' in toleration:
+        raise error
+    if toleration.get('effect', 'NoSchedule') not in _TOLERATION_EFFECTS:
+        raise error
+    if 'tolerationSeconds' in toleration:
+        seconds = toleration['tolerationSeconds']
+        # Only NoExecute taints evict pods, after the given time.
+        if toleration.get('effect') != 'NoExecute' or \
+                type(seconds) is not int:
+            raise error
+    return {field: value if field == 'tolerationSeconds' else str(value)
+            for field, value in toleration.items()}
+
+
+def placement(app_name, config, app_label=APP_LABEL):
+    """Generate the scheduling constraints of a pod from config.
+
+    Args:
+        app_name (str): the application, for its anti-affinity.
+        config (Mapping[str, Any]): charm config holding the node-selector,
+            tolerations, anti-affinity and priority-class-name options.
+        app_label (str): APP_LABEL, or SIDECAR_APP_LABEL in sidecar mode.
+
+    Returns:
+        Dict[str, Any]: the constraints which are set. Only the
+        POD_SPEC_PLACEMENT ones can be merged into kubernetesResources.pod,
+        the others are applied with workload_placement.
+
+    Raises:
+        ConfigError: if an option is invalid.
+    """
+    pod = {}
+    if config['node-selector']:
+        node_selector = _load_yaml('node-selector', config['node-selector'])
+        if not isinstance(node_selector, dict) or not all(
+                isinstance(value, (str, int, float, bool))
+                for value in node_selector.values()):
+            raise ConfigError('node-selector must be a mapping of labels to values')
+        pod['nodeSelector'] = {
+            str(label): ('true' if value else 'false') if isinstance(value, bool)
+            else str(value)
+            for label, value in node_selector.items()}
+
+    if config['tolerations']:
+        tolerations = _load_yaml('tolerations', config['tolerations'])
+        if not isinstance(tolerations, list):
+            raise ConfigError('tolerations must be a list')
+        pod['tolerations'] = [_toleration(toleration) for toleration in tolerations]
+
+    affinity = anti_affinity(app_name, config['anti-affinity'], app_label)
+    if affinity:
+        pod['affinity'] = affinity
+
+    priority_class = config['priority-class-name']
+    if priority_class:
+        if not re.match(_DNS_SUBDOMAIN_PATTERN, priority_class):
+            raise ConfigError(
+                'Invalid priority-class-name: {!r}'.format(priority_class))
+        pod['priorityClassName'] = priority_class
+    return pod
+
+
+def workload_placement(app_name, kind, placement, container=None, resources=None):
+    """Generate the patch applying scheduling constraints to a workload.
+
+    The pod section of a Juju pod spec is a fixed subset of the Kubernetes
+    one, and Juju expresses node and pod affinity through constraints, which
+    a charm can't set. The constraints it lacks are patched, with server-side
+    apply, into the workload Juju runs the pods in instead. So are the
+    container resources, which a pod spec can't hold either. Applying the
+    patch without a field releases it.
+
+    Args:
+        app_name (str): the application, which names the workload.
+        kind (str): kind of the workload Juju runs the pods in, Deployment or
+            StatefulSet.
+        placement (Dict[str, Any]): the constraints to apply, from placement().
+        container (Optional[str]): name of the workload container.
+        resources (Optional[Dict[str, Any]]): the resources of the container,
+            from container_resources().
+
+    Returns:
+        Dict[str, Any]: the patch, to be applied through the API.
+    """
+    template_spec = dict(placement)
+    if resources:
+        # Containers are merged by name, the rest of it is left to Juju.
+        template_spec['containers'] = [{'name': container, 'resources': resources}]
+    return {
+        'apiVersion': 'apps/v1',
+        'kind': kind,
+        'metadata': {'name': app_name},
+        'spec': {'template': {'spec': template_spec}},
+    }
+
+
+def autoscaler(app_name, kind, config):
+    """Generate the HorizontalPodAutoscaler of an app from config.
+
+    Utilization is relative to the resource requests, so a target can only be
+    set along with the request of its resource.
+
+    Args:
+        app_name (str): the application, which names the scaled workload.
+        kind (str): kind of the workload Juju runs the pods in, Deployment or
+            StatefulSet.
+        config (Mapping[str, Any]): charm config holding the autoscaling-*
+            options and the resource requests.
+
+    Returns:
+        Optional[Dict[str, Any]]: the autoscaler, to be applied through the
+        API, or None unless autoscaling-max-replicas is set.
+
+    Raises:
+        ConfigError: if an option is invalid, no target is set, or a target
+            is set without its resource request.
+    """
+    max_replicas = config['autoscaling-max-replicas']
+    if max_replicas < 0:
+        raise ConfigError('autoscaling-max-replicas must not be negative')
+    if not max_replicas:
+        return None
+    min_replicas = config['autoscaling-min-replicas']
+    if min_replicas < 1:
+        raise ConfigError('autoscaling-min-replicas must be at least 1')
+    if max_replicas < min_replicas:
+        raise ConfigError(
+            'autoscaling-max-replicas is lower than autoscaling-min-replicas')
+
+    metrics = []
+    for option, resource, request in AUTOSCALING_TARGETS:
+        target = config[option]
+        if target < 0:
+            raise ConfigError('{} must not be negative'.format(option))
+        if not target:
+            continue
+        if not config[request]:
+            raise ConfigError('{} requires {}'.format(option, request))
+        metrics.append({
+            'type': 'Resource',
+            'resource': {
+                'name': resource,
+                'target': {'type': 'Utilization', 'averageUtilization': target},
+            },
+        })
+    if not metrics:
+        raise ConfigError('autoscaling requires a cpu or memory target')
+
+    return {
+        'apiVersion': 'autoscaling/v2',
+        'kind': 'HorizontalPodAutoscaler',
+        'metadata': {
+            'name': app_name,
+            'labels': {'juju-app': app_name},
+        },
+        'spec': {
+            'scaleTargetRef': {
+                'apiVersion': 'apps/v1',
+                'kind': kind,
+                'name': app_name,
+            },
+            'minReplicas': min_replicas,
+            'maxReplicas': max_replicas,
+            'metrics': metrics,
+        },
+    }
+
+
+def _metrics_options(config):
+    path = config['metrics-path']
+    if not path.startswith('/'):
+        raise ConfigError('Invalid metrics-path: {!r}'.format(path))
+    interval = config['metrics-scrape-interval']
+    if interval < 0:
+        raise ConfigError('metrics-scrape-interval must not be negative')
+    return path, '{}s'.format(interval) if interval else None
+
+
+def scrape_annotations(port, scheme, config):
+    """Generate the prometheus.io annotations of a pod from config.
+
+    Args:
+        port (int): the container port serving the metrics.
+        scheme (str): http or https.
+        config (Mapping[str, Any]): charm config holding the
+            metrics-annotations and metrics-* options.
+
+    Returns:
+        Dict[str, str]: the annotations, empty unless metrics-annotations is
+        set.
+
+    Raises:
+        ConfigError: if an option is invalid.
+    """
+    path, _ = _metrics_options(config)
+    if not config['metrics-annotations']:
+        return {}
+    return {
+        'prometheus.io/scrape': 'true',
+        'prometheus.io/port': str(port),
+        'prometheus.io/path': path,
+        'prometheus.io/scheme': scheme,
+    }
+
+
+def pod_monitor(app_name, port_name, scheme, config, app_label=APP_LABEL):
+    """Generate the PodMonitor scraping the pods of an app from config.
+
+    A PodMonitor selects the pods by their application label and the port
+    by its container port name, so it doesn't depend on how Juju names the
+    ports of the application service.
+
+    Args:
+        app_name (str): the application, whose pods carry the app_label.
+        port_name (str): name of the container port serving the metrics.
+        scheme (str): http or https. The certificates of https endpoints
+            are not verified, as they are usually self-signed.
+        config (Mapping[str, Any]): charm config holding the pod-monitor and
+            metrics-* options.
+        app_label (str): APP_LABEL, or SIDECAR_APP_LABEL in sidecar mode.
+
+    Returns:
+        Optional[Dict[str, Any]]: the PodMonitor, to be listed under
+        POD_MONITOR_CRD in kubernetesResources.customResources, or None
+        unless pod-monitor is set.
+
+    Raises:
+        ConfigError: if an option is invalid.
+    """
+    path, interval = _metrics_options(config)
+    if not config['pod-monitor']:
+        return None
+    endpoint = {'port': port_name, 'path': path, 'scheme': scheme}
+    if interval:
+        endpoint['interval'] = interval
+    if scheme == 'https':
+        endpoint['tlsConfig'] = {'insecureSkipVerify': True}
+    return {
+        'apiVersion': 'monitoring.coreos.com/v1',
+        'kind': 'PodMonitor',
+        'metadata': {
+            'name': app_name,
+            'labels': {'juju-app': app_name},
+        },
+        'spec': {
+            'selector': {'matchLabels': {app_label: app_name}},
+            'podMetricsEndpoints': [endpoint],
+        },
+    }
+
+
+def scrape_job(job_name, target, scheme, config):
+    """Generate the scrape job advertised to a Prometheus-style consumer.
+
+    Args:
+        job_name (str): name of the job, usually the application.
+        target (str): host:port serving the metrics.
+        scheme (str): http or https, whose certificates are not verified.
+        config (Mapping[str, Any]): charm config holding the metrics-*
+            options.
+
+    Returns:
+        Dict[str, Any]: the job, in the Prometheus scrape_config format.
+
+    Raises:
+        ConfigError: if an option is invalid.
+    """
+    path, interval = _metrics_options(config)
+    job = {
+        'job_name': job_name,
+        'metrics_path': path,
+        'scheme': scheme,
+        'static_configs': [{'targets': [target]}],
+    }
+    if interval:
+        job['scrape_interval'] = interval
+    if scheme == 'https':
+        job['tls_config'] = {'insecure_skip_verify': True}
+    return job
+
+
+def pebble_layer(service, command):
+    """Generate the Pebble layer running a workload in sidecar mode.
+
+    The layer replaces the service, so that replanning after a change of
+    command restarts the process in place instead of replacing the pod.
+
+    Args:
+        service (str): name of the Pebble service.
+        command (List[str]): the workload executable and its arguments.
+
+    Returns:
+        Dict[str, Any]: the layer.
+    """
+    import shlex
+
+    return {
+        'summary': '{} layer'.format(service),
+        'services': {
+            service: {
+                'override': 'replace',
+                'summary': service,
+                'command': ' '.join(shlex.quote(arg) for arg in command),
+                'startup': 'enabled',
+            },
+        },
+    }
+
+
+def _manifest(api_version, kind, name, app_name, **fields):
+    manifest = {
+        'apiVersion': api_version,
+        'kind': kind,
+        'metadata': {'name': name, 'labels': {APP_LABEL: app_name}},
+    }
+    manifest.update(fields)
+    return manifest
+
+
+def api_manifests(app_name, spec):
+    """Convert the Kubernetes resources of a pod spec to API manifests.
+
+    In sidecar mode Juju runs the pods, but sets no pod spec, so the config
+    maps, secrets, services, ingresses and custom resources it would have
+    created are applied through the API instead. The pod section, which
+    sidecar mode has no equivalent for, is left out.
+
+    Args:
+        app_name (str): the application, which labels the objects.
+        spec (Dict[str, Any]): the pod spec.
+
+    Returns:
+        List[Dict[str, Any]]: the manifests.
+    """
+    resources = spec.get('kubernetesResources', {})
+    manifests = []
+    for name, data in sorted(spec.get('configMaps', {}).items()):
+        manifests.append(_manifest('v1', 'ConfigMap', name, app_name, data=data))
+    for secret in resources.get('secrets', []):
+        manifests.append(_manifest('v1', 'Secret', secret['name'], app_name,
+                                   type=secret['type'],
+                                   data=secret.get('data', {})))
+    for service in resources.get('services', []):
+        manifest = _manifest('v1', 'Service', service['name'], app_name,
+                             spec=service['spec'])
+        if service.get('annotations'):
+            manifest['metadata']['annotations'] = service['annotations']
+        manifests.append(manifest)
+
+    for ingress in resources.get('ingressResources', []):
+        ingress_spec = dict(ingress['spec'], rules=[
+            {'host': rule['host'], 'http': {'paths': [{
+                'path': path['path'],
+                'pathType': 'ImplementationSpecific',
+                'backend': {'service': {
+                    'name': path['backend']['serviceName'],
+                    'port': {'number': path['backend']['servicePort']},
+                }},
+            } for path in rule['http']['paths']]}}
+            for rule in ingress['spec']['rules']])
+        manifest = _manifest('networking.k8s.io/v1', 'Ingress', ingress['name'],
+                             app_name, spec=ingress_spec)
+        if ingress.get('annotations'):
+            manifest['metadata']['annotations'] = ingress['annotations']
+        manifests.append(manifest)
+
+    for _, objects in sorted(resources.get('customResources', {}).items()):
+        manifests.extend(objects)
+    return manifests
+
+
+def rbac_manifests(app_name, namespace, service_account=SERVICE_ACCOUNT):
+    """Convert the roles of a pod spec service account to RBAC manifests.
+
+    In sidecar mode the workload runs as the service account Juju creates
+    for the application, named after it, which is granted the roles.
+
+    Args:
+        app_name (str): the application.
+        namespace (str): the namespace of the model.
+        service_account (Dict[str, Any]): the pod spec service account.
+
+    Returns:
+        List[Dict[str, Any]]: the roles and their bindings.
+    """
+    subjects = [{
+        'kind': 'ServiceAccount',
+        'name': app_name,
+        'namespace': namespace,
+    }]
+    manifests = []
+    for role in service_account['roles']:
+        if role.get('global'):
+            # Cluster objects are shared by the models, tell them apart.
+            kind, name = 'ClusterRole', '{}-{}'.format(namespace, app_name)
+        else:
+            kind, name = 'Role', app_name
+        manifests.append(_manifest('rbac.authorization.k8s.io/v1', kind, name,
+                                   app_name, rules=role['rules']))
+        manifests.append(_manifest(
+            'rbac.authorization.k8s.io/v1', kind + 'Binding', name, app_name,
+            roleRef={
+                'apiGroup': 'rbac.authorization.k8s.io',
+                'kind': kind,
+                'name': name,
+            },
+            subjects=subjects))
+    return manifests
+
+
+def spec_hash(spec):
+    """Hash the canonical serialized form of a pod spec.
+
+    Returns:
+        str: hex digest which only changes when the content of the spec does.
+    """
+    import hashlib
+
+    serialized = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf8')).hexdigest()
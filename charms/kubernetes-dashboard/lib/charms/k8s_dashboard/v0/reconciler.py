@@ -0,0 +1,296 @@
+"""Reconciliation of the desired state of the Kubernetes Dashboard charms.
+
+The leader of either charm derives its desired state from its config and
+relations: a pod spec, objects applied through the Kubernetes API, and a patch
+of the workload Juju runs the pods in, for what a pod spec can't hold. A
+Reconciler applies them, skipping whatever is unchanged since it last did, as
+setting a pod spec replaces the pods and each API request is a round-trip.
+
+Objects the workload changes itself, such as the settings of the dashboard,
+are seeded instead: created once, and applied again only when the charm's
+version of them changes.
+
+Everything applied or seeded is labelled with the application and model, so
+that a new leader finds what the previous one applied, and so that it is all
+deleted when the application is removed.
+
+Juju replaces the workload once a hook which set a new pod spec ends, dropping
+what was patched into it, so the patch is then applied by the
+workload-patch-pending event, deferred to a later hook.
+
+This library is owned by the k8s-dashboard charm; the dashboard-metrics-scraper
+charm carries a copy of it, which must be kept identical.
+"""
+
+import json
+import logging
+
+from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
+from ops.model import MaintenanceStatus
+
+from charms.k8s_dashboard.v0 import k8s_api
+from charms.k8s_dashboard.v0.pod_spec import APP_LABEL, spec_hash
+
+# The unique Charmhub library identifier, never change it
+LIBID = "d38fd2d9d3ef438088b7a44c56fd2c71"
+
+# Increment this major API version when introducing breaking changes
+LIBAPI = 0
+
+# Increment this PATCH version before using `charmcraft publish-lib` or reset
+# to 0 if you are raising the major API version
+LIBPATCH = 3
+
+logger = logging.getLogger(__name__)
+
+# Labels the objects a Reconciler applied with their model, along with the
+# application label, as cluster-wide objects are shared by all models.
+MODEL_LABEL = 'k8s-dashboard.juju.is/model'
+# Labels the objects it seeded, which a new leader doesn't prune.
+SEEDED_LABEL = 'k8s-dashboard.juju.is/seeded'
+
+
+class WorkloadPatchPendingEvent(EventBase):
+    """The workload patch is to be applied once Juju replaced the workload."""
+
+
+class ReconcilerEvents(ObjectEvents):
+    workload_patch_pending = EventSource(WorkloadPatchPendingEvent)
+
+
+class Reconciler(Object):
+    """Apply the desired state of a charm, skipping what is unchanged.
+
+    What was applied is kept track of in the stored state of the leader. A
+    new leader must call forget_applied, as another unit may have applied
+    something else since. When the application is removed, or scaled to
+    zero, the leader deletes all of it.
+    """
+
+    on = ReconcilerEvents()
+    state = StoredState()
+
+    def __init__(self, charm, key='reconciler'):
+        super().__init__(charm, key)
+        # Whether a pod spec was set in this hook.
+        self.spec_set = False
+        self.framework.observe(self.on.workload_patch_pending,
+                               self._on_workload_patch_pending)
+        self.framework.observe(charm.on.remove, self._on_remove)
+        if self.model.unit.is_leader():
+            # Non-leader hooks are spared loading the state.
+            self.state.set_default(spec_hash=None, specs_applied=0, specs_skipped=0,
+                                   k8s_resources={}, patch_hash=None,
+                                   pending_patch=None, seeded={}, prune=False)
+
+    @property
+    def client(self):
+        return k8s_api.Client(self.model.name, field_manager=self.model.app.name)
+
+    def stats(self):
+        """Count the pod specs set and skipped, for the reconcile-stats action.
+
+        Returns:
+            Dict[str, int]: the counts, by action result key.
+        """
+        self.state.set_default(specs_applied=0, specs_skipped=0)
+        return {
+            'specs-applied': self.state.specs_applied,
+            'specs-skipped': self.state.specs_skipped,
+        }
+
+    def forget_applied(self):
+        """Forget what this unit applied when it last was the leader.
+
+        Another unit may have set the pod spec, and applied objects, since.
+        Comparing against the hashes this unit kept would then skip setting
+        a spec which looks unchanged to it, so everything is applied again.
+        The objects are kept track of, and the next apply lists those the
+        other units applied, so that unwanted ones are still deleted.
+        """
+        self.state.spec_hash = None
+        for key in list(self.state.k8s_resources):
+            self.state.k8s_resources[key] = None
+        # Seeded objects are only created if missing, what the workload
+        # changed in them since is kept.
+        for key in list(self.state.seeded):
+            self.state.seeded[key] = None
+        self.state.prune = True
+        # Unknown rather than None, so that an empty patch is still applied
+        # to release what the other unit patched in.
+        self.state.patch_hash = ''
+
+    def set_pod_spec(self, spec):
+        """Set the pod spec, unless it matches the last one that was set.
+
+        Re-setting an identical spec still makes Juju roll the pods, so the
+        hash of the spec is kept in the stored state and compared before
+        calling set_spec.
+
+        Returns:
+            bool: whether the spec was applied.
+        """
+        new_hash = spec_hash(spec)
+        if new_hash == self.state.spec_hash:
+            self.state.specs_skipped += 1
+            logger.debug('Pod spec unchanged, skipping (applied: %d, skipped: %d)',
+                         self.state.specs_applied, self.state.specs_skipped)
+            return False
+
+        self.model.unit.status = MaintenanceStatus('Setting pod spec')
+        self.model.pod.set_spec(spec)
+        self.spec_set = True
+        self.state.spec_hash = new_hash
+        self.state.specs_applied += 1
+        logger.info('Pod spec set (applied: %d, skipped: %d)',
+                    self.state.specs_applied, self.state.specs_skipped)
+        return True
+
+    def apply(self, manifests, patch):
+        """Apply the objects and the workload patch which changed.
+
+        Objects no longer wanted are deleted. Call it after set_pod_spec, if
+        the pod spec is set in the same hook.
+
+        Args:
+            manifests (List[Dict[str, Any]]): the objects which should exist.
+            patch (Dict[str, Any]): the workload patch, see
+                pod_spec.workload_placement.
+
+        Returns:
+            List[str]: resource keys of the objects which were updated, rather
+            than created or applied again by a new leader.
+
+        Raises:
+            APIError: if a request fails.
+        """
+        client = self.client
+        if self.state.prune:
+            for key in self._list_applied(client, seeded=False):
+                self.state.k8s_resources.setdefault(key, None)
+            self.state.prune = False
+        previous = dict(self.state.k8s_resources)
+        k8s_api.reconcile(client, self.state.k8s_resources,
+                          [self._labelled(manifest) for manifest in manifests])
+        self._apply_patch(client, patch)
+        return [key for key, old in previous.items()
+                if old and self.state.k8s_resources.get(key) not in (None, old)]
+
+    def seed(self, manifest):
+        """Create an object once, and apply it again only when it changes.
+
+        Unlike the objects passed to apply, changes made to a seeded object
+        by others, such as the workload, are kept until the charm's version
+        of it changes. Seeded objects are never deleted.
+
+        Args:
+            manifest (Dict[str, Any]): the object.
+
+        Raises:
+            APIError: if a request fails.
+        """
+        manifest = self._labelled(manifest, seeded=True)
+        key = k8s_api.resource_key(manifest)
+        manifest_hash = spec_hash(manifest)
+        seeded_hash = self.state.seeded.get(key)
+        if seeded_hash == manifest_hash:
+            return
+        if seeded_hash is None:
+            # Unknown to this unit, the object may have been changed since
+            # another one seeded it.
+            self.client.create(manifest)
+        else:
+            self.client.apply(manifest)
+        self.state.seeded[key] = manifest_hash
+
+    def remove_applied(self):
+        """Delete everything the application applied or seeded.
+
+        Whichever unit applied them, the objects are found by their labels.
+
+        Raises:
+            APIError: if a request fails.
+        """
+        client = self.client
+        for key in self._list_applied(client, seeded=True):
+            client.delete(*key.rsplit('/', 2))
+
+    def _labelled(self, manifest, seeded=False):
+        # The manifests may share fragments, they are copied rather than
+        # labelled in place.
+        metadata = manifest['metadata']
+        labels = dict(metadata.get('labels', {}), **{
+            APP_LABEL: self.model.app.name,
+            MODEL_LABEL: self.model.name,
+        })
+        if seeded:
+            labels[SEEDED_LABEL] = 'true'
+        return dict(manifest, metadata=dict(metadata, labels=labels))
+
+    def _list_applied(self, client, seeded):
+        selector = '{}={},{}={}'.format(APP_LABEL, self.model.app.name,
+                                        MODEL_LABEL, self.model.name)
+        if not seeded:
+            selector += ',!{}'.format(SEEDED_LABEL)
+        keys = []
+        for kind, api_version in sorted(k8s_api.API_VERSIONS.items()):
+            try:
+                objects = client.list(api_version, kind, selector)
+            except k8s_api.APIError as e:
+                if e.code not in (403, 404):
+                    raise
+                # Kinds without their CRD installed, or which the application
+                # isn't trusted with, can't have been applied either.
+                continue
+            keys += ['/'.join((api_version, kind, obj['metadata']['name']))
+                     for obj in objects]
+        return keys
+
+    def _apply_patch(self, client, patch):
+        fields = patch['spec']['template']['spec']
+        if self.spec_set:
+            self.state.patch_hash = None
+            self.state.pending_patch = None
+            if fields:
+                self.state.pending_patch = json.dumps(patch, sort_keys=True)
+                self.on.workload_patch_pending.emit()
+            return
+        self.state.pending_patch = None
+        patch_hash = spec_hash(patch)
+        if patch_hash == self.state.patch_hash:
+            return
+        if not fields and self.state.patch_hash is None:
+            # Nothing was patched in, so there is nothing to release either.
+            return
+        client.apply(patch)
+        self.state.patch_hash = patch_hash
+
+    def _on_remove(self, event):
+        if not self.model.unit.is_leader() or self.model.app.planned_units():
+            # Units removed on scale-down leave it all to the remaining ones.
+            return
+        try:
+            self.remove_applied()
+        except k8s_api.APIError as e:
+            logger.error('Failed to delete Kubernetes resources: %s', e)
+
+    def _on_workload_patch_pending(self, event):
+        if not self.model.unit.is_leader():
+            # The new leader patches the workload again.
+            return
+        if self.spec_set:
+            # Juju only replaces the workload once this hook ends.
+            event.defer()
+            return
+        if not self.state.pending_patch:
+            # Superseded by a later reconcile.
+            return
+        patch = json.loads(self.state.pending_patch)
+        try:
+            self.client.apply(patch)
+        except k8s_api.APIError as e:
+            logger.error('Failed to patch the workload: %s', e)
+            event.defer()
+            return
+        self.state.patch_hash = spec_hash(patch)
+        self.state.pending_patch = None
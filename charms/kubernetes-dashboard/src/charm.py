@@ -1,15 +1,97 @@
 #!/usr/bin/env python3
 
+import base64
+import json
 import logging
+import re
+import subprocess
+import tempfile
+from pathlib import Path
 
-from ops.charm import CharmBase
+from ops.charm import (CharmBase, LeaderElectedEvent, PebbleReadyEvent,
+                       RelationBrokenEvent)
 from ops.main import main
-from ops.model import ActiveStatus, MaintenanceStatus, WaitingStatus
+from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
 from ops.framework import StoredState
 
-from k8s_service import RequireK8sService
-from oci_image import OCIImageResource, OCIImageResourceError
+from charms.k8s_dashboard.v0 import k8s_api, pod_spec, reconciler, timing
 from urllib.parse import urlparse
+import yaml
+
+
+CERTS_VOLUME = {
+    'name': 'kubernetes-dashboard-certs',
+    'mountPath': '/certs',
+    'secret': {
+        'name': 'kubernetes-dashboard-certs',
+    },
+}
+
+# Secret holding a certificate from config or the certificates relation. It is
+# applied through the API rather than the pod spec, so that a rotated
+# certificate doesn't need a new pod spec.
+TLS_SECRET = 'kubernetes-dashboard-tls'
+
+TLS_VOLUME = {
+    'name': TLS_SECRET,
+    'mountPath': '/certs',
+    'secret': {
+        'name': TLS_SECRET,
+    },
+}
+
+SECRETS = [
+    {
+        'name': 'kubernetes-dashboard-certs',
+        'type': 'Opaque',
+    },
+    {
+        'name': 'kubernetes-dashboard-csrf',
+        'type': 'Opaque',
+        'data': {'csrf': ''},
+    },
+    {
+        'name': 'kubernetes-dashboard-key-holder',
+        'type': 'Opaque',
+    },
+]
+
+SETTINGS_CONFIG_MAP = 'kubernetes-dashboard-settings'
+
+# Global settings of the dashboard which are not exposed as config options,
+# at their dashboard defaults: the dashboard doesn't fill in missing ones.
+DEFAULT_SETTINGS = {
+    'labelsLimit': 3,
+    'disableAccessDeniedNotifications': False,
+    'defaultNamespace': 'default',
+    'namespaceFallbackList': ['default'],
+}
+
+BANNER_SEVERITIES = ('INFO', 'WARNING', 'ERROR')
+
+NGINX_ANNOTATION = 'nginx.ingress.kubernetes.io/{}'
+
+# Workload container and Pebble service in sidecar mode, see metadata.yaml.
+WORKLOAD_CONTAINER = 'dashboard'
+DASHBOARD_COMMAND = '/dashboard'
+CERTS_DIR = '/certs'
+
+# Self-signed certificate request of scale-out mode, see generate_certificate.
+OPENSSL_CONFIG = (
+    '[req]\n'
+    'prompt = no\n'
+    'distinguished_name = dn\n'
+    'x509_extensions = san\n'
+    '[dn]\n'
+    'CN = {common_name}\n'
+    '[san]\n'
+    'subjectAltName = {alt_names}\n'
+)
+
+GZIP_SNIPPET = (
+    'gzip on;\n'
+    'gzip_types application/json application/javascript text/css text/plain;\n'
+)
 
 
 class K8sDashboardCharm(CharmBase):
@@ -17,247 +99,799 @@ class K8sDashboardCharm(CharmBase):
 
     def __init__(self, *args):
         super().__init__(*args)
+        self.hook_timings = timing.HookTimings(self)
+        self.reconciler = reconciler.Reconciler(self)
+        self.framework.observe(self.on.reconcile_stats_action,
+                               self.on_reconcile_stats_action)
         if not self.unit.is_leader():
             # We can't do anything useful when not the leader, so do nothing.
-            self.model.unit.status = WaitingStatus('Waiting for leadership')
+            # The status is only written once, not on every hook, as each
+            # write is a request to the controller.
+            self.state.set_default(waiting_for_leadership=False)
+            if not self.state.waiting_for_leadership:
+                self.model.unit.status = WaitingStatus('Waiting for leadership')
+                self.state.waiting_for_leadership = True
             return
+        # Only the leader uses these, non-leader hooks are spared importing them.
+        from k8s_service import RequireK8sService
+        from oci_image import OCIImageResource
+
         self.log = logging.getLogger(__name__)
+        self.state.set_default(tls_cert=None, tls_key=None, image_details=None,
+                               dirty=True, inputs_hash=None, events_coalesced=0,
+                               workload_files_hash=None)
         self.dashboard_image = OCIImageResource(self, 'k8s-dashboard-image')
         self.metrics_scraper = RequireK8sService(self, "metrics-scraper")
+        # config-changed always follows install and upgrade-charm, so these
+        # only mark the state dirty and leave the reconcile to it.
         for event in [self.on.install,
-                      self.on.leader_elected,
-                      self.on.upgrade_charm,
+                      self.on.upgrade_charm]:
+            self.framework.observe(event, self.on_install_or_upgrade)
+        for event in [self.on.leader_elected,
                       self.on.config_changed,
+                      self.on.metrics_endpoint_relation_created,
+                      self.on.certificates_relation_joined,
+                      self.on.certificates_relation_changed,
+                      self.on.certificates_relation_broken,
                       self.metrics_scraper.on.k8s_services_changed]:
             self.framework.observe(event, self.main)
+        if self._sidecar:
+            self.framework.observe(self.on[WORKLOAD_CONTAINER].pebble_ready, self.main)
+
+    def on_install_or_upgrade(self, event):
+        # A new revision of the image resource triggers upgrade-charm.
+        self.state.image_details = None
+        self.state.dirty = True
+        self.state.events_coalesced += 1
 
     def main(self, event):
+        # Statuses set from now on replace the non-leader one.
+        self.state.waiting_for_leadership = False
+        self.timer = timing.HookTimer(self.model.config['hook-timings'])
+        try:
+            self._main(event)
+        finally:
+            self.hook_timings.record(event, self.timer)
+
+    def on_reconcile_stats_action(self, event):
+        self.state.set_default(events_coalesced=0)
+        event.set_results(dict(self.reconciler.stats(), **{
+            'events-coalesced': self.state.events_coalesced,
+        }))
+
+    def _main(self, event):
+        from oci_image import OCIImageResourceError
+
+        # Bursts of events, e.g. on deploy or while the metrics-scraper
+        # relation flaps, mostly carry inputs which were already reconciled.
+        # A new leader always reconciles, as another unit may have set the
+        # pod spec since this one last did.
+        relations = self._read_relations()
+        inputs_hash = pod_spec.spec_hash(self._desired_inputs(relations))
+        self.timer.lap('relation-read')
+        if isinstance(event, LeaderElectedEvent):
+            self.reconciler.forget_applied()
+            # Read the shared certificate back, as another unit may have
+            # generated it since.
+            self.state.tls_cert = self.state.tls_key = None
+            # Only the leader observes upgrade-charm, this unit may have
+            # missed a new revision of the image while it wasn't the leader.
+            self.state.image_details = None
+            self.state.dirty = True
+        if isinstance(event, PebbleReadyEvent):
+            # The workload container was (re)started, without the layer or
+            # the certificate files pushed into the previous one.
+            self.state.workload_files_hash = None
+            self.state.dirty = True
+        if not self.state.dirty and inputs_hash == self.state.inputs_hash:
+            self.state.events_coalesced += 1
+            self.log.debug('Nothing changed since the last reconcile (coalesced: %d)',
+                           self.state.events_coalesced)
+            return
+        self.state.dirty = True
+        # The request only depends on the config and the certificates
+        # relations, both covered by the inputs hash.
+        self._request_certificate(event)
+
+        config = self.model.config
         try:
-            dashboard_image_details = self.dashboard_image.fetch()
-        except OCIImageResourceError as e:
+            dashboard_image_details = self._fetch_image_details()
+            self.timer.lap('image-fetch')
+            pull_policy = pod_spec.image_pull_policy(
+                dashboard_image_details['imagePath'],
+                config['image-pull-policy'], default='Always')
+            resources = pod_spec.container_resources(config)
+            tmp_volume = pod_spec.tmp_volume(config['tmp-volume-size-limit'])
+            probes = pod_spec.probes('HTTPS', 8443, config)
+            service = pod_spec.service(config['max-surge'], config['max-unavailable'])
+            placement = pod_spec.placement(self.app.name, config, self._app_label)
+            server_args = self._build_server_args()
+            settings_config_map = self._build_settings_config_map()
+            dashboard_service = self._build_dashboard_service()
+            disruption_budgets = self._build_disruption_budgets()
+            autoscalers = self._build_autoscalers()
+            ingress_resources = self._build_pod_ingress_resources()
+            supplied_certificate = self._supplied_certificate(
+                relations['certificate'])
+            scrape_annotations = pod_spec.scrape_annotations(8443, 'https', config)
+            pod_monitor = pod_spec.pod_monitor(self.app.name, 'dashboard', 'https',
+                                               config, app_label=self._app_label)
+            scrape_job = pod_spec.scrape_job(
+                self.app.name,
+                'kubernetes-dashboard.{}.svc:443'.format(self.model.name),
+                'https', config)
+        except (OCIImageResourceError, pod_spec.ConfigError) as e:
             self.model.unit.status = e.status
             return
+        self.timer.lap('config')
+
+        tls_secrets = []
+        certs_volume = CERTS_VOLUME
+        secrets = SECRETS
+        # Certificate files pushed to the workload container in sidecar mode.
+        workload_files = {}
+        if supplied_certificate:
+            if self._sidecar:
+                workload_files = dict(zip(('tls.crt', 'tls.key'), supplied_certificate))
+            else:
+                tls_secrets.append(self._build_tls_secret(*supplied_certificate))
+            certs_volume = TLS_VOLUME
+            cert_args = ['--tls-cert-file=tls.crt',
+                         '--tls-key-file=tls.key']
+        elif config['scale-out']:
+            try:
+                tls_cert, tls_key = self._shared_certificate()
+            except k8s_api.APIError as e:
+                self.log.error('Failed to read the dashboard certificate: %s', e)
+                self.model.unit.status = e.status
+                return
+            except FileNotFoundError as e:
+                self.log.error('Failed to generate the dashboard certificate: %s', e)
+                self.model.unit.status = BlockedStatus(
+                    'scale-out requires openssl in the charm container')
+                return
+            except (OSError, subprocess.CalledProcessError) as e:
+                self.log.error('Failed to generate the dashboard certificate: %s %s',
+                               e, getattr(e, 'stderr', None) or '')
+                self.model.unit.status = BlockedStatus(
+                    'openssl failed to generate the dashboard certificate, '
+                    'see juju debug-log')
+                return
+            cert_args = ['--tls-cert-file=dashboard.crt',
+                         '--tls-key-file=dashboard.key']
+            workload_files = {'dashboard.crt': tls_cert, 'dashboard.key': tls_key}
+            secrets = [dict(SECRETS[0], data={
+                'dashboard.crt': base64.b64encode(tls_cert.encode()).decode(),
+                'dashboard.key': base64.b64encode(tls_key.encode()).decode(),
+            })] + SECRETS[1:]
+        else:
+            cert_args = ['--auto-generate-certificates']
+        self.timer.lap('certificates')
 
-        if not self.metrics_scraper.is_created:
+        services = [dashboard_service]
+        metrics_scraper = relations['metrics-scraper']
+        if not metrics_scraper['created']:
             metrics_scraper_args = ["--metrics-provider=none"]
         else:
-            if not self.metrics_scraper.is_available:
+            if not metrics_scraper['available']:
                 self.model.unit.status = WaitingStatus("Waiting for Metrics Scraper")
                 return
-            ms_service_name, ms_service_port = self.metrics_scraper.services[0]
+            ms_services = metrics_scraper['services']
+            if len(ms_services) == 1:
+                ms_service_name, ms_service_port = ms_services[0]
+            elif self._sidecar:
+                # The fan-out service selects the scraper pods by a label
+                # set in the pod spec, which sidecar scrapers have none of.
+                self.model.unit.status = BlockedStatus(
+                    'Relate a single metrics scraper in sidecar mode')
+                return
+            else:
+                # Several scraper apps are related, spread the requests over
+                # all their pods. Only ready pods are endpoints of the service,
+                # so a failing scraper doesn't take the metrics down.
+                ms_service = self._build_metrics_scraper_service()
+                services.append(ms_service)
+                ms_service_name = ms_service['name']
+                ms_service_port = ms_service['spec']['ports'][0]['port']
             metrics_scraper_args = ["--metrics-provider=sidecar",
                                     "--sidecar-host=http://{}:{}".format(
                                         ms_service_name,
                                         ms_service_port)]
 
-        self.model.unit.status = MaintenanceStatus('Setting pod spec')
-        ingress_resources = self._build_pod_ingress_resources()
+        kubernetes = dict(probes, securityContext=pod_spec.SECURITY_CONTEXT)
 
-        self.model.pod.set_spec({
+        spec = {
             'version': 3,
-            'service': {
-                'updateStrategy': {
-                    'type': 'RollingUpdate',
-                    'rollingUpdate': {'maxUnavailable': 1},
-                },
-            },
-            'configMaps': {
-                'kubernetes-dashboard-settings': {},
-            },
+            'service': service,
             'containers': [
                 {
-                    'name': "{}-charm".format(self.model.app.name),
+                    'name': self._container_name,
                     'imageDetails': dashboard_image_details,
-                    'imagePullPolicy': 'Always',
-                    'ports': [
-                        {
-                            'name': 'dashboard',
-                            'containerPort': 8443,
-                            'protocol': 'TCP',
-                        },
-                    ],
-                    'args': [
-                        '--auto-generate-certificates',
+                    'imagePullPolicy': pull_policy,
+                    'ports': [pod_spec.container_port('dashboard', 8443)],
+                    'args': cert_args + [
                         "--namespace={}".format(self.model.name),
                         "--authentication-mode={}".format(
                             self.model.config['authentication-mode']),
-                    ] + metrics_scraper_args,
-                    'volumeConfig': [
-                        {
-                            'name': 'kubernetes-dashboard-certs',
-                            'mountPath': '/certs',
-                            'secret': {
-                                'name': 'kubernetes-dashboard-certs',
-                            },
-                        },
-                        {
-                            'name': 'tmp-volume',
-                            'mountPath': '/tmp',
-                            'emptyDir': {
-                                'medium': 'Memory',
-                            },
-                        },
-                    ],
-                    'kubernetes': {
-                        'securityContext': {
-                            'allowPrivilegeEscalation': False,
-                            'readOnlyRootFilesystem': True,
-                            'runAsUser': 1001,
-                            'runAsGroup': 2001,
-                        },
-                        'livenessProbe': {
-                            'httpGet': {
-                                'scheme': 'HTTPS',
-                                'path': '/',
-                                'port': 8443,
-                            },
-                            'initialDelaySeconds': 30,
-                            'timeoutSeconds': 30,
-                        },
-                    },
+                    ] + server_args + metrics_scraper_args,
+                    'volumeConfig': [certs_volume, tmp_volume],
+                    'kubernetes': kubernetes,
                 },
             ],
-            'serviceAccount': {
-                'roles': [
-                    {
-                        'rules': [
-                            {
-                                'apiGroups': [''],
-                                'resources': ['secrets'],
-                                'resourceNames': [
-                                    'kubernetes-dashboard-key-holder',
-                                    'kubernetes-dashboard-certs',
-                                    'kubernetes-dashboard-csrf',
-                                ],
-                                'verbs': ['get', 'update', 'delete'],
-                            },
-                            {
-                                'apiGroups': [''],
-                                'resources': ['configmaps'],
-                                'resourceNames': [
-                                    'kubernetes-dashboard-settings'],
-                                'verbs': ['get', 'update'],
-                            },
-                            {
-                                'apiGroups': [''],
-                                'resources': ['services'],
-                                'resourceNames': [
-                                    'heapster',
-                                    'dashboard-metrics-scraper',
-                                ],
-                                'verbs': ['proxy'],
-                            },
-                            {
-                                'apiGroups': [''],
-                                'resources': ['services/proxy'],
-                                'resourceNames': [
-                                    'heapster',
-                                    'http:heapster',
-                                    'https:heapster',
-                                    'dashboard-metrics-scraper',
-                                    'http:dashboard-metrics-scraper',
-                                ],
-                                'verbs': ['get'],
-                            },
-                            {
-                                'apiGroups': ['metrics.k8s.io'],
-                                'resources': ['pods', 'nodes'],
-                                'verbs': ['get', 'list', 'watch'],
-                            },
-                        ],
-                    },
-                    {
-                        'global': True,
-                        'rules': [
-                            {
-                                'apiGroups': ['metrics.k8s.io'],
-                                'resources': ['pods', 'nodes'],
-                                'verbs': ['get', 'list', 'watch'],
-                            },
-                        ],
-                    },
-                ],
-            },
+            'serviceAccount': pod_spec.SERVICE_ACCOUNT,
             'kubernetesResources': {
-                'secrets': [
-                    {
-                        'name': 'kubernetes-dashboard-certs',
-                        'type': 'Opaque',
-                    },
-                    {
-                        'name': 'kubernetes-dashboard-csrf',
-                        'type': 'Opaque',
-                        'data': {'csrf': ''},
-                    },
-                    {
-                        'name':  'kubernetes-dashboard-key-holder',
-                        'type': 'Opaque',
-                    },
-                ],
-                'services': [{
-                    'name': 'kubernetes-dashboard',
-                    'spec': {
-                        'selector': {
-                            'juju-app': self.model.app.name,
-                        },
-                        'ports': [{
-                            'protocol': 'TCP',
-                            'port': 443,
-                            'targetPort': 8443,
-                        }],
-                    },
-                }],
+                'secrets': secrets,
+                'services': services,
                 'ingressResources': ingress_resources or [],
             },
-        })
+        }
+        # In sidecar mode Juju runs the pods without a spec, all the placement
+        # is patched into the workload.
+        pod_placement = {} if self._sidecar else {
+            key: value for key, value in placement.items()
+            if key in pod_spec.POD_SPEC_PLACEMENT}
+        placement_patch = pod_spec.workload_placement(
+            self.app.name, self._workload_kind(),
+            {key: value for key, value in placement.items()
+             if key not in pod_placement},
+            container=self._container_name, resources=resources)
+        if pod_placement:
+            spec['kubernetesResources']['pod'] = pod_placement
+        if scrape_annotations:
+            spec['kubernetesResources']['pod'] = dict(
+                pod_placement, annotations=scrape_annotations)
+        if pod_monitor:
+            spec['kubernetesResources']['customResources'] = {
+                pod_spec.POD_MONITOR_CRD: [pod_monitor],
+            }
+        self.timer.lap('spec-build')
+        if self._sidecar:
+            # Juju runs the pods, the spec only describes the workload and
+            # the resources to apply through the API.
+            if not self._replan_workload(spec['containers'][0]['args'],
+                                         workload_files):
+                return
+            spec_applied = False
+            manifests = (pod_spec.api_manifests(self.app.name, spec)
+                         + pod_spec.rbac_manifests(self.app.name, self.model.name))
+        else:
+            spec_applied = self.reconciler.set_pod_spec(spec)
+            manifests = []
+        self.timer.lap('set-spec')
+        self._publish_scrape_job(scrape_job)
 
+        try:
+            updated = self.reconciler.apply(
+                manifests + disruption_budgets + autoscalers + tls_secrets,
+                placement_patch)
+            # Seeded rather than in the pod spec, which would replace the
+            # changes made from the settings page whenever it is set.
+            self.reconciler.seed(settings_config_map)
+            # The dashboard only loads its certificate when it starts. A new
+            # pod spec already replaces the pods, otherwise they are
+            # restarted to pick up a rotated one.
+            if not spec_applied and any(k8s_api.resource_key(secret) in updated
+                                        for secret in tls_secrets):
+                self.log.info('Certificate rotated, restarting the dashboard')
+                k8s_api.rollout_restart(self.reconciler.client, self.app.name)
+        except k8s_api.APIError as e:
+            self.log.error('Failed to apply Kubernetes resources: %s', e)
+            self.model.unit.status = e.status
+            return
+        finally:
+            self.timer.lap('k8s-api')
+
+        self.state.dirty = False
+        self.state.inputs_hash = inputs_hash
         self.model.unit.status = ActiveStatus()
 
+    def _read_relations(self):
+        """Snapshot the relation data the desired state is derived from.
+
+        The relations are read once per hook and only the snapshot is used
+        from then on, rather than walking the relation data again on each
+        metrics scraper property access.
+
+        Returns:
+            Dict[str, Any]: the snapshot.
+        """
+        created = self.metrics_scraper.is_created
+        available = created and self.metrics_scraper.is_available
+        return {
+            'metrics-scraper': {
+                'created': created,
+                'available': available,
+                'services': sorted(set(map(tuple, self.metrics_scraper.services)))
+                if available else [],
+            },
+            'metrics-endpoint': [relation.id for relation
+                                 in self.model.relations['metrics-endpoint']],
+            'certificates': [relation.id for relation
+                             in self.model.relations['certificates']],
+            'certificate': self._related_certificate(),
+        }
+
+    def _desired_inputs(self, relations):
+        """Gather everything the desired state is derived from.
+
+        The image details are left out: they can only change on upgrade-charm,
+        which marks the state dirty.
+
+        Args:
+            relations (Dict[str, Any]): the snapshot of the relations.
+
+        Returns:
+            Dict[str, Any]: the inputs.
+        """
+        return dict(relations, config=dict(self.model.config))
+
+    def _workload_kind(self):
+        """Get the kind of workload Juju runs the pods in."""
+        # Juju runs sidecar charms in a StatefulSet.
+        return 'StatefulSet' if self._sidecar else 'Deployment'
+
+    @property
+    def _sidecar(self):
+        """Whether the charm runs in sidecar mode.
+
+        Sidecar mode is chosen by declaring the workload container in
+        metadata.yaml, see the README.
+        """
+        return WORKLOAD_CONTAINER in self.meta.containers
+
+    @property
+    def _app_label(self):
+        return pod_spec.SIDECAR_APP_LABEL if self._sidecar else pod_spec.APP_LABEL
+
+    @property
+    def _container_name(self):
+        """Name of the dashboard container in the workload."""
+        if self._sidecar:
+            return WORKLOAD_CONTAINER
+        return '{}-charm'.format(self.app.name)
+
+    def _replan_workload(self, args, files):
+        """Run the dashboard with the given arguments under Pebble.
+
+        A changed command is applied by Pebble restarting the dashboard in
+        place, rather than Juju replacing the pod. The certificate files are
+        only pushed when they change, which restarts the dashboard too as it
+        only loads them when it starts.
+
+        Args:
+            args (List[str]): the dashboard arguments.
+            files (Dict[str, str]): content of the files to keep in the
+                certificates directory, by file name.
+
+        Returns:
+            bool: whether the dashboard is running the layer, False if Pebble
+            is not ready yet.
+        """
+        from ops.pebble import APIError, ConnectionError
+
+        container = self.unit.get_container(WORKLOAD_CONTAINER)
+        if not container.can_connect():
+            self.model.unit.status = WaitingStatus('Waiting for Pebble')
+            return False
+        layer = pod_spec.pebble_layer(WORKLOAD_CONTAINER, [DASHBOARD_COMMAND] + args)
+        files_hash = pod_spec.spec_hash(files)
+        try:
+            container.add_layer(WORKLOAD_CONTAINER, layer, combine=True)
+            if files_hash == self.state.workload_files_hash:
+                # Only restarts the dashboard if its command changed.
+                container.replan()
+                return True
+            container.make_dir(CERTS_DIR, make_parents=True)
+            for name, content in sorted(files.items()):
+                container.push('{}/{}'.format(CERTS_DIR, name), content,
+                               permissions=0o600)
+            container.restart(WORKLOAD_CONTAINER)
+        except (APIError, ConnectionError) as e:
+            self.log.error('Failed to start the dashboard: %s', e)
+            self.model.unit.status = WaitingStatus('Waiting for Pebble')
+            return False
+        self.state.workload_files_hash = files_hash
+        return True
+
+    def _shared_certificate(self):
+        """Get the certificate shared by all dashboard replicas.
+
+        The certificate is generated once and kept in the certs secret the
+        replicas mount. The leader reads it back from there, whichever unit
+        generated it, and caches it in its stored state.
+
+        Returns:
+            Tuple[str, str]: PEM encoded certificate and key.
+
+        Raises:
+            APIError: if the secret can't be read.
+            OSError, CalledProcessError: if the certificate can't be generated.
+        """
+        if not self.state.tls_cert:
+            secret = self.reconciler.client.get(
+                'v1', 'Secret', CERTS_VOLUME['secret']['name']) or {}
+            data = secret.get('data') or {}
+            if 'dashboard.crt' in data and 'dashboard.key' in data:
+                self.state.tls_cert, self.state.tls_key = (
+                    base64.b64decode(data[name]).decode()
+                    for name in ('dashboard.crt', 'dashboard.key'))
+            else:
+                self.state.tls_cert, self.state.tls_key = generate_certificate(
+                    self._certificate_hostnames()[:3])
+        return self.state.tls_cert, self.state.tls_key
+
+    def _certificate_hostnames(self):
+        """List the names the dashboard is reached by, for its certificate."""
+        service = 'kubernetes-dashboard'
+        hostnames = [
+            service,
+            '{}.{}'.format(service, self.model.name),
+            '{}.{}.svc'.format(service, self.model.name),
+        ]
+        try:
+            site_urls = parse_site_urls(self.model.config['site-url'])
+        except pod_spec.ConfigError:
+            # Reported when the spec is built.
+            site_urls = []
+        return list(dict.fromkeys(hostnames + [url.hostname for url in site_urls]))
+
+    def _request_certificate(self, event):
+        """Request a server certificate on the certificates relations.
+
+        The request is only written when it changes, as each write fires
+        relation-changed on the provider.
+        """
+        hostnames = self._certificate_hostnames()
+        request = {
+            'common_name': hostnames[0],
+            'sans': json.dumps(hostnames[1:]),
+            'certificate_name': TLS_SECRET,
+        }
+        for relation in self.model.relations['certificates']:
+            if isinstance(event, RelationBrokenEvent) and event.relation == relation:
+                continue
+            unit_data = relation.data[self.unit]
+            for key, value in request.items():
+                if unit_data.get(key) != value:
+                    unit_data[key] = value
+
+    def _related_certificate(self):
+        """Get the server certificate issued on the certificates relation.
+
+        Returns:
+            Optional[Tuple[str, str]]: PEM encoded certificate and key, None
+            until one is issued.
+        """
+        prefix = self.unit.name.replace('/', '_')
+        for relation in self.model.relations['certificates']:
+            for unit in relation.units:
+                data = relation.data[unit]
+                cert = data.get('{}.server.cert'.format(prefix))
+                key = data.get('{}.server.key'.format(prefix))
+                if cert and key:
+                    return cert, key
+        return None
+
+    def _supplied_certificate(self, related):
+        """Get the certificate set in config or issued on the relation.
+
+        Args:
+            related (Optional[Tuple[str, str]]): the certificate issued on the
+                certificates relation, if any.
+
+        Returns:
+            Optional[Tuple[str, str]]: PEM encoded certificate and key, None
+            if neither supplies one.
+
+        Raises:
+            ConfigError: if only one of tls-cert and tls-key is set, or either
+                isn't PEM encoded.
+        """
+        cert = self.model.config['tls-cert'].strip()
+        key = self.model.config['tls-key'].strip()
+        if not cert and not key:
+            return related
+        if not cert or not key:
+            raise pod_spec.ConfigError('tls-cert and tls-key must be set together')
+        if not cert.startswith('-----BEGIN') or not key.startswith('-----BEGIN'):
+            raise pod_spec.ConfigError('tls-cert and tls-key must be PEM encoded')
+        return cert + '\n', key + '\n'
+
+    def _build_tls_secret(self, cert, key):
+        """Generate the secret holding a supplied certificate.
+
+        Returns:
+            Dict[str, Any]: the secret, to be applied through the API.
+        """
+        return {
+            'apiVersion': 'v1',
+            'kind': 'Secret',
+            'metadata': {
+                'name': TLS_SECRET,
+                'labels': {'juju-app': self.app.name},
+            },
+            'type': 'kubernetes.io/tls',
+            'data': {
+                'tls.crt': base64.b64encode(cert.encode()).decode(),
+                'tls.key': base64.b64encode(key.encode()).decode(),
+            },
+        }
+
+    def _build_dashboard_service(self):
+        """Generate the kubernetes-dashboard service.
+
+        Returns:
+            Dict[str, Any]: the service resource.
+        """
+        spec = {
+            'selector': {
+                self._app_label: self.model.app.name,
+            },
+            'ports': [{
+                'protocol': 'TCP',
+                'port': 443,
+                'targetPort': 8443,
+            }],
+        }
+
+        session_affinity = self.model.config['session-affinity']
+        if session_affinity == 'ClientIP':
+            timeout = self.model.config['session-affinity-timeout']
+            if not 0 < timeout <= 86400:
+                raise pod_spec.ConfigError(
+                    'Invalid session-affinity-timeout: {}'.format(timeout))
+            spec['sessionAffinity'] = 'ClientIP'
+            spec['sessionAffinityConfig'] = {'clientIP': {'timeoutSeconds': timeout}}
+        elif session_affinity != 'None':
+            raise pod_spec.ConfigError(
+                'Invalid session-affinity: {!r}'.format(session_affinity))
+
+        return {'name': 'kubernetes-dashboard', 'spec': spec}
+
+    def _build_server_args(self):
+        """Generate the dashboard arguments tuning its server.
+
+        Returns:
+            List[str]: the arguments.
+
+        Raises:
+            ConfigError: if an option is invalid.
+        """
+        config = self.model.config
+        if config['token-ttl'] < 0:
+            raise pod_spec.ConfigError('token-ttl must not be negative')
+        args = ['--token-ttl={}'.format(config['token-ttl'])]
+        if config['enable-skip-login']:
+            args.append('--enable-skip-login')
+
+        for option in ('api-server-qps', 'api-server-burst'):
+            if config[option] < 0:
+                raise pod_spec.ConfigError('{} must not be negative'.format(option))
+            if config[option]:
+                args.append('--{}={}'.format(option, config[option]))
+        if 0 < config['api-server-burst'] < config['api-server-qps']:
+            raise pod_spec.ConfigError('api-server-burst is lower than api-server-qps')
+
+        banner = config['system-banner']
+        if banner:
+            severity = config['system-banner-severity']
+            if severity not in BANNER_SEVERITIES:
+                raise pod_spec.ConfigError(
+                    'Invalid system-banner-severity: {!r}'.format(severity))
+            args += ['--system-banner={}'.format(banner),
+                     '--system-banner-severity={}'.format(severity)]
+        return args
+
+    def _build_settings_config_map(self):
+        """Generate the config map seeding the global settings of the dashboard.
+
+        Returns:
+            Dict[str, Any]: the config map, to be seeded through the API.
+
+        Raises:
+            ConfigError: if an option is invalid.
+        """
+        config = self.model.config
+        if config['items-per-page'] < 1:
+            raise pod_spec.ConfigError('items-per-page must be at least 1')
+        for option in ('resource-auto-refresh-interval', 'logs-auto-refresh-interval'):
+            if config[option] < 0:
+                raise pod_spec.ConfigError('{} must not be negative'.format(option))
+
+        settings = dict(
+            DEFAULT_SETTINGS,
+            clusterName=config['cluster-name'],
+            itemsPerPage=config['items-per-page'],
+            resourceAutoRefreshTimeInterval=config['resource-auto-refresh-interval'],
+            logsAutoRefreshTimeInterval=config['logs-auto-refresh-interval'],
+        )
+        return {
+            'apiVersion': 'v1',
+            'kind': 'ConfigMap',
+            'metadata': {
+                'name': SETTINGS_CONFIG_MAP,
+                'labels': {'juju-app': self.app.name},
+            },
+            # Serialized the way the dashboard stores them.
+            'data': {'_global': json.dumps(settings, sort_keys=True)},
+        }
+
+    def _build_metrics_scraper_service(self):
+        """Generate the service fanning out to all the metrics scraper pods.
+
+        The scraper charm labels its pods and names its port the same way in
+        every application, whatever its config, so the service selects the
+        pods of all the scraper applications in the model. Each scraper pod
+        keeps its own metrics, so a dashboard pod sticks to one of them while
+        it is ready.
+
+        Returns:
+            Dict[str, Any]: the service resource.
+        """
+        return {
+            'name': '{}-metrics-scraper'.format(self.app.name),
+            'spec': {
+                'selector': {
+                    pod_spec.METRICS_SCRAPER_LABEL: 'true',
+                },
+                'ports': [{
+                    'protocol': 'TCP',
+                    'port': 8000,
+                    'targetPort': pod_spec.METRICS_SCRAPER_PORT,
+                }],
+                'sessionAffinity': 'ClientIP',
+            },
+        }
+
+    def _build_disruption_budgets(self):
+        """Generate the PodDisruptionBudget for scale-out mode.
+
+        Returns:
+            List[Dict[str, Any]]: the budgets, empty unless scale-out is
+            enabled and pdb-min-available is set.
+        """
+        min_available = self.model.config['pdb-min-available']
+        if not self.model.config['scale-out'] or not min_available:
+            return []
+
+        return [{
+            'apiVersion': 'policy/v1',
+            'kind': 'PodDisruptionBudget',
+            'metadata': {
+                'name': self.app.name,
+                'labels': {'juju-app': self.app.name},
+            },
+            'spec': {
+                'minAvailable': pod_spec.int_or_percent(
+                    'pdb-min-available', min_available),
+                'selector': {'matchLabels': {self._app_label: self.app.name}},
+            },
+        }]
+
+    def _build_autoscalers(self):
+        """Generate the HorizontalPodAutoscaler for scale-out mode.
+
+        Returns:
+            List[Dict[str, Any]]: the autoscalers, empty unless
+            autoscaling-max-replicas is set.
+
+        Raises:
+            ConfigError: if an option is invalid, or autoscaling is set
+                without scale-out.
+        """
+        autoscaler = pod_spec.autoscaler(self.app.name, self._workload_kind(),
+                                         self.model.config)
+        if not autoscaler:
+            return []
+        if not self.model.config['scale-out']:
+            raise pod_spec.ConfigError('autoscaling requires scale-out')
+        return [autoscaler]
+
+    def _fetch_image_details(self):
+        """Fetch the image details, reusing the ones from a previous hook.
+
+        Fetching the resource costs a round-trip to the controller. Attaching
+        a new revision of the resource triggers upgrade-charm, which is the
+        only time it can change after it was first fetched, and clears them.
+        A new leader clears them too, as it may have missed that hook.
+
+        Raises:
+            OCIImageResourceError: if the resource is missing or invalid.
+        """
+        if not self.state.image_details:
+            self.state.image_details = self.dashboard_image.fetch()
+        return dict(self.state.image_details)
+
+    def _publish_scrape_job(self, job):
+        """Advertise the metrics endpoint to the related Prometheus consumers.
+
+        Values are only written when they change, as each write fires
+        relation-changed on the consumer.
+        """
+        data = {
+            'scrape_jobs': json.dumps([job], sort_keys=True),
+            'scrape_metadata': json.dumps({
+                'model': self.model.name,
+                'application': self.app.name,
+                'charm_name': self.meta.name,
+            }, sort_keys=True),
+        }
+        for relation in self.model.relations['metrics-endpoint']:
+            app_data = relation.data[self.app]
+            for key, value in data.items():
+                if app_data.get(key) != value:
+                    app_data[key] = value
+
     def _build_pod_ingress_resources(self):
         """Generate pod ingress resources.
 
         Returns:
             List[Dict[str, Any]]: pod ingress resources.
+
+        Raises:
+            ConfigError: if an ingress tuning option is invalid.
         """
 
-        site_url = self.model.config['site-url']
-        if not site_url:
+        site_urls = parse_site_urls(self.model.config['site-url'])
+        if not site_urls:
             return
 
-        parsed = urlparse(site_url)
-
-        if not parsed.scheme.startswith('http'):
-            return
+        prefixes = {url.path.rstrip('/') for url in site_urls}
+        if len(prefixes) > 1:
+            raise pod_spec.ConfigError('site-url entries must all have the same path')
+        prefix = prefixes.pop()
 
         annotations = {
             'nginx.ingress.kubernetes.io/proxy-body-size': '{}m'.format(
-                self.model.config['max-file-size'])
+                self.model.config['max-file-size']),
+            # the dashboard only serves HTTPS
+            'nginx.ingress.kubernetes.io/backend-protocol': 'HTTPS',
             }
+        if prefix:
+            # The dashboard has no base-href option, but only uses relative
+            # URLs, so serve it under the prefix by stripping it at the ingress.
+            path = '{}(/|$)(.*)'.format(prefix)
+            annotations['nginx.ingress.kubernetes.io/use-regex'] = 'true'
+            annotations['nginx.ingress.kubernetes.io/rewrite-target'] = '/$2'
+            annotations['nginx.ingress.kubernetes.io/x-forwarded-prefix'] = prefix
+        else:
+            path = '/'
+
+        hostnames = list(dict.fromkeys(url.hostname for url in site_urls))
         ingress = {
             "name": "{}-ingress".format(self.app.name),
             "spec": {
                 "rules": [
                     {
-                        "host": parsed.hostname,
+                        "host": hostname,
                         "http": {
                             "paths": [{
-                                "path": "/",
+                                "path": path,
                                 "backend": {
-                                    "serviceName": self.app.name,
-                                    "servicePort": 8443
+                                    "serviceName": 'kubernetes-dashboard',
+                                    "servicePort": 443
                                 }
                             }],
                         },
-                    },
+                    }
+                    for hostname in hostnames
                 ],
             },
         }
-        if parsed.scheme == 'https':
-            ingress['spec']['tls'] = [{'hosts': [parsed.hostname]}]
-            tls_secret_name = self.model.config['tls-secret-name']
-            if tls_secret_name:
-                ingress['spec']['tls'][0]['secretName'] = tls_secret_name
-        else:
+
+        tls_hostnames = list(dict.fromkeys(
+            url.hostname for url in site_urls if url.scheme == 'https'))
+        if tls_hostnames:
+            tls_secret_names = self._parse_tls_secret_names()
+            ingress['spec']['tls'] = []
+            for hostname in tls_hostnames:
+                tls = {'hosts': [hostname]}
+                tls_secret_name = tls_secret_names.get(
+                    hostname, self.model.config['tls-secret-name'])
+                if tls_secret_name:
+                    tls['secretName'] = tls_secret_name
+                ingress['spec']['tls'].append(tls)
+        if len(tls_hostnames) < len(site_urls):
             annotations['nginx.ingress.kubernetes.io/ssl-redirect'] = 'false'
 
         whitelist_source_range = self.model.config['ingress-whitelist-source-range']
@@ -265,11 +899,158 @@ class K8sDashboardCharm(CharmBase):
             whitelist_annotation = 'nginx.ingress.kubernetes.io/whitelist-source-range'
             annotations[whitelist_annotation] = whitelist_source_range
 
+        annotations.update(self._build_ingress_tuning_annotations())
+
         if annotations:
             ingress['annotations'] = annotations
 
         return [ingress]
 
+    def _parse_tls_secret_names(self):
+        """Parse the ingress-tls-secret-names option.
+
+        Returns:
+            Dict[str, str]: TLS secret name by hostname.
+
+        Raises:
+            ConfigError: if the option is not a mapping of strings.
+        """
+        value = self.model.config['ingress-tls-secret-names']
+        if not value:
+            return {}
+        try:
+            secret_names = yaml.safe_load(value)
+        except yaml.YAMLError:
+            secret_names = None
+        if not isinstance(secret_names, dict) or not all(
+                isinstance(name, str) for name in secret_names.values()):
+            raise pod_spec.ConfigError(
+                'ingress-tls-secret-names must be a mapping of hostnames to secrets')
+        return secret_names
+
+    def _build_ingress_tuning_annotations(self):
+        """Generate the nginx-ingress tuning annotations from config.
+
+        Annotations from ingress-annotations come last, so they override the
+        ones generated from the other options.
+
+        Returns:
+            Dict[str, str]: the annotations.
+
+        Raises:
+            ConfigError: if an option is invalid.
+        """
+        config = self.model.config
+        annotations = {}
+
+        buffering = config['ingress-proxy-buffering']
+        if buffering:
+            if buffering not in ('on', 'off'):
+                raise pod_spec.ConfigError(
+                    'Invalid ingress-proxy-buffering: {!r}'.format(buffering))
+            annotations[NGINX_ANNOTATION.format('proxy-buffering')] = buffering
+
+        buffer_size = config['ingress-proxy-buffer-size']
+        if buffer_size:
+            if not re.match(r'^[0-9]+[km]?$', buffer_size):
+                raise pod_spec.ConfigError(
+                    'Invalid ingress-proxy-buffer-size: {!r}'.format(buffer_size))
+            annotations[NGINX_ANNOTATION.format('proxy-buffer-size')] = buffer_size
+
+        for option in ('ingress-proxy-read-timeout', 'ingress-proxy-send-timeout'):
+            timeout = config[option]
+            if timeout < 0:
+                raise pod_spec.ConfigError('{} must not be negative'.format(option))
+            if timeout:
+                name = option[len('ingress-'):]
+                annotations[NGINX_ANNOTATION.format(name)] = str(timeout)
+
+        if config['ingress-upstream-keepalive']:
+            annotations[NGINX_ANNOTATION.format('proxy-http-version')] = '1.1'
+            annotations[NGINX_ANNOTATION.format('connection-proxy-header')] = \
+                'keep-alive'
+
+        if config['ingress-gzip']:
+            annotations[NGINX_ANNOTATION.format('configuration-snippet')] = \
+                GZIP_SNIPPET
+
+        extra = config['ingress-annotations']
+        if extra:
+            try:
+                extra = yaml.safe_load(extra)
+            except yaml.YAMLError:
+                extra = None
+            if not isinstance(extra, dict) or not all(
+                    isinstance(value, (str, int, float, bool))
+                    for value in extra.values()):
+                raise pod_spec.ConfigError(
+                    'ingress-annotations must be a mapping of names to values')
+            for name, value in extra.items():
+                if isinstance(value, bool):
+                    value = 'true' if value else 'false'
+                annotations[str(name)] = str(value)
+
+        return annotations
+
+
+def parse_site_urls(site_url):
+    """Parse the URLs the dashboard is served on.
+
+    Args:
+        site_url (str): URLs separated by commas or whitespace, such as
+            "https://dashboard.example.com https://dashboard.example.org/k8s".
+
+    Returns:
+        List[urllib.parse.ParseResult]: the parsed URLs.
+
+    Raises:
+        ConfigError: if a URL isn't an http or https URL with a hostname.
+    """
+    site_urls = []
+    for url in re.split(r'[\s,]+', site_url.strip()):
+        if not url:
+            continue
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise pod_spec.ConfigError('Invalid site-url: {!r}'.format(url))
+        site_urls.append(parsed)
+    return site_urls
+
+
+def generate_certificate(hostnames):
+    """Generate a self-signed certificate with openssl.
+
+    The subject alternative names are set through a config file rather than
+    -addext, which openssl only has since 1.1.1.
+
+    Args:
+        hostnames (List[str]): names for the certificate, the first one is
+            used as its common name.
+
+    Returns:
+        Tuple[str, str]: PEM encoded certificate and key.
+
+    Raises:
+        OSError: if openssl can't be run, FileNotFoundError if it is missing.
+        CalledProcessError: if openssl fails.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = Path(tmp) / 'dashboard.crt', Path(tmp) / 'dashboard.key'
+        config = Path(tmp) / 'openssl.cnf'
+        config.write_text(OPENSSL_CONFIG.format(
+            common_name=hostnames[0],
+            alt_names=','.join('DNS:{}'.format(name) for name in hostnames)))
+        subprocess.run([
+            'openssl', 'req', '-x509', '-nodes',
+            '-newkey', 'rsa:2048',
+            '-days', '3650',
+            '-config', str(config),
+            '-keyout', str(key),
+            '-out', str(cert),
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        return cert.read_text(), key.read_text()
+
 
 if __name__ == "__main__":
     main(K8sDashboardCharm)
@@ -0,0 +1,151 @@
+"""Hook cost benchmarks, run offline against the ops testing Harness.
+
+Each scenario drives a long sequence of events through the charm and records,
+per event, the wall-clock latency and the peak memory allocated (measured in a
+separate pass, as tracemalloc slows everything down), as well as the number of
+set_spec calls and the size of the last pod spec once dumped to YAML.
+
+Run with `tox -e bench`. BENCH_EVENTS sets the number of events per scenario
+and, if BENCH_OUTPUT is set, the results are also written there as JSON.
+"""
+
+import json
+import os
+import time
+import tracemalloc
+from unittest import mock
+
+import pytest
+from ops.model import ActiveStatus
+from ops.testing import Harness
+import yaml
+
+from charm import K8sDashboardCharm
+from charms.k8s_dashboard.v0.reconciler import Reconciler
+
+
+if yaml.__with_libyaml__:
+    _DefaultDumper = yaml.CSafeDumper
+else:
+    _DefaultDumper = yaml.SafeDumper
+
+EVENTS = int(os.environ.get("BENCH_EVENTS", 200))
+
+# Regression budgets, deliberately loose so that only real regressions trip.
+MAX_MEAN_LATENCY_MS = 50
+MAX_PEAK_ALLOCATION_KIB = 2048
+
+RESULTS = []
+
+
+def _harness():
+    harness = Harness(K8sDashboardCharm)
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    return harness
+
+
+def _config_unchanged(harness):
+    harness.begin_with_initial_hooks()
+    return lambda i: harness.charm.on.config_changed.emit()
+
+
+def _config_changed(harness):
+    harness.begin_with_initial_hooks()
+    modes = ["token", "basic"]
+    return lambda i: harness.update_config(
+        key_values={"authentication-mode": modes[i % 2]}
+    )
+
+
+def _ingress_changed(harness):
+    harness.begin_with_initial_hooks()
+    return lambda i: harness.update_config(
+        key_values={"site-url": "https://dashboard-{}.example.com".format(i)}
+    )
+
+
+def _relation_changed(harness):
+    rel_id = harness.add_relation("metrics-scraper", "dashboard-metrics-scraper")
+    harness.add_relation_unit(rel_id, "dashboard-metrics-scraper/0")
+    harness.begin_with_initial_hooks()
+    return lambda i: harness.update_relation_data(
+        rel_id,
+        "dashboard-metrics-scraper",
+        {"service-name": "dashboard-metrics-scraper", "service-port": str(8000 + i)},
+    )
+
+
+SCENARIOS = {
+    # name: (setup, expected set_spec calls per event)
+    "config-unchanged": (_config_unchanged, 0),
+    "config-changed": (_config_changed, 1),
+    "ingress-changed": (_ingress_changed, 1),
+    "relation-changed": (_relation_changed, 1),
+}
+
+
+def _run(setup, measure_memory):
+    harness = _harness()
+    emit = setup(harness)
+    latencies, peaks = [], []
+    with mock.patch.object(
+        harness.charm.model.pod, "set_spec", wraps=harness.charm.model.pod.set_spec
+    ) as set_spec:
+        for i in range(1, EVENTS + 1):
+            if measure_memory:
+                tracemalloc.start()
+                emit(i)
+                peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+                tracemalloc.stop()
+            else:
+                start = time.perf_counter()
+                emit(i)
+                latencies.append((time.perf_counter() - start) * 1000)
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    spec_size = len(yaml.dump(harness.get_pod_spec(), Dumper=_DefaultDumper))
+    return latencies, peaks, set_spec.call_count, spec_size
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_hook_cost(scenario, monkeypatch):
+    # API requests, such as seeding the settings config map, aren't measured.
+    client = mock.Mock(**{"list.return_value": []})
+    monkeypatch.setattr(Reconciler, "client", property(lambda self: client))
+    setup, set_spec_per_event = SCENARIOS[scenario]
+    latencies, _, set_spec_calls, spec_size = _run(setup, measure_memory=False)
+    _, peaks, _, _ = _run(setup, measure_memory=True)
+
+    latencies.sort()
+    result = {
+        "charm": "k8s-dashboard",
+        "scenario": scenario,
+        "events": EVENTS,
+        "set-spec-calls": set_spec_calls,
+        "mean-ms": round(sum(latencies) / EVENTS, 3),
+        "p95-ms": round(latencies[int(EVENTS * 0.95) - 1], 3),
+        "max-ms": round(latencies[-1], 3),
+        "mean-peak-kib": round(sum(peaks) / EVENTS, 1),
+        "max-peak-kib": round(max(peaks), 1),
+        "spec-yaml-bytes": spec_size,
+    }
+    RESULTS.append(result)
+    print("\n" + json.dumps(result, sort_keys=True))
+
+    assert set_spec_calls == EVENTS * set_spec_per_event
+    assert result["mean-ms"] < MAX_MEAN_LATENCY_MS
+    assert result["max-peak-kib"] < MAX_PEAK_ALLOCATION_KIB
+
+
+def teardown_module():
+    output = os.environ.get("BENCH_OUTPUT")
+    if output:
+        with open(output, "w") as f:
+            json.dump(RESULTS, f, indent=2, sort_keys=True)
@@ -0,0 +1,77 @@
+"""Import cost benchmark of the charm module.
+
+Every hook runs in a fresh Python process, which imports the charm module
+before dispatching the event, even on non-leader units that return right away.
+The charm is imported in fresh interpreters with `-X importtime`, after ops,
+so that only the time spent beyond importing ops is recorded, as well as the
+modules imported.
+
+Run with `tox -e bench`. BENCH_RUNS sets the number of interpreters started,
+the fastest of which is kept.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+RUNS = int(os.environ.get("BENCH_RUNS", 5))
+
+# Regression budget, deliberately loose so that only real regressions trip.
+MAX_CHARM_IMPORT_MS = 25
+
+# Modules only the leader needs, which must not be imported up front. Those
+# ops itself already imports, such as ssl for Pebble, are no concern of the
+# charm and left out of the check.
+LEADER_ONLY_MODULES = {
+    "k8s_service",
+    "oci_image",
+    "ssl",
+    "urllib.request",
+    "hashlib",
+}
+
+
+def _import_times(modules="ops.charm, ops.main, charm"):
+    """Import the charm in a fresh interpreter.
+
+    Args:
+        modules (str): the modules to import.
+
+    Returns:
+        Dict[str, int]: cumulative import time in microseconds, by module.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, sys.path)))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + modules],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line.split("|")
+        times[module.strip()] = int(cumulative)
+    return times
+
+
+def test_import_cost():
+    runs = [_import_times() for _ in range(RUNS)]
+    charm_ms = min(times["charm"] for times in runs) / 1000
+    imported = set(runs[0])
+    imported_by_ops = set(_import_times("ops.charm, ops.main"))
+
+    result = {
+        "charm": "k8s-dashboard",
+        "scenario": "import",
+        "runs": RUNS,
+        "charm-import-ms": round(charm_ms, 3),
+        "modules": len(imported),
+    }
+    print("\n" + json.dumps(result, sort_keys=True))
+
+    assert not LEADER_ONLY_MODULES & (imported - imported_by_ops)
+    assert charm_ms < MAX_CHARM_IMPORT_MS
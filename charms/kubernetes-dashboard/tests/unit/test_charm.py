@@ -1,10 +1,18 @@
+import base64
+import json
+import subprocess
+from unittest import mock
+
 import pytest
 
 from ops.model import ActiveStatus, BlockedStatus, WaitingStatus
 from ops.testing import Harness
 import yaml
 
+import charm
 from charm import K8sDashboardCharm
+from charms.k8s_dashboard.v0 import k8s_api
+from charms.k8s_dashboard.v0.reconciler import Reconciler
 
 
 if yaml.__with_libyaml__:
@@ -13,14 +21,43 @@ else:
     _DefaultDumper = yaml.SafeDumper
 
 
+@pytest.fixture(autouse=True)
+def k8s_client(monkeypatch):
+    # The leader seeds the settings config map through the API in every mode.
+    client = mock.Mock(**{"get.return_value": None, "list.return_value": []})
+    monkeypatch.setattr(Reconciler, "client", property(lambda self: client))
+    return client
+
+
 @pytest.fixture
 def harness():
     return Harness(K8sDashboardCharm)
 
 
+@pytest.fixture
+def sidecar_harness():
+    # The sidecar flavour of the charm declares its workload container.
+    with open("metadata.yaml") as f:
+        meta = yaml.safe_load(f)
+    meta["containers"] = {"dashboard": {"resource": "k8s-dashboard-image"}}
+    with open("actions.yaml") as f:
+        actions = f.read()
+    return Harness(K8sDashboardCharm, meta=yaml.safe_dump(meta), actions=actions)
+
+
 def test_not_leader(harness):
     harness.begin()
     assert isinstance(harness.charm.model.unit.status, WaitingStatus)
+    assert harness.charm.state.waiting_for_leadership
+
+
+def test_leader_replaces_waiting_status(harness):
+    harness.set_leader(True)
+    harness.begin()
+    harness.charm.state.waiting_for_leadership = True
+    harness.charm.on.config_changed.emit()
+    assert not harness.charm.state.waiting_for_leadership
+    assert isinstance(harness.charm.model.unit.status, BlockedStatus)
 
 
 def test_missing_image(harness):
@@ -47,6 +84,9 @@ def test_main_no_relation(harness):
     yaml.dump(pod_spec, Dumper=_DefaultDumper)
 
     assert "--metrics-provider=none" in pod_spec[0]["containers"][0]["args"]
+    kubernetes = pod_spec[0]["containers"][0]["kubernetes"]
+    assert kubernetes["startupProbe"]["failureThreshold"] == 30
+    assert kubernetes["readinessProbe"]["httpGet"]["port"] == 8443
 
 
 def test_main_with_relation(harness):
@@ -78,6 +118,69 @@ def test_main_with_relation(harness):
     assert sidecar_host in pod_spec[0]["containers"][0]["args"]
 
 
+def test_main_reads_relations_once(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    rel_id = harness.add_relation("metrics-scraper", "dashboard-metrics-scraper")
+    harness.add_relation_unit(rel_id, "dashboard-metrics-scraper/0")
+    harness.begin_with_initial_hooks()
+    requirer = type(harness.charm.metrics_scraper)
+    read_services = requirer.services.fget
+    services = mock.PropertyMock(
+        side_effect=lambda: read_services(harness.charm.metrics_scraper)
+    )
+    with mock.patch.object(requirer, "services", services):
+        harness.update_relation_data(
+            rel_id,
+            "dashboard-metrics-scraper",
+            {"service-name": "dashboard-metrics-scraper", "service-port": "8000"},
+        )
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    services.assert_called_once_with()
+
+
+def test_main_with_multiple_scrapers(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    for app in ["scraper-a", "scraper-b"]:
+        rel_id = harness.add_relation("metrics-scraper", app)
+        harness.add_relation_unit(rel_id, "{}/0".format(app))
+        harness.update_relation_data(
+            rel_id, app, {"service-name": app, "service-port": "8000"}
+        )
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+
+    pod_spec = harness.get_pod_spec()[0]
+    args = pod_spec["containers"][0]["args"]
+    assert "--sidecar-host=http://k8s-dashboard-metrics-scraper:8000" in args
+    services = pod_spec["kubernetesResources"]["services"]
+    assert [service["name"] for service in services] == [
+        "kubernetes-dashboard",
+        "k8s-dashboard-metrics-scraper",
+    ]
+    assert services[1]["spec"] == {
+        "selector": {"k8s-dashboard.juju.is/metrics-scraper": "true"},
+        "ports": [{"protocol": "TCP", "port": 8000, "targetPort": "scraper"}],
+        # each scraper pod keeps its own metrics
+        "sessionAffinity": "ClientIP",
+    }
+
+
 def test_main_ingress_http(harness):
     harness.set_leader(True)
     harness.add_oci_resource(
@@ -103,6 +206,8 @@ def test_main_ingress_http(harness):
         "false"
         == ingressResource["annotations"]["nginx.ingress.kubernetes.io/ssl-redirect"]
     )
+    backend = ingressResource["spec"]["rules"][0]["http"]["paths"][0]["backend"]
+    assert backend == {"serviceName": "kubernetes-dashboard", "servicePort": 443}
 
 
 def test_main_ingress_https(harness):
@@ -134,3 +239,1001 @@ def test_main_ingress_https(harness):
     assert (
         "k8sdashboard.7.7.7.7.xip.io" == ingressResource["spec"]["tls"][0]["hosts"][0]
     )
+
+
+def test_main_skips_unchanged_spec(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    state = harness.charm.reconciler.state
+    applied, skipped = state.specs_applied, state.specs_skipped
+    assert applied == 1
+
+    # hook-timings changes the inputs, but not the spec
+    harness.update_config(key_values={"hook-timings": True})
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    assert state.specs_applied == applied
+    assert state.specs_skipped == skipped + 1
+
+    harness.update_config(key_values={"authentication-mode": "basic"})
+    assert state.specs_applied == applied + 1
+    pod_spec = harness.get_pod_spec()
+    assert "--authentication-mode=basic" in pod_spec[0]["containers"][0]["args"]
+
+    # another unit may have set a different spec while this one wasn't the
+    # leader, so a new leader sets its spec even if it looks unchanged
+    harness.charm.on.leader_elected.emit()
+    assert state.specs_applied == applied + 2
+
+
+def test_main_coalesces_events(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    # install only marks the state dirty, config-changed adds nothing to the
+    # reconcile done on leader-elected
+    state = harness.charm.state
+    stats = harness.charm.reconciler.state
+    assert stats.specs_applied == 1
+    assert stats.specs_skipped == 0
+    assert state.events_coalesced == 2
+    assert not state.dirty
+
+    with mock.patch.object(harness.charm, "_build_dashboard_service") as build:
+        for _ in range(5):
+            harness.charm.on.config_changed.emit()
+        build.assert_not_called()
+    assert state.events_coalesced == 7
+
+    # upgrade-charm marks the state dirty, so the next event reconciles even
+    # though its inputs didn't change
+    harness.charm.on.upgrade_charm.emit()
+    assert state.dirty
+    harness.charm.on.config_changed.emit()
+    assert not state.dirty
+    assert stats.specs_skipped == 1
+
+    action_event = mock.Mock()
+    harness.charm.on_reconcile_stats_action(action_event)
+    action_event.set_results.assert_called_once_with(
+        {"specs-applied": 1, "specs-skipped": 1, "events-coalesced": 8}
+    )
+
+
+def test_main_resources(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "cpu-request": "100m",
+            "memory-limit": "512Mi",
+            "tmp-volume-size-limit": "64Mi",
+        }
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    container = harness.get_pod_spec()[0]["containers"][0]
+    # Juju takes no resources in a pod spec, they are patched into the workload
+    assert "resources" not in container["kubernetes"]
+    harness.charm.reconciler.spec_set = False
+    harness.framework.reemit()
+    patch = k8s_client.apply.call_args[0][0]
+    assert patch["spec"]["template"]["spec"]["containers"] == [
+        {
+            "name": "k8s-dashboard-charm",
+            "resources": {
+                "requests": {"cpu": "100m"},
+                "limits": {"memory": "512Mi"},
+            },
+        },
+    ]
+    tmp_volume = container["volumeConfig"][1]
+    assert tmp_volume["emptyDir"] == {"medium": "Memory", "sizeLimit": "64Mi"}
+
+    harness.update_config(key_values={"memory-limit": "half a gig"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid memory-limit: 'half a gig'"
+    )
+
+
+def test_generate_certificate():
+    cert, key = charm.generate_certificate(
+        ["kubernetes-dashboard", "kubernetes-dashboard.dashboard"]
+    )
+    assert cert.startswith("-----BEGIN CERTIFICATE-----")
+    assert "PRIVATE KEY-----" in key
+    text = subprocess.run(
+        ["openssl", "x509", "-noout", "-text"],
+        input=cert,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert "CN = kubernetes-dashboard" in text
+    assert (
+        "DNS:kubernetes-dashboard, DNS:kubernetes-dashboard.dashboard" in text
+    )
+
+
+@pytest.mark.parametrize(
+    "error, message",
+    [
+        (FileNotFoundError(2, "No such file or directory", "openssl"),
+         "scale-out requires openssl in the charm container"),
+        (subprocess.CalledProcessError(1, "openssl", stderr="req: bad option"),
+         "openssl failed to generate the dashboard certificate, see juju debug-log"),
+    ],
+)
+def test_main_scale_out_certificate_failure(harness, monkeypatch, error, message):
+    monkeypatch.setattr(charm, "generate_certificate", mock.Mock(side_effect=error))
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values={"scale-out": True})
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(message)
+
+
+def test_main_scale_out(harness, monkeypatch, k8s_client):
+    generate_certificate = mock.Mock(return_value=("CERT", "KEY"))
+    monkeypatch.setattr(charm, "generate_certificate", generate_certificate)
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "scale-out": True,
+            "max-surge": "1",
+            "max-unavailable": "0",
+            "session-affinity": "ClientIP",
+            "pdb-min-available": "1",
+        }
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    pod_spec = harness.get_pod_spec()[0]
+    yaml.dump(pod_spec, Dumper=_DefaultDumper)
+
+    args = pod_spec["containers"][0]["args"]
+    assert "--auto-generate-certificates" not in args
+    assert "--tls-cert-file=dashboard.crt" in args
+    certs = pod_spec["kubernetesResources"]["secrets"][0]
+    assert certs["name"] == "kubernetes-dashboard-certs"
+    assert base64.b64decode(certs["data"]["dashboard.crt"]) == b"CERT"
+    assert base64.b64decode(certs["data"]["dashboard.key"]) == b"KEY"
+
+    rolling_update = pod_spec["service"]["updateStrategy"]["rollingUpdate"]
+    assert rolling_update == {"maxSurge": 1, "maxUnavailable": 0}
+    service = pod_spec["kubernetesResources"]["services"][0]["spec"]
+    assert service["sessionAffinity"] == "ClientIP"
+    assert service["sessionAffinityConfig"]["clientIP"]["timeoutSeconds"] == 10800
+
+    k8s_client.apply.assert_called_once()
+    budget = k8s_client.apply.call_args[0][0]
+    assert budget["kind"] == "PodDisruptionBudget"
+    assert budget["spec"]["minAvailable"] == 1
+
+    # the certificate is generated once and reused on later hooks
+    harness.update_config(key_values={"pdb-min-available": "50%"})
+    generate_certificate.assert_called_once()
+    assert k8s_client.apply.call_count == 2
+
+    # a new leader reads back the certificate another unit generated
+    k8s_client.get.return_value = {"data": certs["data"]}
+    harness.charm.on.leader_elected.emit()
+    k8s_client.get.assert_called_with("v1", "Secret", "kubernetes-dashboard-certs")
+    generate_certificate.assert_called_once()
+    certs = harness.get_pod_spec()[0]["kubernetesResources"]["secrets"][0]
+    assert base64.b64decode(certs["data"]["dashboard.crt"]) == b"CERT"
+
+    harness.update_config(key_values={"scale-out": False})
+    k8s_client.delete.assert_called_once_with(
+        "policy/v1", "PodDisruptionBudget", "k8s-dashboard"
+    )
+    args = harness.get_pod_spec()[0]["containers"][0]["args"]
+    assert "--auto-generate-certificates" in args
+
+
+def test_main_autoscaling(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={"autoscaling-max-replicas": 5, "autoscaling-target-cpu": 60}
+    )
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "autoscaling-target-cpu requires cpu-request"
+    )
+
+    harness.update_config(key_values={"cpu-request": "100m"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "autoscaling requires scale-out"
+    )
+
+    harness.update_config(key_values={"scale-out": True})
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    autoscaler = k8s_client.apply.call_args[0][0]
+    assert autoscaler["kind"] == "HorizontalPodAutoscaler"
+    assert autoscaler["spec"]["maxReplicas"] == 5
+
+    # a new leader applies the objects again, rather than trusting the hashes
+    # it kept from when it last led
+    k8s_client.reset_mock()
+    harness.charm.on.leader_elected.emit()
+    assert k8s_client.apply.call_args[0][0]["kind"] == "HorizontalPodAutoscaler"
+
+    harness.update_config(key_values={"autoscaling-max-replicas": 0})
+    k8s_client.delete.assert_called_once_with(
+        "autoscaling/v2", "HorizontalPodAutoscaler", "k8s-dashboard"
+    )
+
+
+def test_main_supplied_certificate(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values={"tls-cert": "-----BEGIN CERT", "tls-key": ""})
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "tls-cert and tls-key must be set together"
+    )
+
+    harness.update_config(key_values={"tls-key": "-----BEGIN KEY"})
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    container = harness.get_pod_spec()[0]["containers"][0]
+    assert "--auto-generate-certificates" not in container["args"]
+    assert "--tls-cert-file=tls.crt" in container["args"]
+    assert container["volumeConfig"][0]["secret"]["name"] == "kubernetes-dashboard-tls"
+    secret = k8s_client.apply.call_args[0][0]
+    assert secret["kind"] == "Secret"
+    assert base64.b64decode(secret["data"]["tls.crt"]) == b"-----BEGIN CERT\n"
+    assert base64.b64decode(secret["data"]["tls.key"]) == b"-----BEGIN KEY\n"
+
+    # a rotated certificate only updates the secret and restarts the pods
+    with mock.patch.object(harness.charm.model.pod, "set_spec") as set_spec:
+        harness.update_config(key_values={"tls-cert": "-----BEGIN ROTATED"})
+    set_spec.assert_not_called()
+    secret, restart = [call[0][0] for call in k8s_client.apply.call_args_list[-2:]]
+    assert base64.b64decode(secret["data"]["tls.crt"]) == b"-----BEGIN ROTATED\n"
+    assert restart["kind"] == "Deployment"
+    assert restart["metadata"]["name"] == "k8s-dashboard"
+
+    harness.update_config(key_values={"tls-cert": "", "tls-key": ""})
+    k8s_client.delete.assert_called_once_with(
+        "v1", "Secret", "kubernetes-dashboard-tls"
+    )
+    args = harness.get_pod_spec()[0]["containers"][0]["args"]
+    assert "--auto-generate-certificates" in args
+
+
+class FakeApiServer:
+    """Keep what each field manager applied, as server-side apply does."""
+
+    field_manager = "k8s-dashboard"
+
+    def __init__(self):
+        self.applied = {}
+
+    def create(self, manifest):
+        self.apply(manifest)
+
+    def apply(self, manifest, field_manager=None):
+        key = (manifest["kind"], manifest["metadata"]["name"])
+        # a manager's apply releases whatever it left out since its last one
+        self.applied.setdefault(key, {})[field_manager or self.field_manager] = manifest
+
+    def delete(self, api_version, kind, name):
+        self.applied.pop((kind, name), None)
+
+    def get(self, api_version, kind, name):
+        return None
+
+    def list(self, api_version, kind, label_selector):
+        return []
+
+    def template(self, name):
+        """Merge what all managers applied to the pod template of a Deployment."""
+        merged = {}
+        for manifest in self.applied[("Deployment", name)].values():
+            for field, value in manifest["spec"]["template"].items():
+                merged.setdefault(field, {}).update(value)
+        return merged
+
+
+def test_main_certificate_rotation_keeps_placement(harness, monkeypatch):
+    server = FakeApiServer()
+    monkeypatch.setattr(Reconciler, "client", property(lambda self: server))
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "tls-cert": "-----BEGIN CERT",
+            "tls-key": "-----BEGIN KEY",
+            "node-selector": "{node-role.kubernetes.io/infra: 'true'}",
+        }
+    )
+    harness.begin_with_initial_hooks()
+    harness.charm.reconciler.spec_set = False
+    harness.framework.reemit()
+
+    harness.update_config(key_values={"tls-cert": "-----BEGIN ROTATED"})
+    template = server.template("k8s-dashboard")
+    assert "kubectl.kubernetes.io/restartedAt" in template["metadata"]["annotations"]
+    assert template["spec"] == {
+        "nodeSelector": {"node-role.kubernetes.io/infra": "true"},
+    }
+
+    # and a later placement patch keeps the restart annotation
+    harness.update_config(key_values={"anti-affinity": "required"})
+    template = server.template("k8s-dashboard")
+    assert "kubectl.kubernetes.io/restartedAt" in template["metadata"]["annotations"]
+    assert "affinity" in template["spec"]
+
+
+def test_main_related_certificate(harness, k8s_client):
+    harness.set_leader(True)
+    harness.set_model_name("dashboard")
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values={"site-url": "https://dashboard.example.com"})
+    rel_id = harness.add_relation("certificates", "easyrsa")
+    harness.add_relation_unit(rel_id, "easyrsa/0")
+    harness.begin_with_initial_hooks()
+    request = harness.get_relation_data(rel_id, "k8s-dashboard/0")
+    assert request["common_name"] == "kubernetes-dashboard"
+    assert json.loads(request["sans"]) == [
+        "kubernetes-dashboard.dashboard",
+        "kubernetes-dashboard.dashboard.svc",
+        "dashboard.example.com",
+    ]
+    args = harness.get_pod_spec()[0]["containers"][0]["args"]
+    assert "--auto-generate-certificates" in args
+
+    harness.update_relation_data(
+        rel_id,
+        "easyrsa/0",
+        {
+            "k8s-dashboard_0.server.cert": "ISSUED CERT",
+            "k8s-dashboard_0.server.key": "ISSUED KEY",
+        },
+    )
+    args = harness.get_pod_spec()[0]["containers"][0]["args"]
+    assert "--tls-key-file=tls.key" in args
+    secret = k8s_client.apply.call_args[0][0]
+    assert base64.b64decode(secret["data"]["tls.crt"]) == b"ISSUED CERT"
+
+
+def test_main_certificate_request_coalesced(harness, monkeypatch):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    hostnames = mock.Mock(wraps=harness.charm._certificate_hostnames)
+    monkeypatch.setattr(harness.charm, "_certificate_hostnames", hostnames)
+    harness.charm.on.config_changed.emit()
+    assert hostnames.call_count == 0
+
+    # A new relation changes the inputs, so the request is written.
+    rel_id = harness.add_relation("certificates", "easyrsa")
+    harness.add_relation_unit(rel_id, "easyrsa/0")
+    request = harness.get_relation_data(rel_id, "k8s-dashboard/0")
+    assert request["common_name"] == "kubernetes-dashboard"
+    assert hostnames.call_count == 1
+
+
+def test_main_invalid_session_affinity(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values={"session-affinity": "Cookie"})
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid session-affinity: 'Cookie'"
+    )
+
+
+def test_hook_timings(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    action_event = mock.Mock()
+    harness.charm.hook_timings.on_hook_timings_action(action_event)
+    action_event.fail.assert_called_once()
+
+    harness.update_config(key_values={"hook-timings": True})
+    action_event = mock.Mock()
+    harness.charm.hook_timings.on_hook_timings_action(action_event)
+    results = action_event.set_results.call_args[0][0]
+    timings = results["config-changed"]
+    for phase in ("image-fetch", "relation-read", "spec-build", "set-spec", "total"):
+        assert float(timings["{}-ms".format(phase)]) >= 0
+
+
+def test_image_details_cached(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    image = harness.charm.dashboard_image
+    with mock.patch.object(image, "fetch", wraps=image.fetch) as fetch:
+        harness.update_config(key_values={"authentication-mode": "basic"})
+        fetch.assert_not_called()
+
+        harness.charm.on.upgrade_charm.emit()
+        fetch.assert_not_called()
+        harness.charm.on.config_changed.emit()
+        fetch.assert_called_once()
+
+        # a new leader may have missed upgrade-charm while it wasn't one
+        harness.charm.on.leader_elected.emit()
+        assert fetch.call_count == 2
+
+    image_details = harness.get_pod_spec()[0]["containers"][0]["imageDetails"]
+    assert image_details["imagePath"] == "kubernetesui/dashboard:v2.0.4"
+
+
+def test_main_image_pull_policy(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard@sha256:" + "a" * 64,
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    container = harness.get_pod_spec()[0]["containers"][0]
+    assert container["imagePullPolicy"] == "IfNotPresent"
+
+    harness.update_config(key_values={"image-pull-policy": "Always"})
+    container = harness.get_pod_spec()[0]["containers"][0]
+    assert container["imagePullPolicy"] == "Always"
+
+    harness.update_config(key_values={"image-pull-policy": "always"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid image-pull-policy: 'always'"
+    )
+
+
+def test_main_placement(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "node-selector": "{node-role.kubernetes.io/infra: 'true'}",
+            "tolerations": "[{key: dedicated, value: infra, effect: NoSchedule}]",
+            "anti-affinity": "none",
+            "priority-class-name": "infra",
+        }
+    )
+    harness.begin_with_initial_hooks()
+    # the pod spec only takes the priority class
+    assert harness.get_pod_spec()[0]["kubernetesResources"]["pod"] == {
+        "priorityClassName": "infra",
+    }
+    # the rest is patched into the deployment once Juju replaced it, after
+    # the hook which set the spec
+    k8s_client.apply.assert_not_called()
+    harness.charm.reconciler.spec_set = False
+    harness.framework.reemit()
+    patch = k8s_client.apply.call_args[0][0]
+    assert (patch["kind"], patch["metadata"]["name"]) == ("Deployment", "k8s-dashboard")
+    assert patch["spec"]["template"]["spec"] == {
+        "nodeSelector": {"node-role.kubernetes.io/infra": "true"},
+        "tolerations": [{"key": "dedicated", "value": "infra", "effect": "NoSchedule"}],
+    }
+
+    # a placement change alone leaves the spec alone and patches right away
+    k8s_client.reset_mock()
+    harness.update_config(key_values={"anti-affinity": "required"})
+    assert harness.charm.reconciler.state.specs_skipped == 1
+    affinity = k8s_client.apply.call_args[0][0]["spec"]["template"]["spec"]["affinity"]
+    assert "requiredDuringSchedulingIgnoredDuringExecution" in (
+        affinity["podAntiAffinity"]
+    )
+
+    # unset fields are released by patching without them
+    harness.update_config(
+        key_values={"node-selector": "", "tolerations": "", "anti-affinity": "none"}
+    )
+    assert k8s_client.apply.call_args[0][0]["spec"]["template"]["spec"] == {}
+
+    harness.update_config(key_values={"tolerations": "dedicated"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "tolerations must be a list"
+    )
+
+
+def test_main_server_args_and_settings(harness, k8s_client):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    pod_spec = harness.get_pod_spec()[0]
+    args = pod_spec["containers"][0]["args"]
+    assert "--token-ttl=900" in args
+    assert not [arg for arg in args if arg.startswith(("--api-server", "--system"))]
+    # seeded through the API, the pod spec would overwrite the settings page
+    assert "configMaps" not in pod_spec
+    config_map = k8s_client.create.call_args[0][0]
+    assert config_map["metadata"]["name"] == "kubernetes-dashboard-settings"
+    settings = json.loads(config_map["data"]["_global"])
+    assert settings["itemsPerPage"] == 10
+    assert settings["resourceAutoRefreshTimeInterval"] == 5
+    assert settings["labelsLimit"] == 3
+
+    # only written again when a settings option changes
+    harness.update_config(key_values={"authentication-mode": "basic"})
+    k8s_client.apply.assert_not_called()
+
+    harness.update_config(
+        key_values={
+            "token-ttl": 0,
+            "enable-skip-login": True,
+            "api-server-qps": 20,
+            "api-server-burst": 40,
+            "system-banner": "Production cluster",
+            "system-banner-severity": "WARNING",
+            "cluster-name": "prod",
+            "items-per-page": 50,
+            "resource-auto-refresh-interval": 30,
+        }
+    )
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    pod_spec = harness.get_pod_spec()[0]
+    args = pod_spec["containers"][0]["args"]
+    for arg in [
+        "--token-ttl=0",
+        "--enable-skip-login",
+        "--api-server-qps=20",
+        "--api-server-burst=40",
+        "--system-banner=Production cluster",
+        "--system-banner-severity=WARNING",
+    ]:
+        assert arg in args
+    settings = json.loads(k8s_client.apply.call_args[0][0]["data"]["_global"])
+    assert settings["clusterName"] == "prod"
+    assert settings["itemsPerPage"] == 50
+    assert settings["resourceAutoRefreshTimeInterval"] == 30
+
+
+def test_main_untrusted(harness, k8s_client):
+    k8s_client.create.side_effect = k8s_api.APIError(
+        "POST /api/v1/namespaces/kubernetes-dashboard/configmaps failed: "
+        "403 Forbidden", 403
+    )
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Kubernetes API access denied, run juju trust"
+    )
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"token-ttl": -1}, "token-ttl must not be negative"),
+        ({"api-server-qps": 20, "api-server-burst": 10},
+         "api-server-burst is lower than api-server-qps"),
+        ({"system-banner": "Hi", "system-banner-severity": "LOUD"},
+         "Invalid system-banner-severity: 'LOUD'"),
+        ({"items-per-page": 0}, "items-per-page must be at least 1"),
+        ({"logs-auto-refresh-interval": -5},
+         "logs-auto-refresh-interval must not be negative"),
+    ],
+)
+def test_main_server_args_invalid(harness, config, message):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(key_values=config)
+    harness.begin_with_initial_hooks()
+    assert harness.charm.model.unit.status == BlockedStatus(message)
+
+
+def test_main_ingress_tuning(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "site-url": "https://k8sdashboard.7.7.7.7.xip.io",
+            "ingress-proxy-buffering": "off",
+            "ingress-proxy-read-timeout": 300,
+            "ingress-upstream-keepalive": True,
+            "ingress-annotations": (
+                "{nginx.ingress.kubernetes.io/proxy-read-timeout: 600,"
+                " nginx.ingress.kubernetes.io/enable-cors: true}"
+            ),
+        }
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    pod_spec = harness.get_pod_spec()
+    yaml.dump(pod_spec, Dumper=_DefaultDumper)
+    annotations = pod_spec[0]["kubernetesResources"]["ingressResources"][0][
+        "annotations"
+    ]
+    assert annotations["nginx.ingress.kubernetes.io/backend-protocol"] == "HTTPS"
+    assert annotations["nginx.ingress.kubernetes.io/proxy-buffering"] == "off"
+    assert annotations["nginx.ingress.kubernetes.io/proxy-http-version"] == "1.1"
+    # ingress-annotations override the generated annotations
+    assert annotations["nginx.ingress.kubernetes.io/proxy-read-timeout"] == "600"
+    assert annotations["nginx.ingress.kubernetes.io/enable-cors"] == "true"
+
+    harness.update_config(key_values={"ingress-annotations": "[not, a, mapping]"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "ingress-annotations must be a mapping of names to values"
+    )
+    harness.update_config(
+        key_values={"ingress-annotations": "", "ingress-proxy-buffering": "maybe"}
+    )
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid ingress-proxy-buffering: 'maybe'"
+    )
+
+
+def test_main_ingress_multiple_hosts(harness):
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "site-url": (
+                "https://eu.example.com/dashboard/, https://us.example.com/dashboard"
+            ),
+            "tls-secret-name": "default-tls",
+            "ingress-tls-secret-names": "{us.example.com: us-tls}",
+        }
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    pod_spec = harness.get_pod_spec()
+    yaml.dump(pod_spec, Dumper=_DefaultDumper)
+    ingress = pod_spec[0]["kubernetesResources"]["ingressResources"][0]
+
+    rules = ingress["spec"]["rules"]
+    assert [rule["host"] for rule in rules] == ["eu.example.com", "us.example.com"]
+    assert rules[1]["http"]["paths"][0]["path"] == "/dashboard(/|$)(.*)"
+    assert ingress["spec"]["tls"] == [
+        {"hosts": ["eu.example.com"], "secretName": "default-tls"},
+        {"hosts": ["us.example.com"], "secretName": "us-tls"},
+    ]
+    annotations = ingress["annotations"]
+    assert annotations["nginx.ingress.kubernetes.io/rewrite-target"] == "/$2"
+    assert "nginx.ingress.kubernetes.io/ssl-redirect" not in annotations
+
+    harness.update_config(
+        key_values={"site-url": "https://eu.example.com/a http://us.example.com/b"}
+    )
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "site-url entries must all have the same path"
+    )
+    harness.update_config(key_values={"site-url": "eu.example.com"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid site-url: 'eu.example.com'"
+    )
+
+
+def test_main_metrics(harness):
+    harness.set_leader(True)
+    harness.set_model_name("dashboard")
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus")
+    harness.begin_with_initial_hooks()
+    pod_spec = harness.get_pod_spec()[0]
+    assert "pod" not in pod_spec["kubernetesResources"]
+    assert "customResources" not in pod_spec["kubernetesResources"]
+    rel_data = harness.get_relation_data(rel_id, "k8s-dashboard")
+    assert json.loads(rel_data["scrape_jobs"]) == [
+        {
+            "job_name": "k8s-dashboard",
+            "metrics_path": "/metrics",
+            "scheme": "https",
+            "static_configs": [
+                {"targets": ["kubernetes-dashboard.dashboard.svc:443"]}
+            ],
+            "tls_config": {"insecure_skip_verify": True},
+        }
+    ]
+
+    harness.update_config(
+        key_values={"metrics-annotations": True, "pod-monitor": True}
+    )
+    pod_spec = harness.get_pod_spec()[0]
+    yaml.dump(pod_spec, Dumper=_DefaultDumper)
+    annotations = pod_spec["kubernetesResources"]["pod"]["annotations"]
+    assert annotations["prometheus.io/port"] == "8443"
+    assert annotations["prometheus.io/scheme"] == "https"
+    monitors = pod_spec["kubernetesResources"]["customResources"][
+        "podmonitors.monitoring.coreos.com"
+    ]
+    assert monitors[0]["spec"]["podMetricsEndpoints"][0]["port"] == "dashboard"
+
+    harness.update_config(key_values={"metrics-path": "metrics"})
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Invalid metrics-path: 'metrics'"
+    )
+
+
+def test_main_sidecar(sidecar_harness, k8s_client):
+    harness = sidecar_harness
+    harness.set_leader(True)
+    harness.set_model_name("kubernetes-dashboard")
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    assert harness.charm.reconciler.state.specs_applied == 0
+    service = harness.get_container_pebble_plan("dashboard").services["dashboard"]
+    assert service.command.startswith("/dashboard --auto-generate-certificates ")
+    applied = {(manifest["kind"], manifest["metadata"]["name"]): manifest
+               for manifest in [call[0][0] for call in k8s_client.apply.call_args_list]}
+    assert set(applied) == {
+        ("Secret", "kubernetes-dashboard-certs"),
+        ("Secret", "kubernetes-dashboard-csrf"),
+        ("Secret", "kubernetes-dashboard-key-holder"),
+        ("Service", "kubernetes-dashboard"),
+        ("Role", "k8s-dashboard"),
+        ("RoleBinding", "k8s-dashboard"),
+        ("ClusterRole", "kubernetes-dashboard-k8s-dashboard"),
+        ("ClusterRoleBinding", "kubernetes-dashboard-k8s-dashboard"),
+        # a new leader releases any placement another unit patched in
+        ("StatefulSet", "k8s-dashboard"),
+    }
+    assert applied["Service", "kubernetes-dashboard"]["spec"]["selector"] == {
+        "app.kubernetes.io/name": "k8s-dashboard"
+    }
+    config_map = k8s_client.create.call_args[0][0]
+    assert config_map["metadata"]["name"] == "kubernetes-dashboard-settings"
+
+    # an arg change only restarts the service, unchanged resources aren't
+    # applied again
+    k8s_client.reset_mock()
+    harness.update_config(key_values={"authentication-mode": "basic"})
+    service = harness.get_container_pebble_plan("dashboard").services["dashboard"]
+    assert "--authentication-mode=basic" in service.command.split()
+    k8s_client.apply.assert_not_called()
+    assert harness.charm.reconciler.state.specs_applied == 0
+
+
+def test_main_sidecar_supplied_certificate(sidecar_harness, k8s_client):
+    harness = sidecar_harness
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={"tls-cert": "-----BEGIN CERT", "tls-key": "-----BEGIN KEY"}
+    )
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    container = harness.charm.unit.get_container("dashboard")
+    assert container.pull("/certs/tls.crt").read() == "-----BEGIN CERT\n"
+    assert container.pull("/certs/tls.key").read() == "-----BEGIN KEY\n"
+    service = harness.get_container_pebble_plan("dashboard").services["dashboard"]
+    assert "--tls-cert-file=tls.crt" in service.command.split()
+    # the certificate is pushed to the container rather than kept in a secret
+    assert "kubernetes-dashboard-tls" not in [
+        call[0][0]["metadata"]["name"] for call in k8s_client.apply.call_args_list
+    ]
+
+    harness.update_config(key_values={"tls-cert": "-----BEGIN ROTATED"})
+    assert container.pull("/certs/tls.crt").read() == "-----BEGIN ROTATED\n"
+
+
+def test_main_sidecar_pebble_ready(sidecar_harness, monkeypatch):
+    harness = sidecar_harness
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={"tls-cert": "-----BEGIN CERT", "tls-key": "-----BEGIN KEY"}
+    )
+    harness.begin_with_initial_hooks()
+    container = harness.charm.unit.get_container("dashboard")
+    for method in ("add_layer", "push", "restart"):
+        monkeypatch.setattr(
+            container, method, mock.Mock(wraps=getattr(container, method))
+        )
+    harness.charm.on.config_changed.emit()
+    container.add_layer.assert_not_called()
+
+    # A restarted container lost the layer and the files, which are all
+    # put back although the inputs didn't change.
+    harness.charm.on.dashboard_pebble_ready.emit(container)
+    container.add_layer.assert_called_once()
+    assert container.push.call_count == 2
+    container.restart.assert_called_once_with("dashboard")
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+
+
+def test_main_sidecar_unsupported(sidecar_harness, k8s_client):
+    harness = sidecar_harness
+    harness.set_leader(True)
+    harness.add_oci_resource(
+        "k8s-dashboard-image",
+        {
+            "registrypath": "kubernetesui/dashboard:v2.0.4",
+            "username": "",
+            "password": "",
+        },
+    )
+    harness.update_config(
+        key_values={
+            "scale-out": True,
+            "cpu-request": "100m",
+            "autoscaling-max-replicas": 5,
+            "autoscaling-target-cpu": 60,
+        }
+    )
+    harness.begin_with_initial_hooks()
+    # the resource requests are patched into the workload container Juju runs
+    assert isinstance(harness.charm.model.unit.status, ActiveStatus)
+    applied = {
+        call[0][0]["kind"]: call[0][0] for call in k8s_client.apply.call_args_list
+    }
+    assert applied["HorizontalPodAutoscaler"]["spec"]["scaleTargetRef"]["kind"] == (
+        "StatefulSet"
+    )
+    assert applied["StatefulSet"]["spec"]["template"]["spec"]["containers"] == [
+        {"name": "dashboard", "resources": {"requests": {"cpu": "100m"}}},
+    ]
+
+    for app in ["scraper-a", "scraper-b"]:
+        rel_id = harness.add_relation("metrics-scraper", app)
+        harness.add_relation_unit(rel_id, "{}/0".format(app))
+        harness.update_relation_data(
+            rel_id, app, {"service-name": app, "service-port": "8000"}
+        )
+    assert harness.charm.model.unit.status == BlockedStatus(
+        "Relate a single metrics scraper in sidecar mode"
+    )
@@ -0,0 +1,128 @@
+from unittest import mock
+
+import pytest
+
+from charms.k8s_dashboard.v0 import k8s_api
+
+
+class FakeClient:
+    def __init__(self):
+        self.calls = []
+
+    def apply(self, manifest):
+        self.calls.append(("apply", k8s_api.resource_key(manifest)))
+
+    def delete(self, api_version, kind, name):
+        self.calls.append(("delete", api_version, kind, name))
+
+
+def _budget(min_available):
+    return {
+        "apiVersion": "policy/v1",
+        "kind": "PodDisruptionBudget",
+        "metadata": {"name": "k8s-dashboard"},
+        "spec": {"minAvailable": min_available},
+    }
+
+
+def test_reconcile():
+    client, applied = FakeClient(), {}
+    key = "policy/v1/PodDisruptionBudget/k8s-dashboard"
+
+    k8s_api.reconcile(client, applied, [_budget(1)])
+    assert client.calls == [("apply", key)]
+    assert list(applied) == [key]
+
+    # unchanged objects are not re-applied
+    k8s_api.reconcile(client, applied, [_budget(1)])
+    assert len(client.calls) == 1
+
+    k8s_api.reconcile(client, applied, [_budget(2)])
+    assert client.calls[-1] == ("apply", key)
+
+    k8s_api.reconcile(client, applied, [])
+    assert client.calls[-1] == (
+        "delete", "policy/v1", "PodDisruptionBudget", "k8s-dashboard"
+    )
+    assert applied == {}
+
+
+def test_client_path():
+    client = k8s_api.Client("kubernetes-dashboard", field_manager="k8s-dashboard")
+    assert client._path("policy/v1", "PodDisruptionBudget", "k8s-dashboard") == (
+        "/apis/policy/v1/namespaces/kubernetes-dashboard/"
+        "poddisruptionbudgets/k8s-dashboard"
+    )
+    assert client._path(
+        "rbac.authorization.k8s.io/v1", "ClusterRole", "kubernetes-dashboard"
+    ) == "/apis/rbac.authorization.k8s.io/v1/clusterroles/kubernetes-dashboard"
+
+
+def test_client_apply(monkeypatch):
+    client = k8s_api.Client("kubernetes-dashboard", field_manager="k8s-dashboard")
+    request = mock.Mock()
+    monkeypatch.setattr(client, "_request", request)
+    manifest = _budget(1)
+    client.apply(manifest)
+    assert request.call_args[0][1].endswith("?fieldManager=k8s-dashboard&force=true")
+    client.apply(manifest, field_manager="k8s-dashboard-restart")
+    assert "fieldManager=k8s-dashboard-restart&" in request.call_args[0][1]
+
+
+def test_client_create(monkeypatch):
+    client = k8s_api.Client("kubernetes-dashboard", field_manager="k8s-dashboard")
+    request = mock.Mock()
+    monkeypatch.setattr(client, "_request", request)
+    assert client.create(_budget(1))
+    method, path, body = request.call_args[0]
+    assert (method, body) == ("POST", _budget(1))
+    assert path == (
+        "/apis/policy/v1/namespaces/kubernetes-dashboard/poddisruptionbudgets"
+        "?fieldManager=k8s-dashboard"
+    )
+
+    request.side_effect = k8s_api.APIError("exists", 409)
+    assert not client.create(_budget(1))
+    request.side_effect = k8s_api.APIError("forbidden", 403)
+    with pytest.raises(k8s_api.APIError):
+        client.create(_budget(1))
+
+
+def test_client_get_and_list(monkeypatch):
+    client = k8s_api.Client("kubernetes-dashboard", field_manager="k8s-dashboard")
+    request = mock.Mock(return_value={"items": [_budget(1)]})
+    monkeypatch.setattr(client, "_request", request)
+    assert client.list("rbac.authorization.k8s.io/v1", "ClusterRole", "a=b,!c") == [
+        _budget(1)
+    ]
+    request.assert_called_once_with(
+        "GET",
+        "/apis/rbac.authorization.k8s.io/v1/clusterroles?labelSelector=a%3Db%2C%21c",
+    )
+
+    request.side_effect = k8s_api.APIError("not found", 404)
+    assert client.get("v1", "Secret", "kubernetes-dashboard-certs") is None
+    assert request.call_args[0] == (
+        "GET",
+        "/api/v1/namespaces/kubernetes-dashboard/secrets/kubernetes-dashboard-certs",
+    )
+
+
+def test_api_error_status():
+    error = k8s_api.APIError("GET /api/v1 failed: 500 Internal Server Error", 500)
+    assert error.status.message == (
+        "Kubernetes API error: GET /api/v1 failed: 500 Internal Server Error"
+    )
+    error = k8s_api.APIError("GET /api/v1 failed: 403 Forbidden", 403)
+    assert error.status.message == "Kubernetes API access denied, run juju trust"
+
+
+def test_rollout_restart():
+    client = mock.Mock(field_manager="k8s-dashboard")
+    k8s_api.rollout_restart(client, "k8s-dashboard")
+    manifest = client.apply.call_args[0][0]
+    # the restart doesn't release the fields of the workload patch
+    assert client.apply.call_args[1] == {"field_manager": "k8s-dashboard-restart"}
+    assert k8s_api.resource_key(manifest) == "apps/v1/Deployment/k8s-dashboard"
+    annotations = manifest["spec"]["template"]["metadata"]["annotations"]
+    assert "kubectl.kubernetes.io/restartedAt" in annotations
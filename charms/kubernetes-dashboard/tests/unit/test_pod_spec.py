@@ -0,0 +1,447 @@
+import pytest
+
+from ops.model import BlockedStatus
+import yaml
+
+from charms.k8s_dashboard.v0 import pod_spec
+
+
+if yaml.__with_libyaml__:
+    _DefaultDumper = yaml.CSafeDumper
+else:
+    _DefaultDumper = yaml.SafeDumper
+
+PROBE_CONFIG = {
+    "probe-period": 10,
+    "probe-timeout": 30,
+    "probe-failure-threshold": 3,
+    "startup-probe-failure-threshold": 30,
+}
+
+
+def test_spec_hash_is_canonical():
+    spec_a = {"version": 3, "containers": [{"name": "a", "args": ["--x"]}]}
+    spec_b = {"containers": [{"args": ["--x"], "name": "a"}], "version": 3}
+    assert pod_spec.spec_hash(spec_a) == pod_spec.spec_hash(spec_b)
+
+    spec_b["containers"][0]["args"].append("--y")
+    assert pod_spec.spec_hash(spec_a) != pod_spec.spec_hash(spec_b)
+
+
+def test_fragments_serialize():
+    spec = {
+        "service": pod_spec.SERVICE,
+        "containers": [
+            {
+                "ports": [pod_spec.container_port("dashboard", 8443)],
+                "volumeConfig": [pod_spec.TMP_VOLUME],
+                "kubernetes": dict(
+                    pod_spec.probes("HTTPS", 8443, PROBE_CONFIG),
+                    securityContext=pod_spec.SECURITY_CONTEXT,
+                ),
+            },
+        ],
+        "serviceAccount": pod_spec.SERVICE_ACCOUNT,
+    }
+    dumped = yaml.dump(spec, Dumper=_DefaultDumper)
+    # shared fragments must not be emitted as YAML anchors / aliases
+    assert "&id" not in dumped
+    assert yaml.safe_load(dumped) == spec
+
+
+def test_container_resources():
+    config = {
+        "cpu-request": "100m",
+        "cpu-limit": "1",
+        "memory-request": "",
+        "memory-limit": "256Mi",
+    }
+    assert pod_spec.container_resources(config) == {
+        "requests": {"cpu": "100m"},
+        "limits": {"cpu": "1", "memory": "256Mi"},
+    }
+    assert pod_spec.container_resources(dict.fromkeys(config, "")) == {}
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"cpu-limit": "1 core"}, "Invalid cpu-limit: '1 core'"),
+        ({"memory-request": "128MB"}, "Invalid memory-request: '128MB'"),
+        ({"memory-request": "1Gi", "memory-limit": "512Mi"},
+         "memory-request exceeds memory-limit"),
+    ],
+)
+def test_container_resources_invalid(config, message):
+    options = dict.fromkeys(
+        ("cpu-request", "cpu-limit", "memory-request", "memory-limit"), ""
+    )
+    options.update(config)
+    with pytest.raises(pod_spec.ConfigError) as excinfo:
+        pod_spec.container_resources(options)
+    assert isinstance(excinfo.value.status, BlockedStatus)
+    assert excinfo.value.status.message == message
+
+
+def test_tmp_volume():
+    assert pod_spec.tmp_volume("") is pod_spec.TMP_VOLUME
+    assert pod_spec.tmp_volume("64Mi")["emptyDir"] == {
+        "medium": "Memory",
+        "sizeLimit": "64Mi",
+    }
+    with pytest.raises(pod_spec.ConfigError):
+        pod_spec.tmp_volume("lots")
+
+
+def test_image_pull_policy():
+    tagged = "kubernetesui/dashboard:v2.0.4"
+    pinned = "kubernetesui/dashboard@sha256:" + "0" * 64
+    assert pod_spec.image_pull_policy(tagged, "") is None
+    assert pod_spec.image_pull_policy(tagged, "", "Always") == "Always"
+    assert pod_spec.image_pull_policy(pinned, "", "Always") == "IfNotPresent"
+    assert pod_spec.image_pull_policy(pinned, "Always") == "Always"
+    with pytest.raises(pod_spec.ConfigError) as excinfo:
+        pod_spec.image_pull_policy(tagged, "Sometimes")
+    assert str(excinfo.value) == "Invalid image-pull-policy: 'Sometimes'"
+
+
+def test_service():
+    assert pod_spec.service() is pod_spec.SERVICE
+    assert pod_spec.service("25%", "0") == {
+        "updateStrategy": {
+            "type": "RollingUpdate",
+            "rollingUpdate": {"maxSurge": "25%", "maxUnavailable": 0},
+        },
+    }
+    with pytest.raises(pod_spec.ConfigError):
+        pod_spec.service("0", "0")
+    with pytest.raises(pod_spec.ConfigError):
+        pod_spec.service("", "one")
+
+
+def test_anti_affinity():
+    assert pod_spec.anti_affinity("scraper", "none") is None
+    term = {
+        "labelSelector": {"matchLabels": {"juju-app": "scraper"}},
+        "topologyKey": "kubernetes.io/hostname",
+    }
+    assert pod_spec.anti_affinity("scraper", "preferred") == {
+        "podAntiAffinity": {
+            "preferredDuringSchedulingIgnoredDuringExecution": [
+                {"weight": 100, "podAffinityTerm": term}
+            ]
+        }
+    }
+    assert pod_spec.anti_affinity("scraper", "required") == {
+        "podAntiAffinity": {"requiredDuringSchedulingIgnoredDuringExecution": [term]}
+    }
+    with pytest.raises(pod_spec.ConfigError):
+        pod_spec.anti_affinity("scraper", "always")
+
+    sidecar = pod_spec.anti_affinity("scraper", "required", pod_spec.SIDECAR_APP_LABEL)
+    rules = sidecar["podAntiAffinity"]
+    [term] = rules["requiredDuringSchedulingIgnoredDuringExecution"]
+    assert term["labelSelector"] == {
+        "matchLabels": {"app.kubernetes.io/name": "scraper"}
+    }
+
+
+PLACEMENT_CONFIG = {
+    "node-selector": "",
+    "tolerations": "",
+    "anti-affinity": "none",
+    "priority-class-name": "",
+}
+
+
+def test_placement():
+    assert pod_spec.placement("dashboard", PLACEMENT_CONFIG) == {}
+
+    config = {
+        "node-selector": "{node-role.kubernetes.io/infra: true, zone: a}",
+        "tolerations": (
+            "[{key: dedicated, value: infra, effect: NoSchedule},"
+            " {key: node.kubernetes.io/unreachable, operator: Exists,"
+            " effect: NoExecute, tolerationSeconds: 30}]"
+        ),
+        "anti-affinity": "preferred",
+        "priority-class-name": "infra-critical",
+    }
+    placement = pod_spec.placement("dashboard", config)
+    assert placement["nodeSelector"] == {
+        "node-role.kubernetes.io/infra": "true",
+        "zone": "a",
+    }
+    assert placement["tolerations"] == [
+        {"key": "dedicated", "value": "infra", "effect": "NoSchedule"},
+        {
+            "key": "node.kubernetes.io/unreachable",
+            "operator": "Exists",
+            "effect": "NoExecute",
+            "tolerationSeconds": 30,
+        },
+    ]
+    assert placement["affinity"] == pod_spec.anti_affinity("dashboard", "preferred")
+    assert placement["priorityClassName"] == "infra-critical"
+
+
+def test_workload_placement():
+    placement = {"nodeSelector": {"zone": "a"}}
+    assert pod_spec.workload_placement("scraper", "StatefulSet", placement) == {
+        "apiVersion": "apps/v1",
+        "kind": "StatefulSet",
+        "metadata": {"name": "scraper"},
+        "spec": {"template": {"spec": {"nodeSelector": {"zone": "a"}}}},
+    }
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"node-selector": "[infra]"},
+         "node-selector must be a mapping of labels to values"),
+        ({"node-selector": "{a: b"}, "node-selector is not valid YAML"),
+        ({"tolerations": "{key: dedicated}"}, "tolerations must be a list"),
+        ({"tolerations": "[{key: a, operator: Exists, value: b}]"},
+         "Invalid toleration: {'key': 'a', 'operator': 'Exists', 'value': 'b'}"),
+        ({"tolerations": "[{key: a, tolerationSeconds: 30}]"},
+         "Invalid toleration: {'key': 'a', 'tolerationSeconds': 30}"),
+        ({"tolerations": "[{key: a, effect: Evict}]"},
+         "Invalid toleration: {'key': 'a', 'effect': 'Evict'}"),
+        ({"priority-class-name": "Infra"}, "Invalid priority-class-name: 'Infra'"),
+    ],
+)
+def test_placement_invalid(config, message):
+    with pytest.raises(pod_spec.ConfigError) as excinfo:
+        pod_spec.placement("dashboard", dict(PLACEMENT_CONFIG, **config))
+    assert str(excinfo.value) == message
+
+
+def test_probes():
+    probes = pod_spec.probes("HTTP", 8000, PROBE_CONFIG)
+    assert set(probes) == {"startupProbe", "livenessProbe", "readinessProbe"}
+    assert probes["startupProbe"] == {
+        "httpGet": {"scheme": "HTTP", "path": "/", "port": 8000},
+        "periodSeconds": 10,
+        "timeoutSeconds": 30,
+        "failureThreshold": 30,
+    }
+    assert probes["readinessProbe"]["failureThreshold"] == 3
+
+    with pytest.raises(pod_spec.ConfigError) as excinfo:
+        pod_spec.probes("HTTP", 8000, dict(PROBE_CONFIG, **{"probe-period": 0}))
+    assert str(excinfo.value) == "probe-period must be at least 1"
+
+
+METRICS_CONFIG = {
+    "metrics-annotations": False,
+    "pod-monitor": False,
+    "metrics-path": "/metrics",
+    "metrics-scrape-interval": 0,
+}
+
+
+def test_metrics_disabled():
+    assert pod_spec.scrape_annotations(8443, "https", METRICS_CONFIG) == {}
+    monitor = pod_spec.pod_monitor("dashboard", "dashboard", "https", METRICS_CONFIG)
+    assert monitor is None
+
+
+def test_metrics():
+    config = dict(
+        METRICS_CONFIG,
+        **{
+            "metrics-annotations": True,
+            "pod-monitor": True,
+            "metrics-scrape-interval": 30,
+        }
+    )
+    assert pod_spec.scrape_annotations(8000, "http", config) == {
+        "prometheus.io/scrape": "true",
+        "prometheus.io/port": "8000",
+        "prometheus.io/path": "/metrics",
+        "prometheus.io/scheme": "http",
+    }
+
+    monitor = pod_spec.pod_monitor("dashboard", "dashboard", "https", config)
+    yaml.dump(monitor, Dumper=_DefaultDumper)
+    assert monitor["kind"] == "PodMonitor"
+    assert monitor["spec"]["selector"] == {"matchLabels": {"juju-app": "dashboard"}}
+    assert monitor["spec"]["podMetricsEndpoints"] == [
+        {
+            "port": "dashboard",
+            "path": "/metrics",
+            "scheme": "https",
+            "interval": "30s",
+            "tlsConfig": {"insecureSkipVerify": True},
+        }
+    ]
+
+    job = pod_spec.scrape_job("scraper", "scraper.model.svc:8000", "http", config)
+    assert job == {
+        "job_name": "scraper",
+        "metrics_path": "/metrics",
+        "scheme": "http",
+        "scrape_interval": "30s",
+        "static_configs": [{"targets": ["scraper.model.svc:8000"]}],
+    }
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"metrics-path": "metrics"}, "Invalid metrics-path: 'metrics'"),
+        ({"metrics-scrape-interval": -1},
+         "metrics-scrape-interval must not be negative"),
+    ],
+)
+def test_metrics_invalid(config, message):
+    # Invalid options are reported even when nothing is exposed.
+    with pytest.raises(pod_spec.ConfigError) as excinfo:
+        pod_spec.scrape_annotations(8443, "https", dict(METRICS_CONFIG, **config))
+    assert str(excinfo.value) == message
+
+
+AUTOSCALING_CONFIG = {
+    "autoscaling-min-replicas": 1,
+    "autoscaling-max-replicas": 0,
+    "autoscaling-target-cpu": 0,
+    "autoscaling-target-memory": 0,
+    "cpu-request": "",
+    "memory-request": "",
+}
+
+
+def test_autoscaler():
+    assert pod_spec.autoscaler("dashboard", "Deployment", AUTOSCALING_CONFIG) is None
+
+    config = dict(
+        AUTOSCALING_CONFIG,
+        **{
+            "autoscaling-min-replicas": 2,
+            "autoscaling-max-replicas": 10,
+            "autoscaling-target-cpu": 70,
+            "cpu-request": "100m",
+        }
+    )
+    autoscaler = pod_spec.autoscaler("dashboard", "Deployment", config)
+    yaml.dump(autoscaler, Dumper=_DefaultDumper)
+    assert autoscaler["kind"] == "HorizontalPodAutoscaler"
+    assert autoscaler["spec"] == {
+        "scaleTargetRef": {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "name": "dashboard",
+        },
+        "minReplicas": 2,
+        "maxReplicas": 10,
+        "metrics": [
+            {
+                "type": "Resource",
+                "resource": {
+                    "name": "cpu",
+                    "target": {"type": "Utilization", "averageUtilization": 70},
+                },
+            }
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "config_overrides, message",
+    [
+        ({"autoscaling-max-replicas": -1},
+         "autoscaling-max-replicas must not be negative"),
+        ({"autoscaling-min-replicas": 0},
+         "autoscaling-min-replicas must be at least 1"),
+        ({"autoscaling-min-replicas": 5},
+         "autoscaling-max-replicas is lower than autoscaling-min-replicas"),
+        ({}, "autoscaling requires a cpu or memory target"),
+        ({"autoscaling-target-memory": 80},
+         "autoscaling-target-memory requires memory-request"),
+    ],
+)
+def test_autoscaler_invalid(config_overrides, message):
+    config = dict(AUTOSCALING_CONFIG, **{"autoscaling-max-replicas": 3})
+    config.update(config_overrides)
+    with pytest.raises(pod_spec.ConfigError) as excinfo:
+        pod_spec.autoscaler("dashboard", "Deployment", config)
+    assert str(excinfo.value) == message
+
+
+def test_pebble_layer():
+    layer = pod_spec.pebble_layer(
+        "dashboard", ["/dashboard", "--system-banner=Hi there"]
+    )
+    assert layer["services"] == {
+        "dashboard": {
+            "override": "replace",
+            "summary": "dashboard",
+            "command": "/dashboard '--system-banner=Hi there'",
+            "startup": "enabled",
+        },
+    }
+
+
+def test_api_manifests():
+    spec = {
+        "configMaps": {"settings": {"_global": "{}"}},
+        "kubernetesResources": {
+            "pod": {"annotations": {"a": "b"}},
+            "secrets": [{"name": "certs", "type": "Opaque"}],
+            "services": [{
+                "name": "kubernetes-dashboard",
+                "annotations": {"a": "b"},
+                "spec": {"ports": []},
+            }],
+            "ingressResources": [{
+                "name": "dashboard-ingress",
+                "annotations": {"nginx.ingress.kubernetes.io/use-regex": "true"},
+                "spec": {"rules": [{"host": "dashboard.local", "http": {"paths": [{
+                    "path": "/",
+                    "backend": {"serviceName": "kubernetes-dashboard",
+                                "servicePort": 443},
+                }]}}]},
+            }],
+            "customResources": {
+                pod_spec.POD_MONITOR_CRD: [{"kind": "PodMonitor"}],
+            },
+        },
+    }
+    manifests = pod_spec.api_manifests("dashboard", spec)
+    assert [manifest["kind"] for manifest in manifests] == [
+        "ConfigMap", "Secret", "Service", "Ingress", "PodMonitor"
+    ]
+    assert manifests[0]["data"] == {"_global": "{}"}
+    assert manifests[1]["metadata"]["labels"] == {"juju-app": "dashboard"}
+    assert manifests[1]["data"] == {}
+    assert manifests[2]["metadata"]["annotations"] == {"a": "b"}
+    ingress = manifests[3]
+    assert ingress["apiVersion"] == "networking.k8s.io/v1"
+    assert ingress["metadata"]["annotations"] == {
+        "nginx.ingress.kubernetes.io/use-regex": "true"
+    }
+    assert ingress["spec"]["rules"][0]["http"]["paths"][0] == {
+        "path": "/",
+        "pathType": "ImplementationSpecific",
+        "backend": {"service": {"name": "kubernetes-dashboard",
+                                "port": {"number": 443}}},
+    }
+
+
+def test_rbac_manifests():
+    manifests = pod_spec.rbac_manifests("dashboard", "kubernetes-dashboard")
+    assert [(manifest["kind"], manifest["metadata"]["name"])
+            for manifest in manifests] == [
+        ("Role", "dashboard"),
+        ("RoleBinding", "dashboard"),
+        ("ClusterRole", "kubernetes-dashboard-dashboard"),
+        ("ClusterRoleBinding", "kubernetes-dashboard-dashboard"),
+    ]
+    assert manifests[0]["rules"] == pod_spec.SERVICE_ACCOUNT["roles"][0]["rules"]
+    assert manifests[3]["roleRef"]["name"] == "kubernetes-dashboard-dashboard"
+    assert manifests[3]["subjects"] == [{
+        "kind": "ServiceAccount",
+        "name": "dashboard",
+        "namespace": "kubernetes-dashboard",
+    }]
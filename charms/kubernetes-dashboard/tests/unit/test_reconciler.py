@@ -0,0 +1,175 @@
+from unittest import mock
+
+import pytest
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from charms.k8s_dashboard.v0 import pod_spec
+from charms.k8s_dashboard.v0.reconciler import Reconciler
+
+
+class ReconciledCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.reconciler = Reconciler(self)
+
+
+@pytest.fixture
+def harness(monkeypatch):
+    client = mock.Mock(**{"list.return_value": []})
+    monkeypatch.setattr(Reconciler, "client", property(lambda self: client))
+    harness = Harness(ReconciledCharm, meta="name: reconciled\n")
+    harness.set_model_name("dashboard")
+    harness.set_leader(True)
+    harness.begin()
+    yield harness
+    harness.cleanup()
+
+
+def _budget(min_available):
+    return {
+        "apiVersion": "policy/v1",
+        "kind": "PodDisruptionBudget",
+        "metadata": {"name": "reconciled"},
+        "spec": {"minAvailable": min_available},
+    }
+
+
+def _labelled(manifest, **labels):
+    labels = dict(
+        {"juju-app": "reconciled", "k8s-dashboard.juju.is/model": "dashboard"},
+        **labels
+    )
+    return dict(manifest, metadata=dict(manifest["metadata"], labels=labels))
+
+
+def _seeded(manifest):
+    return _labelled(manifest, **{"k8s-dashboard.juju.is/seeded": "true"})
+
+
+def _patch(**fields):
+    return pod_spec.workload_placement("reconciled", "Deployment", fields)
+
+
+def test_set_pod_spec(harness):
+    reconciler = harness.charm.reconciler
+    spec = {"version": 3, "containers": []}
+    assert reconciler.set_pod_spec(spec)
+    assert reconciler.spec_set
+    assert not reconciler.set_pod_spec(spec)
+    assert reconciler.stats() == {"specs-applied": 1, "specs-skipped": 1}
+
+    reconciler.forget_applied()
+    assert reconciler.set_pod_spec(spec)
+
+
+def test_apply(harness):
+    reconciler = harness.charm.reconciler
+    client = reconciler.client
+    assert reconciler.apply([_budget(1)], _patch()) == []
+    client.apply.assert_called_once_with(_labelled(_budget(1)))
+
+    # an empty patch is only applied to release what was patched in
+    key = "policy/v1/PodDisruptionBudget/reconciled"
+    assert reconciler.apply([_budget(2)], _patch()) == [key]
+    assert client.apply.call_count == 2
+
+    # a new leader applies everything again, which updates nothing it knows of
+    reconciler.forget_applied()
+    assert reconciler.apply([_budget(2)], _patch()) == []
+    assert client.apply.call_args_list[-2:] == [
+        mock.call(_labelled(_budget(2))), mock.call(_patch())
+    ]
+
+    reconciler.apply([], _patch())
+    client.delete.assert_called_once_with(
+        "policy/v1", "PodDisruptionBudget", "reconciled"
+    )
+
+
+def test_apply_patch_after_pod_spec(harness):
+    reconciler = harness.charm.reconciler
+    client = reconciler.client
+    reconciler.set_pod_spec({"version": 3})
+    patch = _patch(nodeSelector={"pool": "infra"})
+    reconciler.apply([], patch)
+    # Juju only replaces the workload once the hook ends
+    client.apply.assert_not_called()
+
+    reconciler.spec_set = False
+    harness.framework.reemit()
+    client.apply.assert_called_once_with(patch)
+    reconciler.apply([], patch)
+    assert client.apply.call_count == 1
+
+    reconciler.apply([], _patch())
+    client.apply.assert_called_with(_patch())
+
+
+def test_seed(harness):
+    reconciler = harness.charm.reconciler
+    client = reconciler.client
+    reconciler.seed(_budget(1))
+    client.create.assert_called_once_with(_seeded(_budget(1)))
+    reconciler.seed(_budget(1))
+    assert client.create.call_count == 1
+    client.apply.assert_not_called()
+
+    # changes are applied over whatever was changed since
+    reconciler.seed(_budget(2))
+    client.apply.assert_called_once_with(_seeded(_budget(2)))
+
+    # a new leader only creates it if missing
+    reconciler.forget_applied()
+    reconciler.seed(_budget(2))
+    assert client.create.call_count == 2
+    assert client.apply.call_count == 1
+
+
+def test_apply_prunes_after_leader_change(harness):
+    reconciler = harness.charm.reconciler
+    client = reconciler.client
+    budget = {"metadata": {"name": "reconciled"}}
+    client.list.side_effect = lambda api_version, kind, selector: (
+        [budget] if kind == "PodDisruptionBudget" else []
+    )
+    reconciler.forget_applied()
+    reconciler.apply([], _patch())
+    # what another leader applied is found by its labels, seeded objects aside
+    client.list.assert_any_call(
+        "policy/v1",
+        "PodDisruptionBudget",
+        "juju-app=reconciled,k8s-dashboard.juju.is/model=dashboard,"
+        "!k8s-dashboard.juju.is/seeded",
+    )
+    client.delete.assert_called_once_with(
+        "policy/v1", "PodDisruptionBudget", "reconciled"
+    )
+
+    # and only listed once
+    client.list.reset_mock()
+    reconciler.apply([], _patch())
+    client.list.assert_not_called()
+
+
+def test_remove(harness):
+    client = harness.charm.reconciler.client
+    role = {"metadata": {"name": "dashboard-reconciled"}}
+    client.list.side_effect = lambda api_version, kind, selector: (
+        [role] if kind == "ClusterRole" else []
+    )
+    # units removed on scale-down leave the objects alone
+    harness.set_planned_units(1)
+    harness.charm.on.remove.emit()
+    client.list.assert_not_called()
+
+    harness.set_planned_units(0)
+    harness.charm.on.remove.emit()
+    client.list.assert_any_call(
+        "rbac.authorization.k8s.io/v1",
+        "ClusterRole",
+        "juju-app=reconciled,k8s-dashboard.juju.is/model=dashboard",
+    )
+    client.delete.assert_called_once_with(
+        "rbac.authorization.k8s.io/v1", "ClusterRole", "dashboard-reconciled"
+    )
@@ -0,0 +1,55 @@
+from unittest import mock
+
+from ops.charm import CharmBase
+from ops.testing import Harness
+
+from charms.k8s_dashboard.v0.timing import HookTimer, HookTimings
+
+
+def test_hook_timer():
+    ticks = iter([0.0, 0.5, 0.75, 1.0, 1.25])
+    timer = HookTimer(clock=lambda: next(ticks))
+    timer.lap("image-fetch")
+    timer.lap("set-spec")
+    timer.lap("image-fetch")
+    assert timer.summary() == {
+        "image-fetch-ms": "750.0",
+        "set-spec-ms": "250.0",
+        "total-ms": "1250.0",
+    }
+
+
+def test_hook_timer_disabled():
+    timer = HookTimer(enabled=False)
+    timer.lap("image-fetch")
+    assert timer.phases == {}
+    assert timer.summary() == {}
+
+
+class TimedCharm(CharmBase):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.hook_timings = HookTimings(self)
+
+
+def test_hook_timings():
+    harness = Harness(
+        TimedCharm, meta="name: timed\n", actions="hook-timings: {}\n"
+    )
+    harness.begin()
+    action_event = mock.Mock()
+    harness.charm.hook_timings.on_hook_timings_action(action_event)
+    action_event.fail.assert_called_once()
+
+    ticks = iter([0.0, 0.5, 1.0])
+    timer = HookTimer(clock=lambda: next(ticks))
+    timer.lap("set-spec")
+    event = mock.Mock()
+    event.handle.kind = "config_changed"
+    harness.charm.hook_timings.record(event, timer)
+    harness.charm.hook_timings.record(event, HookTimer(enabled=False))
+    action_event = mock.Mock()
+    harness.charm.hook_timings.on_hook_timings_action(action_event)
+    action_event.set_results.assert_called_once_with(
+        {"config-changed": {"set-spec-ms": "500.0", "total-ms": "1000.0"}}
+    )
@@ -0,0 +1,221 @@
+"""Orchestration of the functional test: build, deploy and wait for readiness.
+
+The executables are taken from the CHARMCRAFT, JUJU and KUBECTL environment
+variables, defaulting to the real ones, so that the orchestration can be run
+offline against the stubs in tests/func/stubs, see test_runner.py.
+
+Readiness is polled with a bounded exponential backoff rather than fixed
+sleeps, and each poll reads the cluster with a single kubectl call.
+
+If FUNC_METRICS_OUTPUT is set, the recorded metrics, such as the time to
+active, are also written there as JSON.
+"""
+
+import base64
+import json
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_EXECUTABLES = {
+    'charmcraft': 'charmcraft',
+    'juju': 'juju',
+    'kubectl': 'microk8s.kubectl',
+}
+
+# Resource kinds read by a single kubectl call on each poll.
+CLUSTER_KINDS = 'pods,secrets'
+
+METRICS = {}
+
+
+class CommandError(Exception):
+    def __init__(self, args, returncode, stdout, stderr):
+        super().__init__(args, returncode)
+        self.cmd = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __str__(self):
+        return (f'Command {self.cmd} failed ({self.returncode}):\n'
+                f'stdout:\n{self.stdout}\n'
+                f'stderr:\n{self.stderr}\n')
+
+
+def executable(name):
+    """Get the executable for a tool, overridable through the environment."""
+    return os.environ.get(name.upper(), DEFAULT_EXECUTABLES[name])
+
+
+def run(tool, *args, cwd=None):
+    """Run a tool and return its output.
+
+    Args:
+        tool (str): one of the DEFAULT_EXECUTABLES.
+        args: its arguments.
+        cwd (Optional[str]): the directory to run it from.
+
+    Returns:
+        str: the stripped stdout.
+
+    Raises:
+        CommandError: if the tool exits with an error.
+    """
+    args = [executable(tool)] + [str(a) for a in args]
+    res = subprocess.run(args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout = res.stdout.decode('utf8')
+    if res.returncode:
+        raise CommandError(args, res.returncode, stdout, res.stderr.decode('utf8'))
+    return stdout.strip()
+
+
+def build_charms(charm_dirs, cwd=None):
+    """Build the charms in parallel.
+
+    Each build spends most of its time installing dependencies and packing,
+    so they overlap well. All the builds are waited for, even once one
+    failed, so that none is left running behind the test.
+
+    Raises:
+        CommandError: for the first build which failed.
+    """
+    with ThreadPoolExecutor(max_workers=len(charm_dirs)) as pool:
+        futures = [pool.submit(run, 'charmcraft', 'build', '-f', charm_dir, cwd=cwd)
+                   for charm_dir in charm_dirs]
+    return [future.result() for future in futures]
+
+
+def wait_for(fetch, pending, description, timeout=15 * 60, initial_delay=1,
+             max_delay=30, sleep=time.sleep, clock=time.monotonic):
+    """Poll until nothing is pending, backing off exponentially.
+
+    Args:
+        fetch (Callable[[], Any]): reads the current state.
+        pending (Callable[[Any], List[str]]): lists what isn't ready yet in
+            the state, empty once everything is.
+        description (str): what is waited for, for the timeout message.
+        timeout (float): seconds to wait for at most.
+        initial_delay (float): seconds to wait after the first poll, doubled
+            after each poll.
+        max_delay (float): bound of the delay between polls.
+        sleep, clock: time.sleep and time.monotonic, or fakes of them.
+
+    Returns:
+        Any: the first state with nothing pending.
+
+    Raises:
+        TimeoutError: if something is still pending after the timeout.
+    """
+    deadline = clock() + timeout
+    delay = initial_delay
+    while True:
+        state = fetch()
+        waiting = pending(state)
+        if not waiting:
+            return state
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise TimeoutError('Timed out waiting for {}: {}'.format(
+                description, ', '.join(waiting)))
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+
+
+def juju_status(model):
+    return json.loads(run('juju', 'status', '-m', model, '--format=json'))
+
+
+def cluster_state(namespace):
+    """Read all the objects the test looks at with one kubectl call.
+
+    Returns:
+        List[Dict[str, Any]]: the pods and secrets of the namespace.
+    """
+    return json.loads(run('kubectl', 'get', CLUSTER_KINDS, '-n', namespace,
+                          '-o', 'json'))['items']
+
+
+def apps_pending(status, apps):
+    """List the applications, and their units, which aren't active and idle."""
+    waiting = []
+    for app in apps:
+        app_status = status.get('applications', {}).get(app)
+        if not app_status:
+            waiting.append('{} not deployed'.format(app))
+            continue
+        current = app_status['application-status']['current']
+        if current != 'active':
+            waiting.append('{} {}'.format(app, current))
+        for unit, unit_status in sorted(app_status.get('units', {}).items()):
+            workload = unit_status['workload-status']['current']
+            agent = unit_status['juju-status']['current']
+            if (workload, agent) != ('active', 'idle'):
+                waiting.append('{} {}/{}'.format(unit, workload, agent))
+    return waiting
+
+
+def pods(items, app):
+    return [item for item in items if item['kind'] == 'Pod'
+            and item['metadata'].get('labels', {}).get('juju-app') == app]
+
+
+def pods_pending(items, apps):
+    """List the applications without pods, and the pods which aren't ready."""
+    waiting = []
+    for app in apps:
+        app_pods = pods(items, app)
+        if not app_pods:
+            waiting.append('{} has no pods'.format(app))
+        for pod in app_pods:
+            statuses = pod['status'].get('containerStatuses', [])
+            if not statuses or not all(status['ready'] for status in statuses):
+                waiting.append('{} not ready'.format(pod['metadata']['name']))
+    return waiting
+
+
+def wait_for_active(model, apps, **kwargs):
+    """Wait for the applications to settle, active with all their pods ready.
+
+    Juju reports the applications active as soon as the pod spec is set, so
+    the pods, which are replaced by each new spec, are checked on the same
+    poll.
+
+    Args:
+        model (str): the model, also the namespace of the pods.
+        apps (List[str]): the applications.
+        kwargs: passed on to wait_for.
+
+    Returns:
+        List[Dict[str, Any]]: the cluster state once they are.
+    """
+    def fetch():
+        return juju_status(model), cluster_state(model)
+
+    def pending(state):
+        status, items = state
+        return apps_pending(status, apps) + pods_pending(items, apps)
+
+    return wait_for(fetch, pending, 'active applications', **kwargs)[1]
+
+
+def service_account_token(items, prefix):
+    """Get the token of the first service account secret named with prefix."""
+    for item in items:
+        if (item['kind'] == 'Secret'
+                and item.get('type') == 'kubernetes.io/service-account-token'
+                and item['metadata']['name'].startswith(prefix)):
+            return base64.b64decode(item['data']['token']).decode('utf8')
+    return None
+
+
+def record_metric(name, value):
+    """Report a metric and keep it for FUNC_METRICS_OUTPUT."""
+    METRICS[name] = value
+    print('{}: {:.1f}'.format(name, value))
+    output = os.environ.get('FUNC_METRICS_OUTPUT')
+    if output:
+        with open(output, 'w') as f:
+            json.dump(METRICS, f, indent=2, sort_keys=True)
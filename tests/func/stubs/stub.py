@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Stand-in for charmcraft, juju and kubectl, run through symlinks to it.
+
+Every call is logged, with its start and end times, to calls.jsonl in
+STUB_DIR. The applications turn active, and their pods ready, on the
+STUB_READY_AFTER-th status poll. A charmcraft build takes STUB_BUILD_SECONDS
+and fails for the charm directory named by STUB_FAIL.
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+APPS = ('k8s-dashboard', 'dashboard-metrics-scraper')
+
+
+def polls(log, tool):
+    """Count the previous juju status or kubectl get calls."""
+    if not log.exists():
+        return 0
+    with log.open() as f:
+        calls = [json.loads(line) for line in f]
+    return sum(1 for call in calls
+               if call['tool'] == tool and call['args'][0] in ('status', 'get'))
+
+
+def status(ready):
+    current = 'active' if ready else 'maintenance'
+    return {'applications': {app: {
+        'application-status': {'current': current},
+        'units': {'{}/0'.format(app): {
+            'workload-status': {'current': current},
+            'juju-status': {'current': 'idle' if ready else 'executing'},
+        }},
+    } for app in APPS}}
+
+
+def cluster(ready):
+    items = [{
+        'kind': 'Pod',
+        'metadata': {'name': '{}-0'.format(app), 'labels': {'juju-app': app}},
+        'status': {'containerStatuses': [{'ready': ready}]},
+    } for app in APPS]
+    items.append({
+        'kind': 'Secret',
+        'type': 'kubernetes.io/service-account-token',
+        'metadata': {'name': 'k8s-dashboard-token-abcde'},
+        'data': {'token': 'dG9rZW4='},
+    })
+    return {'items': items}
+
+
+def main():
+    tool = Path(sys.argv[0]).name
+    args = sys.argv[1:]
+    log = Path(os.environ['STUB_DIR']) / 'calls.jsonl'
+    ready = polls(log, tool) + 1 >= int(os.environ.get('STUB_READY_AFTER', 1))
+    start = time.time()
+    code = 0
+    if tool == 'charmcraft':
+        time.sleep(float(os.environ.get('STUB_BUILD_SECONDS', 0)))
+        if args[-1] == os.environ.get('STUB_FAIL'):
+            print('Failed to build {}'.format(args[-1]), file=sys.stderr)
+            code = 1
+    elif tool == 'juju' and args[0] == 'status':
+        print(json.dumps(status(ready)))
+    elif tool == 'kubectl' and args[0] == 'get':
+        print(json.dumps(cluster(ready)))
+    with log.open('a') as f:
+        f.write(json.dumps({'tool': tool, 'args': args,
+                            'start': start, 'end': time.time()}) + '\n')
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+"""Offline tests of the functional test orchestration, run against the stubs.
+
+Run with `tox -e unit`, no Juju or Kubernetes needed.
+"""
+
+import json
+from pathlib import Path
+
+import pytest
+
+import runner
+
+
+STUBS = Path(__file__).parent / 'stubs'
+
+
+@pytest.fixture
+def stubs(monkeypatch, tmp_path):
+    for tool in runner.DEFAULT_EXECUTABLES:
+        monkeypatch.setenv(tool.upper(), str(STUBS / tool))
+    monkeypatch.setenv('STUB_DIR', str(tmp_path))
+
+    def calls(tool):
+        log = tmp_path / 'calls.jsonl'
+        if not log.exists():
+            return []
+        with log.open() as f:
+            return [call for call in map(json.loads, f) if call['tool'] == tool]
+    return calls
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def clock(self):
+        return self.now
+
+
+def test_build_charms_in_parallel(stubs, monkeypatch):
+    monkeypatch.setenv('STUB_BUILD_SECONDS', '0.5')
+    runner.build_charms(['charms/a', 'charms/b'])
+    first, second = sorted(stubs('charmcraft'), key=lambda call: call['start'])
+    assert second['start'] < first['end']
+    assert sorted(call['args'][-1] for call in [first, second]) == [
+        'charms/a', 'charms/b'
+    ]
+
+
+def test_build_charms_failure(stubs, monkeypatch):
+    monkeypatch.setenv('STUB_FAIL', 'charms/b')
+    with pytest.raises(runner.CommandError) as excinfo:
+        runner.build_charms(['charms/a', 'charms/b'])
+    assert 'Failed to build charms/b' in str(excinfo.value)
+    # the other build still ran to completion
+    assert len(stubs('charmcraft')) == 2
+
+
+def test_wait_for_backs_off():
+    fake = FakeTime()
+    states = iter([['a', 'b'], ['b'], ['b'], ['b'], []])
+    state = runner.wait_for(lambda: next(states), list, 'things',
+                            initial_delay=1, max_delay=5,
+                            sleep=fake.sleep, clock=fake.clock)
+    assert state == []
+    assert fake.sleeps == [1, 2, 4, 5]
+
+
+def test_wait_for_timeout():
+    fake = FakeTime()
+    with pytest.raises(TimeoutError) as excinfo:
+        runner.wait_for(lambda: ['pod-0 not ready'], list, 'pods', timeout=10,
+                        sleep=fake.sleep, clock=fake.clock)
+    assert str(excinfo.value) == 'Timed out waiting for pods: pod-0 not ready'
+    # the last sleep is cut short at the deadline
+    assert fake.sleeps == [1, 2, 4, 3]
+
+
+def test_wait_for_active(stubs, monkeypatch):
+    monkeypatch.setenv('STUB_READY_AFTER', '3')
+    fake = FakeTime()
+    items = runner.wait_for_active(
+        'kubernetes-dashboard', ['k8s-dashboard', 'dashboard-metrics-scraper'],
+        sleep=fake.sleep, clock=fake.clock)
+    assert fake.sleeps == [1, 2]
+    # a single kubectl call per poll
+    kubectl_calls = stubs('kubectl')
+    assert [call['args'] for call in kubectl_calls] == [
+        ['get', 'pods,secrets', '-n', 'kubernetes-dashboard', '-o', 'json']
+    ] * 3
+    assert len(stubs('juju')) == 3
+    assert runner.pods_pending(items, ['k8s-dashboard']) == []
+    assert runner.service_account_token(items, 'k8s-dashboard-token') == 'token'
+
+
+def test_apps_pending():
+    status = {'applications': {'k8s-dashboard': {
+        'application-status': {'current': 'waiting'},
+        'units': {'k8s-dashboard/0': {
+            'workload-status': {'current': 'waiting'},
+            'juju-status': {'current': 'executing'},
+        }},
+    }}}
+    apps = ['k8s-dashboard', 'dashboard-metrics-scraper']
+    assert runner.apps_pending(status, apps) == [
+        'k8s-dashboard waiting',
+        'k8s-dashboard/0 waiting/executing',
+        'dashboard-metrics-scraper not deployed',
+    ]
+
+
+def test_record_metric(monkeypatch, tmp_path):
+    output = tmp_path / 'metrics.json'
+    monkeypatch.setenv('FUNC_METRICS_OUTPUT', str(output))
+    runner.record_metric('time-to-active', 42.0)
+    assert json.loads(output.read_text())['time-to-active'] == 42.0